@@ -1,19 +1,36 @@
 """Main Streamlit application for Prepaid Expense Management."""
 import streamlit as st
 import pandas as pd
-from datetime import date, datetime
+import numpy as np
+from datetime import date, datetime, timedelta
 from sqlalchemy.orm import Session
 import os
 
 # Import models and services
 from models.database import init_db, SessionLocal, Expense, Allocation, Document
 from models.expense import ExpenseCreate
+from models.schedule import AllocationSchedule
 from services.allocation import AllocationService
 from services.storage import GoogleDriveService
 from services.export import ExportService
 from services.import_service import ImportService
+from services.projection import ProjectionService
+from services.simulation import SimulationService
+from services.expense_index import ExpenseIndexService
+from services.report import ReportService, CURRENT_MONTHS
+from services.allocation_totals import AllocationTotalService
+from services.pivot import PivotService
+from services.tag_index import TagIndexService
+from services.search import SearchService
+from services.period_close import PeriodCloseService
+from services.dashboard import DashboardService
+from services.fiscal_year import FiscalYearService
+from services.allocation_methods import METHOD_TRANCHE, METHOD_LABELS, get_method
 from utils.validators import validate_account_number, validate_amount, validate_file_type
-from utils.helpers import format_currency, format_quarter, get_quarter
+from utils.helpers import (
+    format_currency, format_quarter, format_period, get_quarter, get_quarter_dates, to_dong, PERIOD_LABELS
+)
+from utils.fiscal_calendar import calendar_month
 from config.settings import settings
 
 # Page configuration
@@ -29,6 +46,17 @@ drive_service = GoogleDriveService()
 allocation_service = AllocationService()
 export_service = ExportService()
 import_service = ImportService()
+projection_service = ProjectionService()
+simulation_service = SimulationService()
+expense_index = ExpenseIndexService()
+report_service = ReportService()
+allocation_totals = AllocationTotalService()
+pivot_service = PivotService()
+tag_index = TagIndexService()
+search_service = SearchService()
+period_close = PeriodCloseService()
+dashboard_service = DashboardService()
+fiscal_year = FiscalYearService()
 
 # Auto-Restore from Drive if connected and local db missing
 if drive_service.is_configured() and not os.path.exists("./data/expenses.db"):
@@ -68,6 +96,17 @@ if drive_service.is_configured() and not os.path.exists("./data/expenses.db"):
 # Initialize database (after potential restore)
 init_db()
 
+# Apply the stored fiscal year start, then fill the per-period summary, tag and search
+# tables for databases created before they existed
+_db = SessionLocal()
+try:
+    fiscal_year.load(_db)
+    allocation_totals.ensure_built(_db)
+    tag_index.ensure_built(_db)
+    search_service.ensure_built(_db)
+finally:
+    _db.close()
+
 # Verify write access on startup
 try:
     db_path = settings.database_url.replace("sqlite:///", "")
@@ -129,7 +168,7 @@ def main():
     st.sidebar.title("📊 Menu")
     page = st.sidebar.radio(
         "Chọn chức năng:",
-        ["📝 Nhập Chi Phí", "📥 Import Hàng Loạt", "📋 Danh Sách Chi Phí", "📊 Kế Hoạch Phân Bổ", "⚙️ Cài Đặt"]
+        ["📈 Tổng Quan", "📝 Nhập Chi Phí", "📥 Import Hàng Loạt", "📋 Danh Sách Chi Phí", "📊 Kế Hoạch Phân Bổ", "⚙️ Cài Đặt"]
     )
     
     # Display service status
@@ -141,12 +180,27 @@ def main():
     else:
         st.sidebar.warning("⚠️ Google Drive chưa cấu hình")
     
+    # Current period totals from the summary table
+    st.sidebar.markdown("---")
+    st.sidebar.markdown("### 📈 Phân Bổ Kỳ Hiện Tại")
+    current_quarter, current_year = get_quarter(date.today())
+    db = SessionLocal()
+    try:
+        year_totals = allocation_totals.period_totals(db, current_year)
+    finally:
+        db.close()
+    quarter_totals = year_totals[year_totals['quarter'] == current_quarter]
+    st.sidebar.metric(f"Quý {current_quarter}/{current_year}", format_currency(int(quarter_totals['amount'].sum())))
+    st.sidebar.metric(f"Cả năm {current_year}", format_currency(int(year_totals['amount'].sum())))
+    
     # Sidebar Info
     st.sidebar.markdown("---")
     st.sidebar.info("Phần mềm Quản lý Chi phí Trả trước")
     
     # Navigation
-    if page == "📝 Nhập Chi Phí":
+    if page == "📈 Tổng Quan":
+        page_dashboard()
+    elif page == "📝 Nhập Chi Phí":
         page_create_expense()
     elif page == "📥 Import Hàng Loạt":
         page_bulk_import()
@@ -158,6 +212,84 @@ def main():
         page_settings()
 
 
+def page_dashboard():
+    """Dashboard page with quarterly amortization, balance trend and breakdowns."""
+    st.title("📈 Tổng Quan")
+    
+    current_quarter, current_year = get_quarter(date.today())
+    quarter_end = get_quarter_dates(current_quarter, current_year)[1]
+    db = SessionLocal()
+    try:
+        # Pre-aggregated quarterly series, cached until the next committed write
+        series = dashboard_service.cached_series(db)
+        tag_balances = dashboard_service.cached_tags(db, quarter_end)
+    finally:
+        db.close()
+    
+    if series.empty:
+        st.info("📭 Chưa có dữ liệu.")
+        return
+    
+    this_quarter = series[(series['year'] == current_year) & (series['quarter'] == current_quarter)]
+    this_year = series[series['year'] == current_year]
+    c1, c2, c3, c4 = st.columns(4)
+    with c1:
+        st.metric(f"Số dư cuối Quý {current_quarter}/{current_year}", format_currency(int(this_quarter['closing'].sum())))
+    with c2:
+        st.metric(f"Phân bổ Quý {current_quarter}/{current_year}", format_currency(int(this_quarter['amortization'].sum())))
+    with c3:
+        st.metric(f"Phân bổ năm {current_year}", format_currency(int(this_year['amortization'].sum())))
+    with c4:
+        st.metric(f"Tăng trong năm {current_year}", format_currency(int(this_year['additions'].sum())))
+    
+    group_levels = {"Tài khoản": ['account_number'], "Mã phụ": ['sub_code'], "Tài khoản - Mã phụ": ['account_number', 'sub_code']}
+    years = sorted(series['year'].unique().tolist())
+    first_year = min(max(current_year - 2, years[0]), years[-1])
+    col_d1, col_d2 = st.columns(2)
+    with col_d1:
+        year_range = st.select_slider(
+            "Năm tài chính", options=years, value=(first_year, max(min(current_year + 1, years[-1]), first_year)),
+            key="dashboard_years"
+        )
+    with col_d2:
+        dashboard_group = st.radio("Nhóm theo", list(group_levels.keys()), horizontal=True, key="dashboard_group")
+    
+    keys = group_levels[dashboard_group]
+    shown = series[(series['year'] >= year_range[0]) & (series['year'] <= year_range[1])]
+    shown = shown.assign(group=shown[keys].astype(str).agg(" - ".join, axis=1))
+    
+    def by_quarter(column):
+        return shown.pivot_table(index='end_date', columns='group', values=column, aggfunc='sum').rename_axis("Cuối quý")
+    
+    st.markdown("### 📊 Phân bổ theo quý")
+    st.bar_chart(by_quarter('amortization'))
+    
+    st.markdown("### 📉 Số dư cuối quý")
+    st.line_chart(by_quarter('closing'))
+    
+    st.markdown(f"### 🧩 Cơ cấu số dư cuối Quý {current_quarter}/{current_year}")
+    col_b1, col_b2 = st.columns(2)
+    with col_b1:
+        by_group = (
+            this_quarter.assign(group=this_quarter[keys].astype(str).agg(" - ".join, axis=1))
+            .groupby('group')['closing'].sum()
+        )
+        by_group = by_group[by_group != 0].rename_axis(dashboard_group).rename("Số dư")
+        st.bar_chart(by_group)
+        st.dataframe(
+            by_group.reset_index(), use_container_width=True, hide_index=True,
+            column_config={"Số dư": st.column_config.NumberColumn(format=None)}
+        )
+    with col_b2:
+        by_tag = tag_balances.rename(columns={'tag': "Tags", 'balance': "Số dư"}).set_index("Tags")["Số dư"]
+        st.bar_chart(by_tag)
+        st.dataframe(
+            by_tag.reset_index(), use_container_width=True, hide_index=True,
+            column_config={"Số dư": st.column_config.NumberColumn(format=None)}
+        )
+        st.caption("💡 Khoản mục có nhiều tag được tính vào từng tag.")
+
+
 def page_create_expense():
     """Page for creating new expense."""
     st.title("📝 Nhập Chi Phí Trả Trước Mới")
@@ -166,10 +298,10 @@ def page_create_expense():
     
     # Initialize session state for past allocations if not exists
     if 'past_allocations_rows' not in st.session_state:
-        st.session_state['past_allocations_rows'] = [{'amount': 0.0, 'period': ''}]
+        st.session_state['past_allocations_rows'] = [{'amount': 0, 'period': ''}]
 
     def add_past_allocation_row():
-        st.session_state['past_allocations_rows'].append({'amount': 0.0, 'period': ''})
+        st.session_state['past_allocations_rows'].append({'amount': 0, 'period': ''})
 
     def remove_past_allocation_row(index):
         if len(st.session_state['past_allocations_rows']) > 0:
@@ -182,7 +314,7 @@ def page_create_expense():
             account_number = st.text_input("Tài khoản chi phí (*)", value="242")
             name = st.text_input("Tên khoản chi phí (*)")
             document_code = st.text_input("Mã chứng từ / Hóa đơn")
-            total_amount = st.number_input("Tổng số tiền (*)", min_value=0.0, step=1000.0, format="%f")
+            total_amount = st.number_input("Tổng số tiền (*)", min_value=0, step=1000)
             
             st.markdown("---")
             st.markdown("**Phân bổ Quá khứ (Nếu có)**")
@@ -217,6 +349,33 @@ def page_create_expense():
         with col2:
             start_date = st.date_input("Ngày bắt đầu (*)", value=date.today(), format="DD/MM/YYYY")
             end_date = st.date_input("Ngày kết thúc phân bổ (*)", value=date.today(), format="DD/MM/YYYY")
+            period_type = st.selectbox(
+                "Kỳ phân bổ (*)",
+                options=list(PERIOD_LABELS),
+                index=list(PERIOD_LABELS).index('quarter'),
+                format_func=lambda p: PERIOD_LABELS[p],
+                help="Phân bổ theo tháng (khóa sổ cuối tháng), theo quý hoặc theo năm"
+            )
+            allocation_method = st.selectbox(
+                "Phương pháp phân bổ (*)",
+                options=list(METHOD_LABELS),
+                format_func=lambda m: METHOD_LABELS[m],
+                help="Theo ngày: chia đều theo số ngày thực tế. Đều theo tháng: mỗi tháng bằng nhau, "
+                     "tháng lẻ đầu/cuối tính theo ngày. Theo đợt: nhập các đợt bên dưới."
+            )
+            with st.expander("Các đợt phân bổ (chỉ dùng cho phương pháp Theo đợt)"):
+                st.caption("Mỗi đợt kéo dài đến ngày kết thúc đợt; đợt cuối kéo dài đến ngày kết thúc phân bổ. "
+                           "Tổng tiền được chia cho các đợt theo tỷ lệ số tiền của từng đợt.")
+                edited_tranches = st.data_editor(
+                    pd.DataFrame({'end_date': pd.Series(dtype='datetime64[ns]'), 'weight': pd.Series(dtype='int64')}),
+                    num_rows="dynamic",
+                    column_config={
+                        "end_date": st.column_config.DateColumn("Ngày kết thúc đợt", format="DD/MM/YYYY"),
+                        "weight": st.column_config.NumberColumn("Số tiền đợt", min_value=0, format="%d")
+                    },
+                    use_container_width=True,
+                    key="tranche_editor"
+                )
             
             # Auto-calculate sub-code
             months = allocation_service.calculate_months_between_dates(start_date, end_date)
@@ -261,6 +420,19 @@ def page_create_expense():
             if end_date <= start_date:
                 st.error("Ngày kết thúc phải sau ngày bắt đầu")
                 return
+            
+            allocation_params = None
+            if allocation_method == METHOD_TRANCHE:
+                try:
+                    allocation_params = get_method(allocation_method).validate_params({
+                        'tranches': [
+                            {'end_date': row['end_date'], 'weight': row['weight']}
+                            for _, row in edited_tranches.dropna().iterrows()
+                        ]
+                    })
+                except ValueError as e:
+                    st.error(f"❌ {e}")
+                    return
 
             try:
                 # Calculate allocation months for compatibility
@@ -281,7 +453,7 @@ def page_create_expense():
                 
                 # edited_past_alloc is a DataFrame
                 for idx, row in edited_past_alloc.iterrows():
-                    p_amount = float(row.get('amount', 0) or 0)
+                    p_amount = to_dong(row.get('amount', 0) or 0)
                     p_period = str(row.get('period', '') or '').strip()
                     
                     if p_amount > 0:
@@ -303,7 +475,9 @@ def page_create_expense():
                     allocation_months=months,
                     tags=tags,
                     note=note,
-                    already_allocated=total_already_allocated
+                    already_allocated=total_already_allocated,
+                    allocation_method=allocation_method,
+                    allocation_params=allocation_params
                 )
                 
                 # Add Historical Allocations
@@ -321,6 +495,7 @@ def page_create_expense():
                             pass
                     
                     hist_alloc = Allocation(
+                        period=p_quarter,
                         quarter=p_quarter,
                         year=p_year,
                         amount=p_alloc['amount'],
@@ -331,21 +506,12 @@ def page_create_expense():
                     new_expense.allocations.append(hist_alloc)
 
                 # Calculate allocations
-                allocations_data = allocation_service.calculate_quarterly_allocations(
-                    total_amount, start_date, end_date
+                allocations_data = allocation_service.get_schedule(
+                    total_amount, start_date, end_date, period_type, allocation_method, allocation_params
                 )
                 
                 # Create Future Allocation Records
-                for alloc_data in allocations_data:
-                    allocation = Allocation(
-                        quarter=alloc_data['quarter'],
-                        year=alloc_data['year'],
-                        amount=alloc_data['amount'],
-                        days_in_quarter=alloc_data['days_in_quarter'],
-                        start_date=alloc_data['start_date'],
-                        end_date=alloc_data['end_date']
-                    )
-                    new_expense.allocations.append(allocation)
+                new_expense.allocations.extend(allocation_service.schedule_to_allocations(allocations_data))
                 
                 # Upload Documents
                 if uploaded_files and drive_service.is_configured():
@@ -382,7 +548,7 @@ def page_create_expense():
                 st.info(f"Đã ghi nhận {len(past_allocations_list)} khoản phân bổ quá khứ.")
                 
                 # Reset form sort of (session state needs manual clear or rerun)
-                st.session_state['past_allocations_rows'] = [{'amount': 0.0, 'period': ''}]
+                st.session_state['past_allocations_rows'] = [{'amount': 0, 'period': ''}]
                 
             except Exception as e:
                 db.rollback()
@@ -433,6 +599,21 @@ def page_bulk_import():
                 if st.button("🚀 Bắt đầu Import", type="primary"):
                     expenses_data = import_service.parse_import_data(df)
                     
+                    # Get every schedule up front through the cache, one batch per period type
+                    allocations_by_expense = {}
+                    for period_type in PERIOD_LABELS:
+                        positions = [i for i, e in enumerate(expenses_data) if e['period_type'] == period_type]
+                        if not positions:
+                            continue
+                        schedules = allocation_service.get_schedules(
+                            [expenses_data[i]['total_amount'] for i in positions],
+                            [expenses_data[i]['start_date'] for i in positions],
+                            [expenses_data[i]['end_date'] for i in positions],
+                            period_type,
+                            methods=[expenses_data[i]['allocation_method'] for i in positions]
+                        )
+                        allocations_by_expense.update(zip(positions, schedules))
+                    
                     progress_bar = st.progress(0)
                     status_text = st.empty()
                     
@@ -454,6 +635,7 @@ def page_bulk_import():
                                 end_date=expense_data['end_date'],
                                 sub_code=expense_data['sub_code'],
                                 allocation_months=expense_data['allocation_months'],
+                                allocation_method=expense_data['allocation_method'],
                                 already_allocated=expense_data.get('already_allocated', 0),
                                 past_quarter_year=expense_data.get('past_quarter_year')
                             )
@@ -474,6 +656,7 @@ def page_bulk_import():
                                     # Create historical record
                                     # Use start_date as a placeholder for historical dates
                                     hist_alloc = Allocation(
+                                        period=past_q,
                                         quarter=past_q,
                                         year=past_y,
                                         amount=expense_data['already_allocated'],
@@ -483,23 +666,11 @@ def page_bulk_import():
                                     )
                                     new_expense.allocations.append(hist_alloc)
 
-                            # Calculate and add normal allocations
-                            allocations_data = allocation_service.calculate_quarterly_allocations(
-                                expense_data['total_amount'],
-                                expense_data['start_date'],
-                                expense_data['end_date']
-                            )
-                            
-                            for alloc in allocations_data:
-                                allocation = Allocation(
-                                    quarter=alloc['quarter'],
-                                    year=alloc['year'],
-                                    amount=alloc['amount'],
-                                    days_in_quarter=alloc['days_in_quarter'],
-                                    start_date=alloc['start_date'],
-                                    end_date=alloc['end_date']
+                            # Add normal allocations from the cached schedule
+                            if i in allocations_by_expense:
+                                new_expense.allocations.extend(
+                                    allocation_service.schedule_to_allocations(allocations_by_expense[i])
                                 )
-                                new_expense.allocations.append(allocation)
                             
                             db.add(new_expense)
                             db.commit()
@@ -525,58 +696,75 @@ def page_list_expenses():
     st.title("📋 Danh Sách Chi Phí")
     
     db = SessionLocal()
+    locked_through = period_close.locked_through(db)
     
     # 1. Filters
-    col_f1, col_f2, col_f3 = st.columns(3)
+    col_f1, col_f2, col_f3, col_f4 = st.columns(4)
     with col_f1:
-        search_term = st.text_input("🔍 Tìm kiếm:", placeholder="Tên, Số TK, v.v.")
+        search_term = st.text_input("🔍 Tìm kiếm:", placeholder="Tên, Số TK, Mã CT, Ghi chú (không cần dấu)")
     
     with col_f2:
         term_filter = st.selectbox("⏳ Hạn mức:", ["Tất cả", "Ngắn hạn (9995)", "Dài hạn (9996)"])
 
     with col_f3:
-        # Get all unique tags for filter
-        all_tags = []
-        all_expenses_query = db.query(Expense.tags).filter(Expense.tags.isnot(None)).all()
-        for t in all_expenses_query:
-            if t[0]:
-                tags_list = [tag.strip() for tag in t[0].split(',')]
-                all_tags.extend(tags_list)
-        unique_tags = sorted(list(set(all_tags)))
-        
-        selected_tags = st.multiselect("🏷️ Tags:", options=unique_tags)
+        # Distinct tags come from the cached tag index
+        selected_tags = st.multiselect("🏷️ Tags:", options=tag_index.tag_names(db))
+    
+    with col_f4:
+        status_filter = st.selectbox("📆 Trạng thái:", ["Tất cả", "Đang phân bổ hôm nay", "Còn số dư"])
 
     # 2. Query
     query = db.query(Expense)
     
-    if search_term:
-        query = query.filter(
-            (Expense.name.contains(search_term)) | 
-            (Expense.account_number.contains(search_term)) |
-            (Expense.sub_code.contains(search_term))
-        )
+    # Active/open expenses come from the interval index instead of scanning the table
+    if status_filter == "Đang phân bổ hôm nay":
+        query = query.filter(expense_index.id_filter(Expense.id, expense_index.active_on(date.today(), db)))
+    elif status_filter == "Còn số dư":
+        query = query.filter(expense_index.id_filter(Expense.id, expense_index.with_balance_on(date.today(), db)))
+    
+    # Full-text search (prefix words, diacritics ignored), best matches first
+    search = search_service.ranked(search_term) if search_term else None
+    if search is not None:
+        query = query.join(search, search.c.expense_id == Expense.id)
     
     if term_filter != "Tất cả":
         code_to_filter = "9995" if "9995" in term_filter else "9996"
         query = query.filter(Expense.sub_code == code_to_filter)
     
     if selected_tags:
-        # Simple OR filtering for tags (if expense has ANY of the selected tags)
-        # SQLite doesn't have array types, so we check string contains
-        conditions = []
-        for tag in selected_tags:
-            conditions.append(Expense.tags.contains(tag))
-        from sqlalchemy import or_
-        query = query.filter(or_(*conditions))
-
-    # 3. Sort by Start Date (Newest first)
-    expenses = query.order_by(Expense.start_date.desc()).all()
+        # Expenses having ANY of the selected tags, through the indexed tag tables
+        query = query.filter(tag_index.tag_filter(Expense.id, selected_tags))
+
+    # 3. Sort by search rank, then Start Date (Newest first), one page at a time
+    total_count = query.count()
     
-    if not expenses:
+    if not total_count:
         st.info("📭 Không tìm thấy chi phí nào.")
         db.close()
         return
     
+    page_size = settings.list_page_size
+    page_count = (total_count - 1) // page_size + 1
+    # Filters may shrink the result below the page kept in session state
+    if st.session_state.get('list_page', 1) > page_count:
+        st.session_state['list_page'] = page_count
+    
+    col_p1, col_p2 = st.columns([1, 4])
+    with col_p1:
+        page = st.number_input(f"Trang (/{page_count})", min_value=1, max_value=page_count, value=1, step=1, key="list_page")
+    offset = (page - 1) * page_size
+    order = (Expense.start_date.desc(), Expense.id.desc())
+    if search is not None:
+        order = (search.c.rank,) + order
+    expenses = (
+        query.order_by(*order)
+        .limit(page_size)
+        .offset(offset)
+        .all()
+    )
+    with col_p2:
+        st.caption(f"Hiển thị {offset + 1}–{offset + len(expenses)} / {total_count} khoản mục")
+    
     # 3. Display Expenses
     for expense in expenses:
         combined_total = expense.total_amount + expense.already_allocated
@@ -584,7 +772,11 @@ def page_list_expenses():
         # Header with Name, Account, SubCode and Start Date
         header_text = f"📅 {expense.start_date.strftime('%d/%m/%Y')} | [{expense.sub_code}] {expense.name} ({expense.account_number})"
         
-        with st.expander(header_text, expanded=False):
+        # Details, schedule and forms are only built for opened expenses
+        if not st.toggle(header_text, key=f"open_{expense.id}"):
+            continue
+        
+        with st.container(border=True):
             # --- TOP METRICS ROW (Simplified) ---
             m1, m2 = st.columns(2)
             with m1:
@@ -602,6 +794,7 @@ def page_list_expenses():
                 st.markdown(f"**Mã phụ (Khoản mục):** {expense.sub_code}")
                 st.markdown(f"**Ngày bắt đầu:** {expense.start_date.strftime('%d/%m/%Y')}")
                 st.markdown(f"**Ngày kết thúc:** {expense.end_date.strftime('%d/%m/%Y')}")
+                st.markdown(f"**Phương pháp phân bổ:** {METHOD_LABELS.get(expense.allocation_method, expense.allocation_method)}")
                 
             with c2:
                 st.caption("✏️ Thông tin bổ sung (Có thể sửa)")
@@ -637,31 +830,22 @@ def page_list_expenses():
             # --- ALLOCATION SCHEDULE (Moved Up) ---
             st.markdown("##### 📅 Kế hoạch phân bổ")
             
-            # Prepare data logic 
-            schedule_data = []
-            sorted_allocs = sorted(expense.allocations, key=lambda x: (x.year, x.quarter))
-            running_accumulated = expense.already_allocated
-            total_expense_val = expense.total_amount + expense.already_allocated
+            # Running totals come from the windowed schedule query
+            allocs = report_service.allocation_detail(db, expense_ids=[expense.id])
+            periods = allocs['period'].fillna(allocs['quarter']).astype(int)
             
-            for alloc in sorted_allocs:
-                alloc_amount = int(round(alloc.amount))
-                if alloc.days_in_quarter > 0:
-                    running_accumulated += alloc_amount
-                remaining_val = total_expense_val - running_accumulated
-                
-                q_label = f"Q{alloc.quarter}/{alloc.year}" if alloc.quarter > 0 else "QK (Quá khứ)"
-                
-                schedule_data.append({
-                    "Quý/Năm": q_label,
-                    "Số tiền": alloc_amount, 
-                    "Lũy kế đã PB": int(running_accumulated),
-                    "Còn lại chưa PB": int(remaining_val),
-                    "Ngày BĐ": alloc.start_date.strftime("%d/%m/%Y"),
-                    "Ngày KT": alloc.end_date.strftime("%d/%m/%Y"),
-                    "Số ngày": alloc.days_in_quarter
-                })
-            
-            df_schedule = pd.DataFrame(schedule_data)
+            df_schedule = pd.DataFrame({
+                "Kỳ": [
+                    format_period(period_type, period, year) if quarter > 0 else "QK (Quá khứ)"
+                    for period_type, period, quarter, year in zip(allocs['period_type'], periods, allocs['quarter'], allocs['year'])
+                ],
+                "Số tiền": allocs['amount'],
+                "Lũy kế đã PB": allocs['accumulated'],
+                "Còn lại chưa PB": allocs['remaining'],
+                "Ngày BĐ": pd.to_datetime(allocs['start_date']).dt.strftime("%d/%m/%Y"),
+                "Ngày KT": pd.to_datetime(allocs['end_date']).dt.strftime("%d/%m/%Y"),
+                "Số ngày": allocs['days_in_quarter']
+            })
             st.dataframe(
                 df_schedule,
                 use_container_width=True,
@@ -721,6 +905,49 @@ def page_list_expenses():
                             db.commit()
                             if cnt: st.rerun()
                 
+                # Schedule adjustment: only open periods are recalculated
+                with st.form(key=f"reschedule_form_{expense.id}"):
+                    st.caption("🔧 Điều chỉnh phân bổ (các kỳ đã khóa sổ được giữ nguyên)")
+                    r1, r2, r3 = st.columns(3)
+                    with r1:
+                        new_total = st.number_input(
+                            "Tổng tiền mới", value=int(expense.total_amount), min_value=0, step=1000,
+                            key=f"rs_total_{expense.id}"
+                        )
+                    with r2:
+                        new_end = st.date_input(
+                            "Ngày kết thúc mới", value=expense.end_date, format="DD/MM/YYYY",
+                            key=f"rs_end_{expense.id}"
+                        )
+                    with r3:
+                        # Closed quarters stay locked: the effective date starts after the last close
+                        first_open_day = locked_through + timedelta(days=1) if locked_through else None
+                        effective_date = st.date_input(
+                            "Ngày hiệu lực", value=max(date.today(), first_open_day or date.today()),
+                            min_value=first_open_day, format="DD/MM/YYYY",
+                            key=f"rs_eff_{expense.id}"
+                        )
+                    terminate = st.checkbox(
+                        "Chấm dứt sớm tại ngày hiệu lực (phân bổ hết số còn lại)", key=f"rs_term_{expense.id}"
+                    )
+                    
+                    if st.form_submit_button("🔁 Cập nhật phân bổ"):
+                        try:
+                            result = allocation_service.reschedule_expense(
+                                db, expense,
+                                total_amount=new_total,
+                                end_date=effective_date if terminate else new_end,
+                                as_of=effective_date
+                            )
+                            st.toast(
+                                f"✅ Thêm {result['inserted']} | Sửa {result['updated']} | "
+                                f"Xóa {result['deleted']} kỳ phân bổ",
+                                icon="✅"
+                            )
+                            st.rerun()
+                        except ValueError as e:
+                            st.error(f"❌ {str(e)}")
+                
                 st.divider()
                 
                 # Bottom Actions
@@ -739,10 +966,14 @@ def page_list_expenses():
                 
                 with ac2:
                      if st.button("🗑️ Xóa Khoản mục này", key=f"delete_{expense.id}", type="primary"):
-                        db.delete(expense)
-                        db.commit()
-                        st.success("Đã xóa!")
-                        st.rerun()
+                        try:
+                            db.delete(expense)
+                            db.commit()
+                            st.success("Đã xóa!")
+                            st.rerun()
+                        except ValueError as e:
+                            db.rollback()
+                            st.error(f"❌ {str(e)}")
 
     db.close()
 
@@ -753,7 +984,14 @@ def page_allocation_schedule():
     
     db = SessionLocal()
 
-    tab1, tab2 = st.tabs(["📊 Báo cáo Số dư & Pivot", "📅 Chi tiết Phân bổ (Theo Dòng thời gian)"])
+    tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs([
+        "📊 Báo cáo Số dư & Pivot",
+        "📅 Chi tiết Phân bổ (Theo Dòng thời gian)",
+        "🔮 Dự báo Phân bổ",
+        "🧪 Mô phỏng Thay đổi",
+        "🔄 Biến động TK 242",
+        "⏳ Ngắn/Dài hạn & Kỳ hạn"
+    ])
 
     # --- TAB 1: REPORT & PIVOT (SNAPSHOT) ---
     with tab1:
@@ -773,15 +1011,11 @@ def page_allocation_schedule():
                 
             with col_c3:
                 # Filter options
-                all_tags = []
-                all_expenses_query = db.query(Expense.tags).filter(Expense.tags.isnot(None)).all()
-                for t in all_expenses_query:
-                    if t[0]:
-                        tags_list = [tag.strip() for tag in t[0].split(',')]
-                        all_tags.extend(tags_list)
-                unique_tags = sorted(list(set(all_tags)))
-                
-                filter_tags = st.multiselect("Lọc dữ liệu theo Tags:", options=unique_tags, key="filter_tags_tab1")
+                filter_tags = st.multiselect("Lọc dữ liệu theo Tags:", options=tag_index.tag_names(db), key="filter_tags_tab1")
+                hide_finished = st.checkbox(
+                    "Ẩn khoản đã phân bổ hết", value=False, key="hide_finished_tab1",
+                    help="Bỏ qua các khoản có ngày kết thúc trước ngày báo cáo (số dư bằng 0); Tổng Gốc và Lũy kế khi đó không gồm các khoản này"
+                )
             
             # Add Run Button to prevent auto-recalc flicker
             run_report = st.button("🚀 Tạo Báo Cáo", type="primary", key="btn_run_report")
@@ -791,77 +1025,38 @@ def page_allocation_schedule():
             st.session_state['report_generated_tab1'] = True
             
         if st.session_state.get('report_generated_tab1'):
-            # Fetch all expenses
-            query = db.query(Expense)
-            
-            if filter_tags:
-                conditions = []
-                for tag in filter_tags:
-                    conditions.append(Expense.tags.contains(tag))
-                from sqlalchemy import or_
-                query = query.filter(or_(*conditions))
-                
-            # Sort deterministically to avoid flickering
-            expenses = query.order_by(Expense.created_at.desc()).all()
+            # One aggregate query: balance per expense with the open period pro-rated in SQL
+            # (only expenses still holding a balance on the report date if requested).
+            # Reruns reuse the cached result until data is written.
+            report_key = (report_date, tuple(sorted(filter_tags)), hide_finished)
+            generation = report_service.data_generation()
+            balances = report_service.cached('balance_report', report_key, lambda: report_service.balance_report(
+                db,
+                report_date,
+                tags=filter_tags,
+                expense_ids=expense_index.with_balance_on(report_date, db) if hide_finished else None
+            ), generation)
             
-            if not expenses:
+            if balances.empty:
                 st.info("📭 Không có dữ liệu.")
             else:
-                report_data = []
-                
-                # Simple progress text
-                # progress_bar = st.progress(0, text="Đang tính toán...")
-                
-                for idx, expense in enumerate(expenses):
-                    total_value = expense.total_amount + expense.already_allocated
-                    
-                    # Calculate Accumulated Allocation up to report_date
-                    accumulated_alloc = 0
-                    
-                    # 1. Historical Allocations
-                    accumulated_alloc += expense.already_allocated
-                    
-                    # 2. System Allocations
-                    for alloc in expense.allocations:
-                        if alloc.days_in_quarter == 0:
-                            continue
-                            
-                        # Logic for future allocations
-                        if alloc.end_date <= report_date:
-                            # Fully passed
-                            accumulated_alloc += alloc.amount
-                        elif alloc.start_date <= report_date:
-                            # Partially passed (Current Quarter)
-                            days_passed = (report_date - alloc.start_date).days + 1
-                            if days_passed > 0:
-                                # Pro-rata
-                                ratio = days_passed / alloc.days_in_quarter
-                                accumulated_alloc += round(alloc.amount * ratio)
-                    
-                    remaining_balance = total_value - accumulated_alloc
-                    
+                df_report = pd.DataFrame({
+                    "Tên khoản mục": balances['name'],
+                    "Tài khoản": balances['account_number'],
                     # Determine Short/Long based on sub_code
-                    term_type = "Ngắn hạn (9995)" if expense.sub_code == "9995" else "Dài hạn (9996)"
-                    
-                    report_data.append({
-                        "Tên khoản mục": expense.name,
-                        "Tài khoản": expense.account_number,
-                        "Ngắn/Dài hạn (Mã 999x)": term_type,
-                        "Tags": expense.tags or "(Không có)",
-                        "Mã Chứng từ": expense.document_code or "",
-                        "Tổng Gốc": int(round(total_value)),
-                        "Đã Phân Bổ (Lũy kế)": int(round(accumulated_alloc)),
-                        "Số Dư Cuối Kỳ": int(round(remaining_balance)),
-                        "Ghi chú": expense.note
-                    })
-                
-                df_report = pd.DataFrame(report_data)
+                    "Ngắn/Dài hạn (Mã 999x)": np.where(
+                        balances['sub_code'] == "9995", "Ngắn hạn (9995)", "Dài hạn (9996)"
+                    ),
+                    "Tags": balances['tags'].fillna("").replace("", "(Không có)"),
+                    "Mã Chứng từ": balances['document_code'].fillna(""),
+                    "Tổng Gốc": balances['total_value'],
+                    "Đã Phân Bổ (Lũy kế)": balances['accumulated'],
+                    "Số Dư Cuối Kỳ": balances['balance'],
+                    "Ghi chú": balances['note']
+                })
                 
-                # Ensure numeric columns and fill NA
+                # Money columns are whole đồng, so they are already int64
                 numeric_cols = ["Tổng Gốc", "Đã Phân Bổ (Lũy kế)", "Số Dư Cuối Kỳ"]
-                for col in numeric_cols:
-                    # Coerce and then cast to int to remove any .0
-                    df_report[col] = pd.to_numeric(df_report[col], errors='coerce').fillna(0).astype('int64')
                 
                 # Calculate Totals
                 total_row = {
@@ -886,15 +1081,18 @@ def page_allocation_schedule():
                             valid_group_by = [col for col in group_by if col in df_report.columns]
                             
                             if valid_group_by:
-                                pivot_df = df_report.groupby(valid_group_by)[numeric_cols].sum().reset_index()
+                                # Expenses count under each of their tags; subtotals per level and a grand total
+                                def build_pivot():
+                                    tags_long = None
+                                    if "Tags" in valid_group_by:
+                                        tags_long = report_service.cached(
+                                            'balance_tags', report_key, lambda: pivot_service.explode_tags(df_report, "Tags"), generation
+                                        )
+                                    return pivot_service.pivot(df_report, valid_group_by, numeric_cols, tag_column="Tags", exploded=tags_long)
                                 
-                                # Calculate Pivot Total
-                                pivot_total = {col: "" for col in pivot_df.columns}
-                                pivot_total[pivot_df.columns[0]] = "TỔNG CỘNG" # Set label on first group col
-                                for col in numeric_cols:
-                                    pivot_total[col] = pivot_df[col].sum()
-                                
-                                pivot_df = pd.concat([pivot_df, pd.DataFrame([pivot_total])], ignore_index=True)
+                                pivot_df = report_service.cached(
+                                    'balance_pivot', report_key + (tuple(valid_group_by),), build_pivot, generation
+                                )
                                 
                                 st.dataframe(
                                     pivot_df,
@@ -941,10 +1139,7 @@ def page_allocation_schedule():
                                      # Re-calc pivot for export to be safe
                                     valid_group_by = [col for col in group_by if col in df_report.columns]
                                     if valid_group_by:
-                                        p_exp = df_report.groupby(valid_group_by)[numeric_cols].sum().reset_index()
-                                        p_exp['Tổng Gốc'] = p_exp['Tổng Gốc'].astype('int64')
-                                        p_exp['Đã Phân Bổ (Lũy kế)'] = p_exp['Đã Phân Bổ (Lũy kế)'].astype('int64')
-                                        p_exp['Số Dư Cuối Kỳ'] = p_exp['Số Dư Cuối Kỳ'].astype('int64')
+                                        p_exp = pivot_service.pivot(df_report, valid_group_by, numeric_cols, tag_column="Tags")
                                         p_exp.to_excel(writer, sheet_name='Tong_Hop_Pivot', index=False)
                                  except:
                                      pass
@@ -967,9 +1162,11 @@ def page_allocation_schedule():
         with st.expander("⚙️ Bộ lọc dữ liệu", expanded=True):
             col_t2_1, col_t2_2, col_t2_3 = st.columns(3)
             with col_t2_1:
+                # Years and quarters follow the configured fiscal calendar
+                _, current_year = get_quarter(date.today())
                 year_filter = st.selectbox(
-                    "Chọn năm",
-                    options=["Tất cả"] + list(range(date.today().year - 2, date.today().year + 5)),
+                    "Chọn năm" if settings.fiscal_year_start_month == 1 else "Chọn năm tài chính",
+                    options=["Tất cả"] + list(range(current_year - 2, current_year + 5)),
                     key="year_filter_tab2"
                 )
             
@@ -988,88 +1185,93 @@ def page_allocation_schedule():
             st.session_state['report_generated_tab2'] = True
 
         if st.session_state.get('report_generated_tab2'):
-            # Get all allocations
-            alloc_query = db.query(Allocation).join(Expense)
+            year_value = year_filter if year_filter != "Tất cả" else None
+            quarter_num = int(quarter_filter[1]) if quarter_filter != "Tất cả" else None
             
-            # Apply Filters
-            if year_filter != "Tất cả":
-                alloc_query = alloc_query.filter(Allocation.year == year_filter)
-            
-            if quarter_filter != "Tất cả":
-                quarter_num = int(quarter_filter[1])
-                alloc_query = alloc_query.filter(Allocation.quarter == quarter_num)
+            def load_detail():
+                # Limit to expenses overlapping the selected year/quarter (historical rows are kept)
+                expense_ids = None
+                if year_value is not None:
+                    if quarter_num is not None:
+                        range_start, range_end = get_quarter_dates(quarter_num, year_value)
+                    else:
+                        range_start, range_end = get_quarter_dates(1, year_value)[0], get_quarter_dates(4, year_value)[1]
+                    expense_ids = expense_index.overlapping(range_start, range_end, db)
                 
-            # Also filter by tags if needed? User didn't explicitly ask, but consistency is good.
-            # But let's stick to "Restore old view" exactly. Old view didn't have tag filter.
-            
-            # Deterministic Sort - Chronological (Ascending) for intuitive Running Totals
-            alloc_query = alloc_query.order_by(Allocation.year.asc(), Allocation.quarter.asc(), Expense.created_at.desc())
+                # Rows in chronological order with running totals from one windowed query
+                return report_service.allocation_detail(db, year_value, quarter_num, expense_ids, keep_historical=True)
             
-            allocations = alloc_query.all()
+            # Reruns reuse the cached result until data is written
+            detail = report_service.cached(
+                'allocation_detail', (year_value, quarter_num, settings.fiscal_year_start_month), load_detail
+            )
             
-            if not allocations:
+            if detail.empty:
                 st.info("📭 Không có dữ liệu phân bổ cho giai đoạn này.")
             else:
-                # Create summary table (Old Logic)
-                summary_data = []
-                
-                # Pre-calculate data for efficiency if needed, but per-row calculation is safer for correctness with filters
-                for alloc in allocations:
-                    # Calculate Running Totals for this specific expense up to this allocation
-                    exp = alloc.expense
-                    total_exp_val = exp.total_amount + exp.already_allocated
-                    
-                    # Get all allocations for this expense sequentially (Chronological)
-                    # Note: This might be N+1 lazy loading. For small/medium datasets it's OK.
-                    # Optimization: Sort allocations in python
-                    exp_allocs = sorted(exp.allocations, key=lambda x: (x.year, x.quarter))
-                    
-                    current_accumulated = exp.already_allocated
-                    for a in exp_allocs:
-                        a_amount = int(round(a.amount))
-                        
-                        # IMPORTANT: Skip adding if dummy entry (days=0)
-                        if a.days_in_quarter > 0:
-                            current_accumulated += a_amount
-                            
-                        if a.id == alloc.id:
-                            break
-                    
-                    current_remaining = total_exp_val - current_accumulated
-
-                    # Format Quarter: Just "Qx" or "QK"
-                    q_str = f"Q{alloc.quarter}" if alloc.quarter > 0 else "QK"
-                    
-                    # Format Year: Convert to string to avoid commas
-                    y_str = str(alloc.year) if alloc.year > 0 else ""
-
-                    summary_data.append({
-                        'Khoản mục': alloc.expense.name,
-                        'Số TK': alloc.expense.account_number,
-                        'Mã phụ': alloc.expense.sub_code,
-                        'Quý': q_str,
-                        'Năm': y_str,
-                        'Ngày BĐ': alloc.start_date.strftime("%d/%m/%Y"),
-                        'Ngày KT': alloc.end_date.strftime("%d/%m/%Y"),
-                        'Số ngày': alloc.days_in_quarter,
-                        'Số tiền': int(round(alloc.amount)), # Force Int
-                        'Lũy kế đã PB': int(current_accumulated),
-                        'Còn lại chưa PB': int(current_remaining),
-                        'Tags': alloc.expense.tags
-                    })
+                # Quarter: just "Qx" or "QK"; period within the year for monthly/yearly schedules
+                quarter_labels = ["QK" if q <= 0 else f"Q{q}" for q in detail['quarter']]
+                period_labels = [
+                    f"T{calendar_month(int(p), y)[0]}" if t == 'month' else "Cả năm" if t == 'year' else q_str
+                    for t, p, y, q_str in zip(detail['period_type'], detail['period'], detail['year'], quarter_labels)
+                ]
                 
-                df_sched = pd.DataFrame(summary_data)
+                df_sched = pd.DataFrame({
+                    'Khoản mục': detail['name'],
+                    'Số TK': detail['account_number'],
+                    'Mã phụ': detail['sub_code'],
+                    'Quý': quarter_labels,
+                    'Kỳ': period_labels,
+                    'Năm': [str(y) if y > 0 else "" for y in detail['year']],
+                    'Ngày BĐ': pd.to_datetime(detail['start_date']).dt.strftime("%d/%m/%Y"),
+                    'Ngày KT': pd.to_datetime(detail['end_date']).dt.strftime("%d/%m/%Y"),
+                    'Số ngày': detail['days_in_quarter'],
+                    'Số tiền': detail['amount'],
+                    'Lũy kế đã PB': detail['accumulated'],
+                    'Còn lại chưa PB': detail['remaining'],
+                    'Tags': detail['tags']
+                })
                 
                 # Display summary metrics
                 c1, c2, c3 = st.columns(3)
                 with c1:
-                    st.metric("Tổng số khoản mục", len(set(a.expense_id for a in allocations)))
+                    st.metric("Tổng số khoản mục", detail['expense_id'].nunique())
                 with c2:
-                    st.metric("Tổng số dòng phân bổ", len(allocations))
+                    st.metric("Tổng số dòng phân bổ", len(detail))
                 with c3:
-                    total_amount = sum(a.amount for a in allocations)
+                    total_amount = int(detail['amount'].sum())
                     # Use helper or default format
-                    st.metric("Tổng tiền phân bổ (View này)", f"{int(total_amount):,}")
+                    st.metric("Tổng tiền phân bổ (View này)", f"{total_amount:,}")
+                
+                # Quarter totals by account from the summary table (system rows only)
+                pivot = allocation_totals.quarter_pivot(db, year_value, quarter_num)
+                if not pivot.empty:
+                    st.markdown("##### 🧮 Tổng hợp theo Tài khoản / Mã phụ")
+                    pivot["Tổng cộng"] = pivot.sum(axis=1)
+                    st.dataframe(
+                        pivot.reset_index().rename(columns={'account_number': 'Số TK', 'sub_code': 'Mã phụ'}),
+                        use_container_width=True,
+                        hide_index=True,
+                        column_config={col: st.column_config.NumberColumn(format=None) for col in pivot.columns}
+                    )
+                
+                # Pivot of the rows in view; periods keep chronological order, tags count under each tag
+                pivot_levels = st.multiselect(
+                    "Nhóm theo (Pivot Levels):",
+                    options=["Kỳ phân bổ", "Số TK", "Mã phụ", "Tags"],
+                    key="pivot_levels_tab2"
+                )
+                if pivot_levels:
+                    period_names = [f"{p}/{y}" if y else p for p, y in zip(df_sched['Kỳ'], df_sched['Năm'])]
+                    pivot_input = df_sched.assign(**{
+                        "Kỳ phân bổ": pd.Categorical(period_names, categories=pd.unique(pd.Series(period_names)), ordered=True)
+                    })
+                    st.dataframe(
+                        pivot_service.pivot(pivot_input, pivot_levels, ["Số tiền"], tag_column="Tags"),
+                        use_container_width=True,
+                        hide_index=True,
+                        column_config={"Số tiền": st.column_config.NumberColumn(format=None)}
+                    )
                 
                 # Display table
                 st.dataframe(
@@ -1099,6 +1301,425 @@ def page_allocation_schedule():
         else:
              st.info("👈 Vui lòng nhấn nút **'🚀 Tổng hợp số liệu'** để xem.")
 
+    # --- TAB 3: AMORTIZATION PROJECTION ---
+    with tab3:
+        st.markdown("### 🔮 Dự báo chi phí phân bổ vào P&L theo kỳ")
+        
+        group_options = {
+            "Toàn danh mục": None,
+            "Tài khoản": "account_number",
+            "Mã phụ": "sub_code",
+            "Tags": "tag"
+        }
+        
+        with st.expander("⚙️ Cấu hình dự báo", expanded=True):
+            col_p1, col_p2, col_p3, col_p4 = st.columns(4)
+            with col_p1:
+                projection_from = st.date_input(
+                    "Từ ngày", value=date.today(), format="DD/MM/YYYY", key="projection_from"
+                )
+            with col_p2:
+                projection_years = st.number_input(
+                    "Số năm dự báo", min_value=1, max_value=30,
+                    value=settings.projection_years, step=1, key="projection_years"
+                )
+            with col_p3:
+                projection_period = st.selectbox(
+                    "Kỳ", options=list(PERIOD_LABELS.keys()),
+                    format_func=lambda p: PERIOD_LABELS[p], index=1, key="projection_period"
+                )
+            with col_p4:
+                projection_group = st.selectbox(
+                    "Nhóm theo", options=list(group_options.keys()), key="projection_group"
+                )
+            
+            run_projection = st.button("🚀 Chạy dự báo", type="primary", key="btn_run_projection")
+        
+        if run_projection:
+            st.session_state['report_generated_tab3'] = True
+        
+        if st.session_state.get('report_generated_tab3'):
+            expenses = db.query(Expense).all()
+            
+            if not expenses:
+                st.info("📭 Không có dữ liệu.")
+            else:
+                projection = projection_service.project_expenses(
+                    expenses,
+                    projection_from,
+                    int(projection_years),
+                    projection_period,
+                    group_options[projection_group]
+                )
+                
+                if group_options[projection_group] == "tag":
+                    # Tag groups overlap, so the total row comes from an ungrouped projection
+                    portfolio = projection_service.project_expenses(
+                        expenses, projection_from, int(projection_years), projection_period
+                    )
+                    df_pivot = projection_service.to_pivot(projection, portfolio)
+                    st.caption("💡 Khoản mục có nhiều tag được tính vào từng tag; dòng tổng cộng tính mỗi khoản một lần.")
+                else:
+                    df_pivot = projection_service.to_pivot(projection)
+                
+                # Portfolio total per period (chronological)
+                period_totals = df_pivot.loc['TỔNG CỘNG'].drop('Tổng')
+                
+                c1, c2 = st.columns(2)
+                with c1:
+                    st.metric("Tổng phân bổ dự kiến", f"{int(period_totals.sum()):,}")
+                with c2:
+                    st.metric("Số kỳ", len(period_totals))
+                
+                st.bar_chart(period_totals)
+                
+                st.dataframe(
+                    df_pivot.reset_index(names=projection_group),
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={
+                        col: st.column_config.NumberColumn(format=None) for col in df_pivot.columns
+                    }
+                )
+                
+                if st.button("📥 Xuất Dự báo Excel", key="btn_export_tab3"):
+                    import io
+                    buffer = io.BytesIO()
+                    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+                        df_pivot.reset_index(names=projection_group).to_excel(
+                            writer, sheet_name='Du_Bao_Tong_Hop', index=False
+                        )
+                        projection.to_excel(writer, sheet_name='Du_Bao_Chi_Tiet', index=False)
+                    
+                    st.download_button(
+                        label="⬇️ Tải file Excel",
+                        data=buffer.getvalue(),
+                        file_name=f"du_bao_phan_bo_{projection_from.strftime('%Y%m%d')}.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        key="dl_projection"
+                    )
+        else:
+            st.info("👈 Vui lòng nhấn nút **'🚀 Chạy dự báo'** để xem.")
+
+    # --- TAB 4: WHAT-IF SIMULATION ---
+    with tab4:
+        st.markdown("### 🧪 Mô phỏng thay đổi ngày kết thúc / số tiền")
+        st.caption("Chỉ tính toán trên bản sao trong bộ nhớ, không ghi vào cơ sở dữ liệu. "
+                   "Thay đổi có hiệu lực từ đầu kỳ chứa ngày bắt đầu mô phỏng.")
+        
+        with st.expander("⚙️ Cấu hình kịch bản", expanded=True):
+            sim_tags = tag_index.tag_names(db)
+            sim_accounts = sorted({a for (a,) in db.query(Expense.account_number).distinct().all()})
+            
+            col_s1, col_s2 = st.columns(2)
+            with col_s1:
+                simulation_tags = st.multiselect("Áp dụng cho Tags", options=sim_tags, key="simulation_tags")
+            with col_s2:
+                simulation_accounts = st.multiselect("Áp dụng cho Tài khoản", options=sim_accounts, key="simulation_accounts")
+            
+            col_s3, col_s4, col_s5, col_s6 = st.columns(4)
+            with col_s3:
+                simulation_shift = st.number_input(
+                    "Dời ngày kết thúc (tháng)", min_value=-120, max_value=120, value=0, step=1,
+                    help="Số âm: kết thúc sớm hơn", key="simulation_shift"
+                )
+            with col_s4:
+                simulation_pct = st.number_input(
+                    "Thay đổi số tiền (%)", min_value=-100.0, max_value=1000.0, value=0.0, step=5.0,
+                    key="simulation_pct"
+                )
+            with col_s5:
+                simulation_from = st.date_input(
+                    "Từ ngày", value=date.today(), format="DD/MM/YYYY", key="simulation_from"
+                )
+            with col_s6:
+                simulation_years = st.number_input(
+                    "Số năm", min_value=1, max_value=30, value=settings.projection_years, step=1,
+                    key="simulation_years"
+                )
+            
+            run_simulation = st.button("🚀 Chạy mô phỏng", type="primary", key="btn_run_simulation")
+        
+        if run_simulation:
+            st.session_state['report_generated_tab4'] = True
+        
+        if st.session_state.get('report_generated_tab4'):
+            expenses = db.query(Expense).all()
+            
+            if not expenses:
+                st.info("📭 Không có dữ liệu.")
+            else:
+                affected = simulation_service.select_expenses(expenses, simulation_tags, simulation_accounts)
+                simulation = simulation_service.simulate_expenses(
+                    expenses,
+                    simulation_from,
+                    int(simulation_years),
+                    tags=simulation_tags,
+                    accounts=simulation_accounts,
+                    end_shift_months=int(simulation_shift),
+                    amount_change_pct=float(simulation_pct)
+                )
+                
+                c1, c2, c3 = st.columns(3)
+                with c1:
+                    st.metric("Số khoản mục áp dụng", f"{int(affected.sum()):,}")
+                with c2:
+                    st.metric("Tổng phân bổ hiện tại", f"{int(simulation['baseline'].sum()):,}")
+                with c3:
+                    st.metric(
+                        "Tổng phân bổ theo kịch bản", f"{int(simulation['scenario'].sum()):,}",
+                        delta=f"{int(simulation['delta'].sum()):,}"
+                    )
+                
+                st.bar_chart(simulation.set_index('period_label')[['delta']])
+                
+                df_simulation = simulation[['period_label', 'baseline', 'scenario', 'delta']].rename(columns={
+                    'period_label': 'Kỳ',
+                    'baseline': 'Hiện tại',
+                    'scenario': 'Kịch bản',
+                    'delta': 'Chênh lệch'
+                })
+                st.dataframe(
+                    df_simulation,
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={
+                        col: st.column_config.NumberColumn(format=None)
+                        for col in ['Hiện tại', 'Kịch bản', 'Chênh lệch']
+                    }
+                )
+        else:
+            st.info("👈 Vui lòng nhấn nút **'🚀 Chạy mô phỏng'** để xem.")
+
+    # --- TAB 5: ROLL-FORWARD ---
+    with tab5:
+        st.markdown("### 🔄 Bảng biến động chi phí trả trước (Đầu kỳ - Tăng - Phân bổ - Cuối kỳ)")
+        
+        rollforward_periods = {None: "Cả khoảng thời gian", **PERIOD_LABELS}
+        rollforward_levels = {"Tài khoản": "account_number", "Mã phụ": "sub_code"}
+        
+        with st.expander("⚙️ Cấu hình báo cáo", expanded=True):
+            col_r1, col_r2, col_r3, col_r4 = st.columns(4)
+            with col_r1:
+                rollforward_from = st.date_input(
+                    "Từ ngày", value=date(date.today().year, 1, 1), format="DD/MM/YYYY", key="rollforward_from"
+                )
+            with col_r2:
+                rollforward_to = st.date_input(
+                    "Đến ngày", value=date.today(), format="DD/MM/YYYY", key="rollforward_to"
+                )
+            with col_r3:
+                rollforward_period = st.selectbox(
+                    "Chia theo kỳ", options=list(rollforward_periods.keys()),
+                    format_func=lambda p: rollforward_periods[p], key="rollforward_period"
+                )
+            with col_r4:
+                rollforward_group = st.multiselect(
+                    "Nhóm theo (Pivot Levels):", options=list(rollforward_levels.keys()),
+                    default=list(rollforward_levels.keys()), key="rollforward_group"
+                )
+            
+            run_rollforward = st.button("🚀 Tạo bảng biến động", type="primary", key="btn_run_rollforward")
+        
+        if run_rollforward:
+            st.session_state['report_generated_tab5'] = True
+        
+        if st.session_state.get('report_generated_tab5'):
+            if rollforward_to < rollforward_from:
+                st.error("❌ Ngày kết thúc phải sau ngày bắt đầu")
+            else:
+                # One aggregate query over expenses and allocations, cached until data is written
+                rollforward = report_service.cached(
+                    'roll_forward',
+                    (rollforward_from, rollforward_to, rollforward_period, settings.fiscal_year_start_month),
+                    lambda: report_service.roll_forward(db, rollforward_from, rollforward_to, rollforward_period)
+                )
+                
+                if rollforward.empty:
+                    st.info("📭 Không có dữ liệu.")
+                else:
+                    value_cols = {
+                        'opening': "Số dư đầu kỳ",
+                        'additions': "Tăng trong kỳ",
+                        'amortization': "Phân bổ trong kỳ",
+                        'closing': "Số dư cuối kỳ"
+                    }
+                    df_rollforward = rollforward.rename(columns={
+                        'period_label': "Kỳ", 'start_date': "Từ ngày", 'end_date': "Đến ngày",
+                        'account_number': "Tài khoản", 'sub_code': "Mã phụ", **value_cols
+                    })
+                    df_rollforward["Kỳ"] = pd.Categorical(
+                        df_rollforward["Kỳ"], categories=list(dict.fromkeys(df_rollforward["Kỳ"])), ordered=True
+                    )
+                    money_cols = list(value_cols.values())
+                    
+                    first_period = df_rollforward["Kỳ"] == df_rollforward["Kỳ"].cat.categories[0]
+                    last_period = df_rollforward["Kỳ"] == df_rollforward["Kỳ"].cat.categories[-1]
+                    c1, c2, c3, c4 = st.columns(4)
+                    with c1:
+                        st.metric("Số dư đầu kỳ", f"{int(df_rollforward.loc[first_period, 'Số dư đầu kỳ'].sum()):,}")
+                    with c2:
+                        st.metric("Tăng trong kỳ", f"{int(df_rollforward['Tăng trong kỳ'].sum()):,}")
+                    with c3:
+                        st.metric("Phân bổ trong kỳ", f"{int(df_rollforward['Phân bổ trong kỳ'].sum()):,}")
+                    with c4:
+                        st.metric("Số dư cuối kỳ", f"{int(df_rollforward.loc[last_period, 'Số dư cuối kỳ'].sum()):,}")
+                    
+                    # Periods stay the outer level: balances only add up within a period
+                    df_pivot = pivot_service.pivot(
+                        df_rollforward, ["Kỳ"] + [level for level in rollforward_levels if level in rollforward_group], money_cols
+                    )
+                    grand_total = df_pivot.index[-1]
+                    df_pivot.loc[grand_total, "Số dư đầu kỳ"] = df_rollforward.loc[first_period, "Số dư đầu kỳ"].sum()
+                    df_pivot.loc[grand_total, "Số dư cuối kỳ"] = df_rollforward.loc[last_period, "Số dư cuối kỳ"].sum()
+                    
+                    st.dataframe(
+                        df_pivot,
+                        use_container_width=True,
+                        hide_index=True,
+                        column_config={col: st.column_config.NumberColumn(format=None) for col in money_cols},
+                        height=500
+                    )
+                    
+                    if st.button("📥 Xuất Biến động Excel", key="btn_export_tab5"):
+                        import io
+                        buffer = io.BytesIO()
+                        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+                            df_pivot.to_excel(writer, sheet_name='Bien_Dong_Tong_Hop', index=False)
+                            df_rollforward.to_excel(writer, sheet_name='Bien_Dong_Chi_Tiet', index=False)
+                        
+                        st.download_button(
+                            label="⬇️ Tải file Excel",
+                            data=buffer.getvalue(),
+                            file_name=f"bien_dong_tk242_{rollforward_from.strftime('%Y%m%d')}_{rollforward_to.strftime('%Y%m%d')}.xlsx",
+                            mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                            key="dl_rollforward"
+                        )
+        else:
+            st.info("👈 Vui lòng nhấn nút **'🚀 Tạo bảng biến động'** để xem.")
+
+    # --- TAB 6: CURRENT / NON-CURRENT & MATURITY ---
+    with tab6:
+        st.markdown("### ⏳ Phân loại ngắn hạn / dài hạn và kỳ hạn còn lại của số dư")
+        st.caption(
+            f"Phần số dư sẽ phân bổ trong {CURRENT_MONTHS} tháng tới là ngắn hạn, phần còn lại là dài hạn, "
+            "không phụ thuộc mã phụ 9995/9996 đặt lúc tạo."
+        )
+        
+        maturity_levels = ["Tài khoản", "Mã phụ", "Kỳ hạn còn lại", "Tags"]
+        with st.expander("⚙️ Cấu hình báo cáo", expanded=True):
+            col_m1, col_m2 = st.columns(2)
+            with col_m1:
+                maturity_date = st.date_input(
+                    "Ngày báo cáo", value=date.today(), format="DD/MM/YYYY", key="maturity_date"
+                )
+            with col_m2:
+                maturity_group = st.multiselect(
+                    "Nhóm theo (Pivot Levels):", options=maturity_levels,
+                    default=["Tài khoản", "Mã phụ"], key="maturity_group"
+                )
+            
+            run_maturity = st.button("🚀 Tạo báo cáo", type="primary", key="btn_run_maturity")
+        
+        if run_maturity:
+            st.session_state['report_generated_tab6'] = True
+        
+        if st.session_state.get('report_generated_tab6'):
+            # One query for balances and the next-12-month amortization, cached until data is written
+            generation = report_service.data_generation()
+            maturity = report_service.cached(
+                'maturity_report', (maturity_date,), lambda: report_service.maturity_report(db, maturity_date), generation
+            )
+            
+            if maturity.empty:
+                st.info("📭 Không có dữ liệu.")
+            else:
+                money_cols = ["Số dư", f"Ngắn hạn (≤ {CURRENT_MONTHS} tháng)", f"Dài hạn (> {CURRENT_MONTHS} tháng)"]
+                df_maturity = pd.DataFrame({
+                    "Tên khoản mục": maturity['name'],
+                    "Tài khoản": maturity['account_number'],
+                    "Mã phụ": maturity['sub_code'],
+                    "Tags": maturity['tags'].fillna("").replace("", "(Không có)"),
+                    "Mã Chứng từ": maturity['document_code'].fillna(""),
+                    "Ngày kết thúc": pd.to_datetime(maturity['end_date']).dt.strftime("%d/%m/%Y"),
+                    "Số tháng còn lại": maturity['months_to_maturity'],
+                    "Kỳ hạn còn lại": maturity['maturity_bucket'],
+                    money_cols[0]: maturity['balance'],
+                    money_cols[1]: maturity['current'],
+                    money_cols[2]: maturity['non_current']
+                })
+                
+                reclassified = int(maturity.loc[maturity['sub_code'] == "9996", 'current'].sum())
+                c1, c2, c3, c4 = st.columns(4)
+                with c1:
+                    st.metric("Số dư", f"{int(df_maturity[money_cols[0]].sum()):,}")
+                with c2:
+                    st.metric(money_cols[1], f"{int(df_maturity[money_cols[1]].sum()):,}")
+                with c3:
+                    st.metric(money_cols[2], f"{int(df_maturity[money_cols[2]].sum()):,}")
+                with c4:
+                    st.metric("Mã 9996 chuyển ngắn hạn", f"{reclassified:,}")
+                
+                if maturity_group:
+                    def build_maturity_pivot():
+                        tags_long = None
+                        if "Tags" in maturity_group:
+                            tags_long = pivot_service.explode_tags(df_maturity, "Tags")
+                        return pivot_service.pivot(
+                            df_maturity, maturity_group, money_cols, tag_column="Tags", exploded=tags_long
+                        )
+                    
+                    df_pivot = report_service.cached(
+                        'maturity_pivot', (maturity_date, tuple(maturity_group)), build_maturity_pivot, generation
+                    )
+                    st.markdown("##### 🧬 Tổng hợp")
+                    st.dataframe(
+                        df_pivot,
+                        use_container_width=True,
+                        hide_index=True,
+                        column_config={col: st.column_config.NumberColumn(format=None) for col in money_cols},
+                        height=400
+                    )
+                else:
+                    df_pivot = None
+                
+                # Aging by months to maturity, shortest first
+                df_aging = pivot_service.pivot(df_maturity, ["Kỳ hạn còn lại"], money_cols, subtotals=False)
+                st.markdown("##### 📆 Số dư theo kỳ hạn còn lại")
+                st.dataframe(
+                    df_aging,
+                    use_container_width=True,
+                    hide_index=True,
+                    column_config={col: st.column_config.NumberColumn(format=None) for col in money_cols}
+                )
+                
+                with st.expander("📄 Chi tiết từng khoản"):
+                    st.dataframe(
+                        df_maturity,
+                        use_container_width=True,
+                        hide_index=True,
+                        column_config={col: st.column_config.NumberColumn(format=None) for col in money_cols}
+                    )
+                
+                if st.button("📥 Xuất Ngắn/Dài hạn Excel", key="btn_export_tab6"):
+                    import io
+                    buffer = io.BytesIO()
+                    with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+                        if df_pivot is not None:
+                            df_pivot.to_excel(writer, sheet_name='Ngan_Dai_Han_Tong_Hop', index=False)
+                        df_aging.to_excel(writer, sheet_name='Ky_Han_Con_Lai', index=False)
+                        df_maturity.to_excel(writer, sheet_name='Ngan_Dai_Han_Chi_Tiet', index=False)
+                    
+                    st.download_button(
+                        label="⬇️ Tải file Excel",
+                        data=buffer.getvalue(),
+                        file_name=f"ngan_dai_han_{maturity_date.strftime('%Y%m%d')}.xlsx",
+                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                        key="dl_maturity"
+                    )
+        else:
+            st.info("👈 Vui lòng nhấn nút **'🚀 Tạo báo cáo'** để xem.")
+
     db.close()
 
 
@@ -1277,6 +1898,17 @@ def page_settings():
                                     db_path = settings.database_url.replace("sqlite:///", "")
                                     
                                     if drive_service.download_file(file_id, db_path):
+                                        expense_index.invalidate()
+                                        report_service.bump_generation()
+                                        init_db()
+                                        restored_db = SessionLocal()
+                                        try:
+                                            fiscal_year.load(restored_db)
+                                            allocation_totals.rebuild(restored_db)
+                                            tag_index.rebuild(restored_db)
+                                            search_service.rebuild(restored_db)
+                                        finally:
+                                            restored_db.close()
                                         st.success(f"✅ Đã khôi phục thành công bản backup: {selected_backup['display']}")
                                         st.session_state['show_restore_confirm'] = False
                                         st.info("Hệ thống sẽ tự tải lại trong giây lát...")
@@ -1323,54 +1955,152 @@ GOOGLE_CLIENT_SECRETS_JSON = '''
 DATABASE_URL="sqlite:///./data/expenses.db"
     """, language="toml")
     
+    st.markdown("---")
+    st.markdown("### 📆 Năm tài chính")
+    
+    month_options = list(range(1, 13))
+    fiscal_start = st.selectbox(
+        "Tháng bắt đầu năm tài chính",
+        options=month_options,
+        index=month_options.index(settings.fiscal_year_start_month),
+        format_func=lambda m: f"Tháng {m}" + (" (năm dương lịch)" if m == 1 else ""),
+        key="fiscal_year_start_month"
+    )
+    if fiscal_start != settings.fiscal_year_start_month:
+        # Saved with the data; stored periods are re-labelled so filters and totals follow the new calendar
+        db = SessionLocal()
+        try:
+            with st.spinner("Đang gán lại kỳ phân bổ theo năm tài chính mới..."):
+                relabelled = fiscal_year.set_start_month(db, fiscal_start)
+        finally:
+            db.close()
+        st.toast(f"✅ Năm tài chính bắt đầu từ tháng {fiscal_start} ({relabelled} kỳ phân bổ được gán lại)", icon="✅")
+    q_start, q_end = get_quarter_dates(*get_quarter(date.today()))
+    st.caption(
+        f"Quý hiện tại: {format_quarter(*get_quarter(date.today()))} "
+        f"({q_start.strftime('%d/%m/%Y')} - {q_end.strftime('%d/%m/%Y')}). "
+        "Số tiền và ngày của các kỳ đã lưu được giữ nguyên; năm/quý của từng kỳ được gán lại theo lịch mới."
+    )
+    
+    st.markdown("---")
+    st.markdown("### 🔐 Khóa sổ kỳ kế toán")
+    st.caption(
+        "Khóa sổ lưu số dư cuối quý của từng khoản; báo cáo sau đó tính tiếp từ số dư đã lưu. "
+        "Số liệu phát sinh đến ngày khóa sổ không thể thêm, sửa hoặc xóa."
+    )
+    db = SessionLocal()
+    try:
+        locked = period_close.locked_through(db)
+        # Ended quarters after the last close, latest first
+        candidates = []
+        day = get_quarter_dates(*get_quarter(date.today()))[0] - timedelta(days=1)
+        while len(candidates) < 8 and (locked is None or day > locked):
+            candidates.append(get_quarter(day))
+            day = get_quarter_dates(*candidates[-1])[0] - timedelta(days=1)
+        
+        cl1, cl2 = st.columns(2)
+        with cl1:
+            if candidates:
+                to_close = st.selectbox(
+                    "Quý cần khóa sổ", candidates, format_func=lambda q: format_quarter(*q), key="close_quarter"
+                )
+                if st.button("🔐 Khóa sổ", key="btn_close_quarter", type="primary"):
+                    try:
+                        closed = period_close.close_quarter(db, to_close[1], to_close[0])
+                        st.toast(
+                            f"✅ Đã khóa sổ {format_quarter(*to_close)}: {closed.expense_count} khoản, "
+                            f"số dư {format_currency(closed.closing_balance)}",
+                            icon="✅"
+                        )
+                        st.rerun()
+                    except ValueError as e:
+                        st.error(f"❌ {str(e)}")
+            else:
+                st.info("Không có quý nào cần khóa sổ.")
+        with cl2:
+            if locked is not None:
+                st.markdown(f"**Đã khóa sổ đến:** {locked.strftime('%d/%m/%Y')}")
+                if st.button("🔓 Mở khóa quý gần nhất", key="btn_reopen_quarter"):
+                    period_close.reopen_latest(db)
+                    st.toast("✅ Đã mở khóa quý gần nhất", icon="✅")
+                    st.rerun()
+        
+        closes = period_close.closes(db)
+        if not closes.empty:
+            st.dataframe(
+                pd.DataFrame({
+                    "Kỳ": [format_quarter(q, y) for q, y in zip(closes['quarter'], closes['year'])],
+                    "Ngày khóa sổ": pd.to_datetime(closes['close_date']).dt.strftime("%d/%m/%Y"),
+                    "Số khoản": closes['expense_count'],
+                    "Số dư cuối kỳ": closes['closing_balance'],
+                    "Thời điểm khóa": pd.to_datetime(closes['closed_at']).dt.strftime("%d/%m/%Y %H:%M")
+                }),
+                use_container_width=True,
+                hide_index=True,
+                column_config={"Số dư cuối kỳ": st.column_config.NumberColumn(format=None)}
+            )
+    finally:
+        db.close()
+    
     st.markdown("---")
     st.markdown("### 📊 Thông tin ứng dụng")
     st.info(f"**Phiên bản:** 1.0.0\n\n**Database:** {settings.database_url}")
+    
+    cache_info = allocation_service.schedule_cache_info()
+    st.caption(
+        f"Bộ nhớ đệm kế hoạch phân bổ: {cache_info['size']}/{cache_info['maxsize']} kế hoạch | "
+        f"Hit: {cache_info['hits']} | Miss: {cache_info['misses']}"
+    )
+    report_cache_info = report_service.result_cache_info()
+    st.caption(
+        f"Bộ nhớ đệm báo cáo: {report_cache_info['size']}/{report_cache_info['maxsize']} kết quả | "
+        f"Hit: {report_cache_info['hits']} | Miss: {report_cache_info['misses']} | "
+        f"Thế hệ dữ liệu: {report_service.data_generation()}"
+    )
+    
+    # Repair the per-period summary table if it ever drifts from the allocations
+    if st.button("🔁 Tính lại bảng tổng hợp phân bổ", key="btn_rebuild_totals"):
+        db = SessionLocal()
+        try:
+            rebuilt_rows = allocation_totals.rebuild(db)
+        finally:
+            db.close()
+        st.success(f"✅ Đã tính lại bảng tổng hợp: {rebuilt_rows} dòng")
 
 
-def display_allocation_table(allocations: list, total_amount: float):
+def display_allocation_table(schedule: AllocationSchedule, total_amount: int):
     """Display allocation table with formatting and cumulative balance."""
-    df_data = []
-    cumulative_allocated = 0
+    df = schedule.to_dataframe(include_dates=True)
+    cumulative = schedule.cumulative()
     
-    for alloc in allocations:
-        if alloc['total_days'] > 0 and alloc['days_in_quarter'] > 0:
-            percentage = (alloc['days_in_quarter'] / alloc['total_days']) * 100
-            percentage_str = f"{percentage:.2f}%"
-        else:
-            percentage_str = "H.T (Quá khứ)"
-            
-        cumulative_allocated += alloc['amount']
-        remaining_balance = total_amount - cumulative_allocated
-        
-        df_data.append({
-            'Quý': format_quarter(alloc['quarter'], alloc['year']),
-            'Ngày BĐ': alloc['start_date'].strftime("%d/%m/%Y") if alloc['days_in_quarter'] > 0 else "N/A",
-            'Ngày KT': alloc['end_date'].strftime("%d/%m/%Y") if alloc['days_in_quarter'] > 0 else "N/A",
-            'Số ngày': alloc['days_in_quarter'],
-            'Tỷ lệ (%)': percentage_str,
-            'Số tiền': format_currency(alloc['amount']),
-            'Lũy kế phân bổ': format_currency(cumulative_allocated),
-            'Còn lại': format_currency(remaining_balance)
-        })
+    table = pd.DataFrame({
+        'Kỳ': schedule.labels(),
+        'Ngày BĐ': df['start_date'].dt.strftime("%d/%m/%Y"),
+        'Ngày KT': df['end_date'].dt.strftime("%d/%m/%Y"),
+        'Số ngày': df['days_in_quarter'],
+        'Tỷ lệ (%)': [f"{p:.2f}%" for p in schedule.percentages()],
+        'Số tiền': [format_currency(a) for a in df['amount']],
+        'Lũy kế phân bổ': [format_currency(c) for c in cumulative],
+        'Còn lại': [format_currency(total_amount - c) for c in cumulative]
+    })
     
     # Add total row
-    df_data.append({
-        'Quý': '**TỔNG CỘNG**',
+    summary = schedule.summary()
+    table.loc[len(table)] = {
+        'Kỳ': '**TỔNG CỘNG**',
         'Ngày BĐ': '',
         'Ngày KT': '',
-        'Số ngày': sum(a['days_in_quarter'] for a in allocations),
+        'Số ngày': summary['total_days'],
         'Tỷ lệ (%)': '100.00%',
-        'Số tiền': format_currency(sum(a['amount'] for a in allocations)),
+        'Số tiền': format_currency(summary['total_allocated']),
         'Lũy kế phân bổ': format_currency(total_amount),
         'Còn lại': format_currency(0)
-    })
+    }
     
-    df = pd.DataFrame(df_data)
-    st.dataframe(df, use_container_width=True, hide_index=True)
+    st.dataframe(table, use_container_width=True, hide_index=True)
 
 
-def export_expense_to_excel(expense: Expense, allocations: list):
+def export_expense_to_excel(expense: Expense, allocations: AllocationSchedule):
     """Export single expense to Excel."""
     expense_data = {
         'account_number': expense.account_number,
@@ -1407,6 +2137,8 @@ def export_all_to_excel(db: Session):
         alloc_data = []
         for alloc in expense.allocations:
             alloc_data.append({
+                'period_type': alloc.period_type,
+                'period': alloc.period,
                 'quarter': alloc.quarter,
                 'year': alloc.year,
                 'amount': alloc.amount,
@@ -36,6 +36,55 @@ class Settings(BaseSettings):
         description="Target Google Drive folder ID for uploads"
     )
     
+    # Calendar Configuration
+    calendar_first_year: int = Field(
+        default=2000,
+        description="First year covered by the precomputed quarter calendar"
+    )
+    calendar_last_year: int = Field(
+        default=2100,
+        description="Last year covered by the precomputed quarter calendar"
+    )
+    fiscal_year_start_month: int = Field(
+        default=1,
+        ge=1,
+        le=12,
+        description="First month of the fiscal year (1 = calendar year, 4 = April, 7 = July)"
+    )
+
+    # Allocation Engine
+    schedule_cache_size: int = Field(
+        default=4096,
+        description="Maximum number of allocation schedules kept in the LRU cache"
+    )
+    projection_years: int = Field(
+        default=5,
+        description="Default horizon in years of the amortization projection"
+    )
+    projection_chunk_size: int = Field(
+        default=50_000,
+        description="Expenses processed per chunk by the projection engine"
+    )
+    projection_parallel_threshold: int = Field(
+        default=200_000,
+        description="Portfolio size from which projection chunks run in a process pool"
+    )
+    projection_workers: Optional[int] = Field(
+        default=None,
+        description="Projection worker processes (None uses all CPUs, 1 disables the pool)"
+    )
+    report_cache_size: int = Field(
+        default=64,
+        description="Maximum number of report results kept in the LRU cache"
+    )
+
+    # Expense List
+    list_page_size: int = Field(
+        default=20,
+        ge=1,
+        description="Expenses shown per page of the expense list"
+    )
+
     # Application Settings
     app_title: str = Field(
         default="Quản Lý Chi Phí Trả Trước (TK 242)",
@@ -1,7 +1,58 @@
 """Database migration script to add new columns."""
 import sqlite3
+import re
 import os
 
+# Money columns stored as whole đồng (INTEGER affinity)
+MONEY_COLUMNS = {
+    'expenses': ['total_amount', 'already_allocated'],
+    'allocations': ['amount'],
+}
+
+
+def convert_money_columns(cursor, table, money_columns):
+    """
+    Rebuild a table so its money columns are BIGINT instead of FLOAT.
+    
+    SQLite cannot change a column type in place, so the table is recreated
+    from its original DDL with the column types swapped, values are copied with
+    CAST(ROUND(...) AS INTEGER), and its indexes are recreated.
+    """
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    row = cursor.fetchone()
+    if row is None:
+        return False
+    create_sql = row[0]
+    
+    cursor.execute(f"PRAGMA table_info({table})")
+    columns = [(column[1], column[2].upper()) for column in cursor.fetchall()]
+    to_convert = [name for name, col_type in columns if name in money_columns and col_type in ('FLOAT', 'REAL')]
+    if not to_convert:
+        return False
+    
+    new_sql = create_sql
+    for name in to_convert:
+        new_sql = re.sub(rf'(\b{name}\b\s+)(FLOAT|REAL)\b', r'\1BIGINT', new_sql, count=1, flags=re.IGNORECASE)
+    new_sql = re.sub(rf'^CREATE TABLE\s+"?{table}"?', f'CREATE TABLE {table}__new', new_sql, count=1)
+    
+    cursor.execute("SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table,))
+    index_sqls = [r[0] for r in cursor.fetchall()]
+    
+    select_list = ", ".join(
+        f"CAST(ROUND({name}) AS INTEGER)" if name in to_convert else name
+        for name, _ in columns
+    )
+    column_list = ", ".join(name for name, _ in columns)
+    
+    cursor.execute(new_sql)
+    cursor.execute(f"INSERT INTO {table}__new ({column_list}) SELECT {select_list} FROM {table}")
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}__new RENAME TO {table}")
+    for index_sql in index_sqls:
+        cursor.execute(index_sql)
+    return True
+
+
 def migrate_database():
     """Add new columns to existing database."""
     db_path = "data/expenses.db"
@@ -46,7 +97,7 @@ def migrate_database():
         # Add already_allocated if it doesn't exist
         if 'already_allocated' not in columns:
             print("Adding already_allocated column...")
-            cursor.execute("ALTER TABLE expenses ADD COLUMN already_allocated FLOAT DEFAULT 0.0")
+            cursor.execute("ALTER TABLE expenses ADD COLUMN already_allocated BIGINT DEFAULT 0")
             print("[OK] Added already_allocated column")
         
         # Add past_quarter_year if it doesn't exist
@@ -67,10 +118,66 @@ def migrate_database():
             print("Adding note column...")
             cursor.execute("ALTER TABLE expenses ADD COLUMN note TEXT")
             print("[OK] Added note column")
+        
+        # Add schedule rebase point (set when an expense's schedule is edited)
+        if 'rebase_date' not in columns:
+            print("Adding rebase_date column...")
+            cursor.execute("ALTER TABLE expenses ADD COLUMN rebase_date DATE")
+            print("[OK] Added rebase_date column")
+        
+        if 'rebase_accumulated' not in columns:
+            print("Adding rebase_accumulated column...")
+            cursor.execute("ALTER TABLE expenses ADD COLUMN rebase_accumulated BIGINT DEFAULT 0")
+            print("[OK] Added rebase_accumulated column")
+        
+        # Add allocation method (daily pro-rata for existing expenses)
+        if 'allocation_method' not in columns:
+            print("Adding allocation_method column...")
+            cursor.execute("ALTER TABLE expenses ADD COLUMN allocation_method VARCHAR(20) NOT NULL DEFAULT 'daily'")
+            print("[OK] Added allocation_method column")
+        
+        if 'allocation_params' not in columns:
+            print("Adding allocation_params column...")
+            cursor.execute("ALTER TABLE expenses ADD COLUMN allocation_params JSON")
+            print("[OK] Added allocation_params column")
             
+        # Add period granularity to allocations
+        cursor.execute("PRAGMA table_info(allocations)")
+        allocation_columns = [column[1] for column in cursor.fetchall()]
+        
+        if 'period_type' not in allocation_columns:
+            print("Adding period_type column...")
+            cursor.execute("ALTER TABLE allocations ADD COLUMN period_type VARCHAR(10) NOT NULL DEFAULT 'quarter'")
+            print("[OK] Added period_type column")
+        
+        if 'period' not in allocation_columns:
+            print("Adding period column...")
+            cursor.execute("ALTER TABLE allocations ADD COLUMN period INTEGER")
+            cursor.execute("UPDATE allocations SET period = quarter WHERE period_type = 'quarter'")
+            print("[OK] Added period column")
+        
+        # Indexes for per-expense chronological scans and period filters of allocations
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_allocations_expense_period ON allocations (expense_id, year, quarter, period, days_in_quarter, amount)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_allocations_year_quarter ON allocations (year, quarter)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_allocations_expense_end ON allocations (expense_id, end_date, start_date, days_in_quarter, amount)")
+        print("[OK] Ensured allocation indexes")
+        
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_expenses_start_date_id ON expenses (start_date, id)")
+        print("[OK] Ensured expense list index")
+        
         # Make allocation_months nullable if needed
         print("Checking allocation_months column...")
         
+        # Convert money columns from FLOAT to whole-đồng BIGINT
+        conn.commit()
+        cursor.execute("PRAGMA foreign_keys=OFF")
+        cursor.execute("PRAGMA legacy_alter_table=ON")
+        for table, money_columns in MONEY_COLUMNS.items():
+            if convert_money_columns(cursor, table, money_columns):
+                print(f"[OK] Converted {table} money columns to integer đồng")
+            else:
+                print(f"{table} money columns already integer")
+        
         conn.commit()
         print("\n[SUCCESS] Migration completed successfully!")
         
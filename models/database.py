@@ -1,5 +1,5 @@
 """Database models using SQLAlchemy."""
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, DateTime, ForeignKey, Text
+from sqlalchemy import create_engine, event, Column, Integer, BigInteger, String, Date, DateTime, ForeignKey, Text, JSON, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
@@ -17,15 +17,19 @@ class Expense(Base):
     account_number = Column(String(10), nullable=False, index=True)  # 242xxx format
     name = Column(String(255), nullable=False)
     document_code = Column(String(50), nullable=True)  # Document/voucher code for identification
-    total_amount = Column(Float, nullable=False)
+    total_amount = Column(BigInteger, nullable=False)  # Whole đồng
     start_date = Column(Date, nullable=False)
     end_date = Column(Date, nullable=False)  # End date for allocation
     sub_code = Column(String(10), nullable=False)  # 9995 or 9996
     allocation_months = Column(Integer, nullable=True)  # Calculated from dates, kept for compatibility
-    already_allocated = Column(Float, default=0.0)
+    already_allocated = Column(BigInteger, default=0)  # Whole đồng
     past_quarter_year = Column(String(20), nullable=True)
     tags = Column(String(255), nullable=True)  # Comma separated tags
     note = Column(Text, nullable=True)  # User notes
+    rebase_date = Column(Date, nullable=True)  # First open day after the last schedule edit
+    rebase_accumulated = Column(BigInteger, default=0)  # System allocation before rebase_date (whole đồng)
+    allocation_method = Column(String(20), nullable=False, default="daily")  # daily, monthly or tranche
+    allocation_params = Column(JSON, nullable=True)  # Method parameters, e.g. {"tranches": [...]}
     created_at = Column(DateTime, default=datetime.now)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
     
@@ -33,25 +37,105 @@ class Expense(Base):
     allocations = relationship("Allocation", back_populates="expense", cascade="all, delete-orphan")
     documents = relationship("Document", back_populates="expense", cascade="all, delete-orphan")
     notifications = relationship("Notification", back_populates="expense", cascade="all, delete-orphan")
+    
+    __table_args__ = (
+        # Paging of the expense list (newest start date first)
+        Index("ix_expenses_start_date_id", "start_date", "id"),
+    )
 
 
 class Allocation(Base):
-    """Quarterly allocation record."""
+    """Period (monthly/quarterly/yearly) allocation record."""
     __tablename__ = "allocations"
     
     id = Column(Integer, primary_key=True, index=True)
     expense_id = Column(Integer, ForeignKey("expenses.id"), nullable=False)
-    quarter = Column(Integer, nullable=False)  # 1, 2, 3, 4
+    period_type = Column(String(10), nullable=False, default="quarter")  # month, quarter or year
+    period = Column(Integer, nullable=True)  # Period number within the year (month 1-12, quarter 1-4, year 1)
+    quarter = Column(Integer, nullable=False)  # 1, 2, 3, 4 - quarter in which the period closes
     year = Column(Integer, nullable=False)
-    amount = Column(Float, nullable=False)
-    days_in_quarter = Column(Integer, nullable=False)  # Actual days in this quarter
-    start_date = Column(Date, nullable=False)  # Quarter start date (or expense start if later)
-    end_date = Column(Date, nullable=False)  # Quarter end date (or expense end if earlier)
+    amount = Column(BigInteger, nullable=False)  # Whole đồng
+    days_in_quarter = Column(Integer, nullable=False)  # Actual days in this period
+    start_date = Column(Date, nullable=False)  # Period start date (or expense start if later)
+    end_date = Column(Date, nullable=False)  # Period end date (or expense end if earlier)
     created_at = Column(DateTime, default=datetime.now)
     
     # Relationships
     expense = relationship("Expense", back_populates="allocations")
 
+    __table_args__ = (
+        # Per-expense chronological scans (running totals, opening balances)
+        Index("ix_allocations_expense_period", "expense_id", "year", "quarter", "period", "days_in_quarter", "amount"),
+        Index("ix_allocations_year_quarter", "year", "quarter"),
+        # Rows ending after a period close (reports from the latest snapshot)
+        Index("ix_allocations_expense_end", "expense_id", "end_date", "start_date", "days_in_quarter", "amount"),
+    )
+
+
+class Tag(Base):
+    """Distinct tag name (normalized from the comma-separated Expense.tags, services/tag_index.py)."""
+    __tablename__ = "tags"
+    
+    id = Column(Integer, primary_key=True)
+    name = Column(String(255), nullable=False, unique=True)
+
+
+class ExpenseTag(Base):
+    """Link between an expense and one of its tags."""
+    __tablename__ = "expense_tags"
+    
+    expense_id = Column(Integer, ForeignKey("expenses.id"), primary_key=True)
+    tag_id = Column(Integer, ForeignKey("tags.id"), primary_key=True)
+    
+    __table_args__ = (
+        # Tag filters look up expenses by tag
+        Index("ix_expense_tags_tag_expense", "tag_id", "expense_id"),
+    )
+
+
+class AllocationTotal(Base):
+    """Per-period allocation totals by account, kept in sync on flush (services/allocation_totals.py)."""
+    __tablename__ = "allocation_totals"
+    
+    year = Column(Integer, primary_key=True)
+    quarter = Column(Integer, primary_key=True)
+    account_number = Column(String(10), primary_key=True)
+    sub_code = Column(String(10), primary_key=True)
+    amount = Column(BigInteger, nullable=False, default=0)  # System allocation (days_in_quarter > 0), whole đồng
+    allocation_count = Column(Integer, nullable=False, default=0)  # System allocation rows
+    expense_count = Column(Integer, nullable=False, default=0)  # Expenses with system rows in the quarter
+
+
+class PeriodClose(Base):
+    """Closed quarter: data dated up to close_date is locked (services/period_close.py)."""
+    __tablename__ = "period_closes"
+    
+    close_date = Column(Date, primary_key=True)  # Last day of the closed quarter
+    year = Column(Integer, nullable=False)
+    quarter = Column(Integer, nullable=False)
+    expense_count = Column(Integer, nullable=False, default=0)  # Expenses in the snapshot
+    closing_balance = Column(BigInteger, nullable=False, default=0)  # Whole đồng
+    closed_at = Column(DateTime, default=datetime.now)
+
+
+class BalanceSnapshot(Base):
+    """Closing balance of one expense at a period close."""
+    __tablename__ = "balance_snapshots"
+    
+    close_date = Column(Date, ForeignKey("period_closes.close_date"), primary_key=True)
+    expense_id = Column(Integer, ForeignKey("expenses.id"), primary_key=True)
+    allocated = Column(BigInteger, nullable=False)  # System allocation through close_date, whole đồng
+    balance = Column(BigInteger, nullable=False)  # Closing balance, whole đồng
+
+
+class AppSetting(Base):
+    """Application setting changed from the UI, kept with the data (e.g. the fiscal year start)."""
+    __tablename__ = "app_settings"
+    
+    key = Column(String(50), primary_key=True)
+    value = Column(String(255), nullable=False)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
 
 class Document(Base):
     """Uploaded document reference."""
@@ -84,6 +168,39 @@ class Notification(Base):
     expense = relationship("Expense", back_populates="notifications")
 
 
+# Full-text index over the searchable expense fields (services/search.py), kept in sync by
+# triggers. unicode61 keeps đ/Đ as letters of their own, so they are folded to d/D here.
+SEARCH_FIELDS = ("name", "account_number", "sub_code", "document_code", "note")
+
+
+def search_values(row: str) -> str:
+    """SQL list of the folded search fields of a trigger row ('new' or 'old')."""
+    return ", ".join(
+        f"replace(replace(coalesce({row}.{field}, ''), 'đ', 'd'), 'Đ', 'D')" for field in SEARCH_FIELDS
+    )
+
+
+SEARCH_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5("
+    f"{', '.join(SEARCH_FIELDS)}, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    f"CREATE TRIGGER IF NOT EXISTS expenses_fts_insert AFTER INSERT ON expenses BEGIN "
+    f"INSERT INTO expenses_fts (rowid, {', '.join(SEARCH_FIELDS)}) VALUES (new.id, {search_values('new')}); END",
+    f"CREATE TRIGGER IF NOT EXISTS expenses_fts_update AFTER UPDATE OF {', '.join(SEARCH_FIELDS)} ON expenses BEGIN "
+    f"DELETE FROM expenses_fts WHERE rowid = old.id; "
+    f"INSERT INTO expenses_fts (rowid, {', '.join(SEARCH_FIELDS)}) VALUES (new.id, {search_values('new')}); END",
+    "CREATE TRIGGER IF NOT EXISTS expenses_fts_delete AFTER DELETE ON expenses BEGIN "
+    "DELETE FROM expenses_fts WHERE rowid = old.id; END",
+]
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def _create_search_index(target, connection, **kw):
+    """Create the FTS5 table and its triggers with the regular tables (SQLite only)."""
+    if connection.dialect.name == 'sqlite':
+        for statement in SEARCH_DDL:
+            connection.exec_driver_sql(statement)
+
+
 # Ensure database directory exists for SQLite
 if "sqlite" in settings.database_url:
     try:
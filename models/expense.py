@@ -8,7 +8,7 @@ class ExpenseCreate(BaseModel):
     """Model for creating a new expense."""
     account_number: str = Field(..., description="Account number in format 242xxx")
     name: str = Field(..., min_length=1, max_length=255, description="Expense name")
-    total_amount: float = Field(..., gt=0, description="Total amount (must be positive)")
+    total_amount: int = Field(..., gt=0, description="Total amount in đồng (must be positive)")
     start_date: date = Field(..., description="Start date for allocation")
     
     @validator('account_number')
@@ -28,7 +28,7 @@ class ExpenseResponse(BaseModel):
     id: int
     account_number: str
     name: str
-    total_amount: float
+    total_amount: int
     start_date: date
     sub_code: str
     allocation_months: int
@@ -43,7 +43,7 @@ class AllocationResponse(BaseModel):
     expense_id: int
     quarter: int
     year: int
-    amount: float
+    amount: int
     days_in_quarter: int
     start_date: date
     end_date: date
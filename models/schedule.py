@@ -0,0 +1,238 @@
+"""Compact array-backed allocation schedule."""
+from collections.abc import Mapping
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Tuple
+import numpy as np
+import pandas as pd
+from utils.fiscal_calendar import ordinals_to_datetime64
+from utils.helpers import format_period
+
+# One record per period; dates are stored as day ordinals
+SCHEDULE_DTYPE = np.dtype([
+    ('period', np.int16),
+    ('quarter', np.int8),
+    ('year', np.int16),
+    ('amount', np.int64),
+    ('days_in_quarter', np.int32),
+    ('start_ordinal', np.int32),
+    ('end_ordinal', np.int32),
+])
+
+ROW_KEYS = (
+    'period_type', 'period', 'quarter', 'year', 'amount',
+    'days_in_quarter', 'start_date', 'end_date', 'total_days'
+)
+
+
+class AllocationRow(Mapping):
+    """Read-only view of one period of an AllocationSchedule (no per-row storage)."""
+    __slots__ = ('_schedule', '_index')
+
+    def __init__(self, schedule: "AllocationSchedule", index: int):
+        self._schedule = schedule
+        self._index = index
+
+    def __getitem__(self, key: str):
+        schedule = self._schedule
+        if key == 'period_type':
+            return schedule.period_type
+        if key == 'total_days':
+            return schedule.total_days
+        if key == 'start_date':
+            return date.fromordinal(int(schedule.rows['start_ordinal'][self._index]))
+        if key == 'end_date':
+            return date.fromordinal(int(schedule.rows['end_ordinal'][self._index]))
+        if key in SCHEDULE_DTYPE.names:
+            return int(schedule.rows[key][self._index])
+        raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(ROW_KEYS)
+
+    def __len__(self) -> int:
+        return len(ROW_KEYS)
+
+    def __repr__(self) -> str:
+        return f"AllocationRow({dict(self)!r})"
+
+    @property
+    def label(self) -> str:
+        """Formatted period label (e.g. Q1/2024, T3/2024)."""
+        return format_period(self._schedule.period_type, self['period'], self['year'])
+
+
+class AllocationSchedule:
+    """
+    Immutable allocation schedule backed by one NumPy structured array.
+
+    Values shared by every row (period type, total amount, total days) are
+    stored once. Indexing returns AllocationRow views that read from the array.
+    """
+    __slots__ = ('period_type', 'total_amount', 'total_days', 'rows')
+
+    def __init__(self, rows: np.ndarray, period_type: str, total_amount: int, total_days: int):
+        if rows.flags.writeable:
+            rows.flags.writeable = False
+        object.__setattr__(self, 'rows', rows)
+        object.__setattr__(self, 'period_type', period_type)
+        object.__setattr__(self, 'total_amount', int(total_amount))
+        object.__setattr__(self, 'total_days', int(total_days))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("AllocationSchedule is immutable")
+
+    @classmethod
+    def from_arrays(
+        cls,
+        period_type: str,
+        total_amount: int,
+        total_days: int,
+        period: np.ndarray,
+        quarter: np.ndarray,
+        year: np.ndarray,
+        amount: np.ndarray,
+        days_in_quarter: np.ndarray,
+        start_ordinal: np.ndarray,
+        end_ordinal: np.ndarray
+    ) -> "AllocationSchedule":
+        """Build a schedule from parallel column arrays."""
+        rows = np.empty(len(amount), dtype=SCHEDULE_DTYPE)
+        rows['period'] = period
+        rows['quarter'] = quarter
+        rows['year'] = year
+        rows['amount'] = amount
+        rows['days_in_quarter'] = days_in_quarter
+        rows['start_ordinal'] = start_ordinal
+        rows['end_ordinal'] = end_ordinal
+        return cls(rows, period_type, total_amount, total_days)
+
+    # --- Sequence protocol -------------------------------------------------
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, index: int) -> AllocationRow:
+        if index < 0:
+            index += len(self.rows)
+        if not 0 <= index < len(self.rows):
+            raise IndexError("schedule index out of range")
+        return AllocationRow(self, index)
+
+    def __iter__(self) -> Iterator[AllocationRow]:
+        for index in range(len(self.rows)):
+            yield AllocationRow(self, index)
+
+    def __bool__(self) -> bool:
+        return len(self.rows) > 0
+
+    def __repr__(self) -> str:
+        return (
+            f"AllocationSchedule(period_type={self.period_type!r}, periods={len(self)}, "
+            f"total_amount={self.total_amount}, total_days={self.total_days})"
+        )
+
+    # --- Column access -----------------------------------------------------
+
+    @property
+    def amounts(self) -> np.ndarray:
+        """Amount per period (read-only view)."""
+        return self.rows['amount']
+
+    @property
+    def days(self) -> np.ndarray:
+        """Days per period (read-only view)."""
+        return self.rows['days_in_quarter']
+
+    @property
+    def start_dates(self) -> np.ndarray:
+        """Period start dates as datetime64[D]."""
+        return ordinals_to_datetime64(self.rows['start_ordinal'])
+
+    @property
+    def end_dates(self) -> np.ndarray:
+        """Period end dates as datetime64[D]."""
+        return ordinals_to_datetime64(self.rows['end_ordinal'])
+
+    def cumulative(self) -> np.ndarray:
+        """Running total allocated through each period."""
+        return np.cumsum(self.rows['amount'])
+
+    def remaining(self) -> np.ndarray:
+        """Balance still to allocate after each period."""
+        return self.total_amount - self.cumulative()
+
+    def percentages(self) -> np.ndarray:
+        """Share of total days falling in each period, in percent."""
+        return self.rows['days_in_quarter'] * 100.0 / self.total_days
+
+    def labels(self) -> List[str]:
+        """Formatted period labels."""
+        return [
+            format_period(self.period_type, p, y)
+            for p, y in zip(self.rows['period'].tolist(), self.rows['year'].tolist())
+        ]
+
+    # --- Conversions -------------------------------------------------------
+
+    def to_dataframe(self, include_dates: bool = False) -> pd.DataFrame:
+        """
+        Convert to a DataFrame whose columns are views of the schedule array.
+
+        Args:
+            include_dates: Also add start_date/end_date datetime columns
+                (these are derived, so they are the only copied columns)
+
+        Returns:
+            DataFrame with one row per period
+        """
+        df = pd.DataFrame({name: self.rows[name] for name in SCHEDULE_DTYPE.names}, copy=False)
+        if include_dates:
+            df['start_date'] = self.start_dates
+            df['end_date'] = self.end_dates
+        return df
+
+    def iter_periods(self) -> Iterator[Tuple[int, int, int, int, int, date, date]]:
+        """
+        Iterate plain Python values without building row views.
+
+        Yields:
+            tuple: (period, quarter, year, amount, days_in_quarter, start_date, end_date)
+        """
+        rows = self.rows
+        for period, quarter, year, amount, days, start, end in zip(
+            *(rows[name].tolist() for name in SCHEDULE_DTYPE.names)
+        ):
+            yield period, quarter, year, amount, days, date.fromordinal(start), date.fromordinal(end)
+
+    def to_dicts(self) -> List[Dict]:
+        """Convert to the legacy list-of-dicts representation."""
+        return [dict(row) for row in self]
+
+    # --- Summaries ---------------------------------------------------------
+
+    def total_allocated(self) -> int:
+        """Sum of all period amounts."""
+        return int(self.rows['amount'].sum())
+
+    def first_period(self) -> Optional[str]:
+        """Label of the first period, or None for an empty schedule."""
+        return self[0].label if self else None
+
+    def last_period(self) -> Optional[str]:
+        """Label of the last period, or None for an empty schedule."""
+        return self[-1].label if self else None
+
+    def summary(self) -> Dict:
+        """
+        Get summary of the schedule.
+
+        Returns:
+            Dictionary with period count, totals and first/last period labels
+        """
+        return {
+            'total_quarters': len(self),
+            'total_allocated': self.total_allocated(),
+            'total_days': int(self.rows['days_in_quarter'].sum()),
+            'first_quarter': self.first_period(),
+            'last_quarter': self.last_period()
+        }
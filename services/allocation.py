@@ -1,11 +1,75 @@
-"""Quarterly allocation service with pro-rata calculation."""
-from datetime import date
-from typing import List, Dict
-from utils.helpers import get_quarter, get_quarter_dates, get_days_in_range, add_months
+"""Period allocation service (monthly/quarterly/yearly) with pro-rata calculation."""
+from datetime import date, datetime, timedelta
+from typing import List, Dict, Sequence, Tuple, Optional
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, select
+from config.settings import settings
+from models.schedule import AllocationSchedule, SCHEDULE_DTYPE
+from utils.helpers import add_months, to_dong
+from utils.lru_cache import LRUCache
+from utils.fiscal_calendar import (
+    PERIOD_QUARTER, get_period_calendar, calendar_covering, to_ordinals, ordinals_to_datetime64,
+    active_start_month
+)
+from services.allocation_methods import METHOD_DAILY, get_method, accumulated_grouped, params_key
+
+
+def _to_dong_array(values) -> np.ndarray:
+    """Convert amounts to an int64 array of whole đồng."""
+    arr = np.asarray(values)
+    if arr.dtype.kind in 'iu':
+        return arr.astype(np.int64)
+    return np.rint(arr.astype(np.float64)).astype(np.int64)
+
+
+def _split_origins(
+    start_ordinals: np.ndarray,
+    rebase_dates: Optional[Sequence[Optional[date]]] = None,
+    rebase_accumulated: Optional[Sequence[int]] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Get the ordinal where each expense's day split starts and the amount before it.
+    
+    Returns:
+        tuple: (origin ordinals, base amounts); the origin is the rebase date
+        for edited expenses and the start date otherwise
+    """
+    origins = np.asarray(start_ordinals, dtype=np.int64)
+    base = np.zeros(len(origins), dtype=np.int64)
+    if isinstance(rebase_dates, np.ndarray) and rebase_dates.dtype.kind == 'M':
+        # Origins already resolved for every expense (NaT means not rebased)
+        rebased = ~np.isnat(rebase_dates)
+        origins = np.where(rebased, to_ordinals(rebase_dates), origins)
+        base[rebased] = _to_dong_array(rebase_accumulated)[rebased]
+    elif rebase_dates is not None:
+        rebased = np.array([d is not None for d in rebase_dates], dtype=bool)
+        if rebased.any():
+            origins = origins.copy()
+            origins[rebased] = to_ordinals([d for d in rebase_dates if d is not None])
+            base[rebased] = _to_dong_array(rebase_accumulated)[rebased]
+    return origins, base
+
+
+# (total, start, end, period_type, fiscal year start month, method, method params)
+ScheduleKey = Tuple[int, date, date, str, int, str, Optional[str]]
+ScheduleCache = LRUCache[ScheduleKey, AllocationSchedule]
+
+
+def _as_date(value) -> date:
+    """Normalize date-like values (date, datetime, Timestamp, string) to a date."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return pd.Timestamp(value).date()
 
 
 class AllocationService:
-    """Service for calculating quarterly allocations."""
+    """Service for calculating period allocations."""
+    
+    # Shared across reruns and sessions: keyed by (total, start, end, period_type, fiscal start, method)
+    _schedule_cache = ScheduleCache(settings.schedule_cache_size)
     
     @staticmethod
     def calculate_months_between_dates(start_date: date, end_date: date) -> int:
@@ -61,16 +125,19 @@ class AllocationService:
     
     @staticmethod
     def calculate_quarterly_allocations(
-        total_amount: float,
+        total_amount: int,
         start_date: date,
         end_date: date = None,
         allocation_months: int = None,
-        already_allocated: float = 0.0,
-        past_quarter_year: str = None
-    ) -> List[Dict]:
+        already_allocated: int = 0,
+        past_quarter_year: str = None,
+        method: Optional[str] = None,
+        params: Optional[Dict] = None
+    ) -> AllocationSchedule:
         """
         Calculate quarterly allocations using pro-rata method based on actual days.
         Now ignore already_allocated/past_quarter_year in the core calculation as requested.
+        Other allocation methods are selected with method/params.
         """
         # Calculate end date if not provided
         if end_date is None:
@@ -78,75 +145,603 @@ class AllocationService:
                 raise ValueError("Either end_date or allocation_months must be provided")
             end_date = add_months(start_date, allocation_months)
             # Adjust to last day of previous month
-            from datetime import timedelta
             end_date = date(end_date.year, end_date.month, 1) - timedelta(days=1)
         
-        # Calculate total days in allocation period
-        total_days = get_days_in_range(start_date, end_date)
+        return AllocationService.calculate_allocations(
+            total_amount, start_date, end_date, PERIOD_QUARTER, method, params
+        )
+    
+    @staticmethod
+    def calculate_allocations(
+        total_amount: int,
+        start_date: date,
+        end_date: date,
+        period_type: str = PERIOD_QUARTER,
+        method: Optional[str] = None,
+        params: Optional[Dict] = None,
+        rebase_date: Optional[date] = None,
+        rebase_accumulated: int = 0
+    ) -> AllocationSchedule:
+        """
+        Calculate allocations per month, quarter or year.
         
-        allocations = []
-        current_date = start_date
+        The default method is daily pro-rata. 
+        Amounts are whole đồng, split with the largest-remainder method at day
+        granularity: every day has the same quota total/total_days, and the
+        total % total_days leftover units go to evenly spaced days. A period's
+        amount is the sum over its days, i.e. the difference of
+        floor(total * elapsed_days / total_days) at its boundaries, so each
+        period is within 1 đồng of its exact share and the schedule always
+        sums to the total. Other methods (see services.allocation_methods)
+        replace the day count with their own cumulative amount.
         
-        # Iterate through each quarter in the allocation period
-        while current_date <= end_date:
-            quarter, year = get_quarter(current_date)
-            quarter_start, quarter_end = get_quarter_dates(quarter, year)
-            
-            # Determine actual start and end for this quarter's allocation
-            allocation_start = max(current_date, quarter_start)
-            allocation_end = min(end_date, quarter_end)
-            
-            # Calculate days in this quarter that fall within allocation period
-            days_in_quarter = get_days_in_range(allocation_start, allocation_end)
-            
-            # Calculate pro-rata amount for this quarter (as integer)
-            quarter_amount = round((days_in_quarter / total_days) * total_amount)
-            
-            allocations.append({
-                'quarter': quarter,
-                'year': year,
-                'amount': quarter_amount,  # Integer amount (will be adjusted)
-                'days_in_quarter': days_in_quarter,
-                'start_date': allocation_start,
-                'end_date': allocation_end,
-                'total_days': total_days
-            })
-            
-            # Move to next quarter
-            if quarter == 4:
-                current_date = date(year + 1, 1, 1)
-            else:
-                next_quarter_month = (quarter * 3) + 1
-                current_date = date(year, next_quarter_month, 1)
+        Args:
+            total_amount: Total amount to allocate
+            start_date: Allocation start date
+            end_date: Allocation end date (inclusive)
+            period_type: 'month', 'quarter' or 'year'
+            method: Allocation method name (default daily pro-rata)
+            params: Method parameters (tranches for the tranche method)
+            rebase_date: Start the schedule here, splitting what remains
+                after rebase_accumulated (schedule edits)
+            rebase_accumulated: Amount allocated before rebase_date
         
-        # Fix rounding error: adjust last quarter to match total exactly
-        if allocations:
-            total_allocated = sum(a['amount'] for a in allocations)
-            difference = int(total_amount) - total_allocated
-            
-            # Add the difference to the last quarter
-            allocations[-1]['amount'] += difference
+        Returns:
+            AllocationSchedule with one row per period. 'quarter' is the
+            fiscal quarter in which the period closes and 'days_in_quarter' holds the
+            days of the period that fall in the allocation range.
+        """
+        total_amount = to_dong(total_amount)
+        origin_date = rebase_date or start_date
+        start_ordinal = origin_date.toordinal()
+        end_ordinal = end_date.toordinal()
+        if end_ordinal < start_ordinal:
+            return AllocationSchedule(np.empty(0, dtype=SCHEDULE_DTYPE), period_type, total_amount, 0)
+        
+        cal = get_period_calendar(period_type)
+        if not (cal.contains(start_ordinal) and cal.contains(end_ordinal)):
+            cal = calendar_covering(np.array([start_ordinal, end_ordinal]), period_type)
+        
+        # Slice of the precomputed periods covering the allocation range
+        periods = slice(cal.index_of(origin_date), cal.index_of(end_date) + 1)
+        total_days = end_ordinal - start_ordinal + 1
+        
+        alloc_start = np.maximum(cal.period_start[periods], start_ordinal)
+        alloc_end = np.minimum(cal.period_end[periods], end_ordinal)
+        
+        # Amount allocated through the end of each period, minus the previous period's
+        base = np.array([rebase_accumulated if rebase_date else 0], dtype=np.int64)
+        cumulative = get_method(method).accumulated_batch(
+            np.array([total_amount], dtype=np.int64),
+            np.array([start_date.toordinal()], dtype=np.int64),
+            np.array([end_ordinal], dtype=np.int64),
+            alloc_end[None, :],
+            [params],
+            np.array([start_ordinal], dtype=np.int64),
+            base
+        )[0] - base[0]
+        
+        return AllocationSchedule.from_arrays(
+            period_type, int(total_amount - base[0]), total_days,
+            period=cal.period_number[periods],
+            quarter=cal.period_quarter[periods],
+            year=cal.period_year[periods],
+            amount=np.diff(cumulative, prepend=0),
+            days_in_quarter=alloc_end - alloc_start + 1,
+            start_ordinal=alloc_start,
+            end_ordinal=alloc_end
+        )
+    
+    @staticmethod
+    def _batch_rows(
+        total_amounts: Sequence[int],
+        start_dates: Sequence[date],
+        end_dates: Sequence[date],
+        period_type: str,
+        methods: Optional[Sequence[Optional[str]]] = None,
+        params: Optional[Sequence[Optional[Dict]]] = None,
+        start_month: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Compute the period rows of many expenses in one array pass.
+        
+        Expenses are grouped by allocation method and each group's cumulative
+        amounts are computed as one array operation.
         
-        return allocations
+        Returns:
+            tuple: (rows, n_periods, totals, total_days, expense_index) where rows
+            is a SCHEDULE_DTYPE array holding each expense's periods contiguously
+        """
+        totals = _to_dong_array(total_amounts)
+        starts = to_ordinals(start_dates)
+        ends = to_ordinals(end_dates)
+        
+        cal = calendar_covering(np.concatenate([starts, ends]), period_type, start_month)
+        first_p = cal.period_indices(starts)
+        last_p = cal.period_indices(ends)
+        n_periods = np.where(ends >= starts, last_p - first_p + 1, 0)
+        
+        # One row per (expense, period)
+        expense_index = np.repeat(np.arange(len(totals)), n_periods)
+        group_offsets = np.cumsum(n_periods) - n_periods
+        position = np.arange(len(expense_index)) - np.repeat(group_offsets, n_periods)
+        p_seq = first_p[expense_index] + position
+        
+        alloc_start = np.maximum(starts[expense_index], cal.period_start[p_seq])
+        alloc_end = np.minimum(ends[expense_index], cal.period_end[p_seq])
+        total_days = np.maximum(ends - starts + 1, 0)
+        
+        # Difference of cumulative floors per expense (day-level largest remainder for daily)
+        cumulative = accumulated_grouped(methods, totals, starts, ends, alloc_end, params, index=expense_index)
+        amounts = np.diff(cumulative, prepend=0)
+        amounts[position == 0] = cumulative[position == 0]
+        
+        rows = np.empty(len(expense_index), dtype=SCHEDULE_DTYPE)
+        rows['period'] = cal.period_number[p_seq]
+        rows['quarter'] = cal.period_quarter[p_seq]
+        rows['year'] = cal.period_year[p_seq]
+        rows['amount'] = amounts
+        rows['days_in_quarter'] = alloc_end - alloc_start + 1
+        rows['start_ordinal'] = alloc_start
+        rows['end_ordinal'] = alloc_end
+        return rows, n_periods, totals, total_days, expense_index
+    
+    @staticmethod
+    def calculate_batch_allocations(
+        total_amounts: Sequence[int],
+        start_dates: Sequence[date],
+        end_dates: Sequence[date],
+        period_type: str = PERIOD_QUARTER,
+        methods: Optional[Sequence[Optional[str]]] = None,
+        params: Optional[Sequence[Optional[Dict]]] = None,
+        start_month: Optional[int] = None
+    ) -> pd.DataFrame:
+        """
+        Calculate period allocations for many expenses in one array pass.
+        
+        Produces exactly the rows of calculate_allocations for each
+        (total_amount, start_date, end_date) triple, concatenated in input order.
+        
+        Args:
+            total_amounts: Total amount of each expense
+            start_dates: Allocation start date of each expense
+            end_dates: Allocation end date of each expense
+            period_type: 'month', 'quarter' or 'year'
+            methods: Allocation method of each expense (default all daily)
+            params: Method parameters of each expense
+            start_month: Fiscal year start month (default the configured one)
+        
+        Returns:
+            DataFrame with columns expense_index (position in the inputs),
+            period_type, period, quarter, year, amount, days_in_quarter,
+            start_date, end_date and total_days
+        """
+        rows, _, _, total_days, expense_index = AllocationService._batch_rows(
+            total_amounts, start_dates, end_dates, period_type, methods, params, start_month
+        )
+        return pd.DataFrame({
+            'expense_index': expense_index,
+            'period_type': period_type,
+            'period': rows['period'].astype(np.int64),
+            'quarter': rows['quarter'].astype(np.int64),
+            'year': rows['year'].astype(np.int64),
+            'amount': rows['amount'],
+            'days_in_quarter': rows['days_in_quarter'].astype(np.int64),
+            'start_date': ordinals_to_datetime64(rows['start_ordinal']),
+            'end_date': ordinals_to_datetime64(rows['end_ordinal']),
+            'total_days': total_days[expense_index]
+        })
+    
+    @staticmethod
+    def calculate_batch_schedules(
+        total_amounts: Sequence[int],
+        start_dates: Sequence[date],
+        end_dates: Sequence[date],
+        period_type: str = PERIOD_QUARTER,
+        methods: Optional[Sequence[Optional[str]]] = None,
+        params: Optional[Sequence[Optional[Dict]]] = None
+    ) -> List[AllocationSchedule]:
+        """
+        Calculate one AllocationSchedule per expense in one array pass.
+        
+        All schedules are views into a single shared row array, so a whole
+        portfolio costs one small object per expense plus its packed rows.
+        
+        Returns:
+            List of schedules aligned with the inputs
+        """
+        rows, n_periods, totals, total_days, _ = AllocationService._batch_rows(
+            total_amounts, start_dates, end_dates, period_type, methods, params
+        )
+        rows.flags.writeable = False
+        bounds = np.concatenate([[0], np.cumsum(n_periods)]).tolist()
+        return [
+            AllocationSchedule(rows[bounds[i]:bounds[i + 1]], period_type, total, days)
+            for i, (total, days) in enumerate(zip(totals.tolist(), total_days.tolist()))
+        ]
+    
+    @staticmethod
+    def schedule_to_allocations(schedule: AllocationSchedule) -> list:
+        """Build Allocation records from an allocation schedule."""
+        from models.database import Allocation
+        
+        return [
+            Allocation(
+                period_type=schedule.period_type,
+                period=period,
+                quarter=quarter,
+                year=year,
+                amount=amount,
+                days_in_quarter=days,
+                start_date=start,
+                end_date=end
+            )
+            for period, quarter, year, amount, days, start, end in schedule.iter_periods()
+        ]
     
     @staticmethod
-    def get_allocation_summary(allocations: List[Dict]) -> Dict:
+    def accumulated_at(expense, as_of: date) -> int:
         """
-        Get summary of allocations.
+        Get the amount of an expense allocated up to and including a date.
+        
+        Closed form of the stored schedule's split: for daily pro-rata the
+        system allocation through as_of is floor(total * elapsed_days / total_days),
+        which equals the sum of the stored period amounts at every period end;
+        other methods use their own accumulated amount.
+        After a schedule edit the split restarts at rebase_date from the
+        amount already allocated in the closed periods; dates before the
+        rebase point are read from the stored allocation rows.
         
         Args:
-            allocations: List of allocation dictionaries
+            expense: Object with total_amount, start_date, end_date and
+                (optionally) already_allocated, rebase_date, rebase_accumulated,
+                allocation_method, allocation_params
+            as_of: Report date
         
         Returns:
-            Dictionary with summary information
+            int: Historical amount plus system allocation through as_of
+        """
+        as_of = _as_date(as_of)
+        already_allocated = getattr(expense, 'already_allocated', 0) or 0
+        start_ordinal = _as_date(expense.start_date).toordinal()
+        origin = start_ordinal
+        base = 0
+        
+        rebase_date = getattr(expense, 'rebase_date', None)
+        if rebase_date is not None:
+            if as_of < rebase_date:
+                return already_allocated + AllocationService.accumulated_from_rows(expense.allocations, as_of)
+            origin = rebase_date.toordinal()
+            base = expense.rebase_accumulated or 0
+        
+        method = get_method(getattr(expense, 'allocation_method', None))
+        return already_allocated + method.accumulated(
+            to_dong(expense.total_amount),
+            start_ordinal,
+            _as_date(expense.end_date).toordinal(),
+            as_of.toordinal(),
+            getattr(expense, 'allocation_params', None),
+            origin,
+            base
+        )
+    
+    @staticmethod
+    def accumulated_from_rows(allocations, as_of: date) -> int:
         """
-        total_allocated = sum(a['amount'] for a in allocations)
-        total_days = sum(a['days_in_quarter'] for a in allocations)
+        Sum stored system allocation rows up to a date, pro-rating the open period.
+        
+        Args:
+            allocations: Allocation records (historical rows are skipped)
+            as_of: Report date
         
-        return {
-            'total_quarters': len(allocations),
-            'total_allocated': round(total_allocated, 2),
-            'total_days': total_days,
-            'first_quarter': f"Q{allocations[0]['quarter']}/{allocations[0]['year']}" if allocations else None,
-            'last_quarter': f"Q{allocations[-1]['quarter']}/{allocations[-1]['year']}" if allocations else None
+        Returns:
+            int: Allocated amount through as_of
+        """
+        accumulated = 0
+        for alloc in allocations:
+            if alloc.days_in_quarter == 0:
+                continue
+            if alloc.end_date <= as_of:
+                accumulated += alloc.amount
+            elif alloc.start_date <= as_of:
+                days_passed = (as_of - alloc.start_date).days + 1
+                accumulated += alloc.amount * days_passed // alloc.days_in_quarter
+        return accumulated
+    
+    @staticmethod
+    def accumulated_at_batch(
+        total_amounts: Sequence[int],
+        start_dates: Sequence[date],
+        end_dates: Sequence[date],
+        as_of,
+        already_allocated: Optional[Sequence[int]] = None,
+        rebase_dates: Optional[Sequence[Optional[date]]] = None,
+        rebase_accumulated: Optional[Sequence[int]] = None,
+        methods: Optional[Sequence[Optional[str]]] = None,
+        params: Optional[Sequence[Optional[Dict]]] = None
+    ) -> np.ndarray:
+        """
+        Vectorized accumulated_at over many expenses in one array pass.
+        
+        Entries whose report date falls before their rebase date are not
+        covered by the closed form; accumulated_at_expenses resolves those
+        from the stored rows.
+        
+        Args:
+            total_amounts: Total amount of each expense
+            start_dates: Allocation start date of each expense
+            end_dates: Allocation end date of each expense
+            as_of: Report date, or one report date per expense
+            already_allocated: Historical amount of each expense (default 0)
+            rebase_dates: Rebase date of each expense, None if never edited
+            rebase_accumulated: System allocation before each rebase date
+            methods: Allocation method of each expense (default all daily)
+            params: Method parameters of each expense
+        
+        Returns:
+            np.ndarray: int64 accumulated amount per expense
+        """
+        totals = _to_dong_array(total_amounts)
+        starts = to_ordinals(start_dates)
+        origins, base = _split_origins(starts, rebase_dates, rebase_accumulated)
+        if isinstance(as_of, (date, str, pd.Timestamp)):
+            as_of_ordinals = _as_date(as_of).toordinal()
+        else:
+            as_of_ordinals = to_ordinals(as_of)
+        
+        accumulated = accumulated_grouped(
+            methods, totals, starts, to_ordinals(end_dates), as_of_ordinals, params, origins, base
+        )
+        
+        if already_allocated is not None:
+            accumulated = accumulated + _to_dong_array(already_allocated)
+        return accumulated
+    
+    @staticmethod
+    def accumulated_at_expenses(expenses: Sequence, as_of: date) -> np.ndarray:
+        """
+        Get accumulated_at for a list of expense records in one array pass.
+        
+        Args:
+            expenses: Expense records
+            as_of: Report date
+        
+        Returns:
+            np.ndarray: int64 accumulated amount (including historical) per expense
+        """
+        as_of = _as_date(as_of)
+        rebase_dates = [e.rebase_date for e in expenses]
+        accumulated = AllocationService.accumulated_at_batch(
+            [e.total_amount for e in expenses],
+            [e.start_date for e in expenses],
+            [e.end_date for e in expenses],
+            as_of,
+            [e.already_allocated or 0 for e in expenses],
+            rebase_dates,
+            [e.rebase_accumulated or 0 for e in expenses],
+            [e.allocation_method for e in expenses],
+            [e.allocation_params for e in expenses]
+        )
+        
+        # Report dates inside closed periods of edited expenses
+        for idx, rebase_date in enumerate(rebase_dates):
+            if rebase_date is not None and as_of < rebase_date:
+                accumulated[idx] = AllocationService.accumulated_at(expenses[idx], as_of)
+        return accumulated
+    
+    @staticmethod
+    def reschedule_expense(
+        db,
+        expense,
+        total_amount: Optional[int] = None,
+        end_date: Optional[date] = None,
+        as_of: Optional[date] = None
+    ) -> Dict:
+        """
+        Change an expense's total or end date and update only the affected periods.
+        
+        Periods that ended before the period containing as_of are closed and
+        kept as stored, as are historical rows (days_in_quarter == 0). The
+        period containing as_of must start after the last locked day of the
+        period closes (services/period_close.py), so a past effective date
+        cannot reopen a closed quarter. The
+        remaining amount (new total minus closed allocations) is split over
+        the open periods through the new end date with the expense's
+        allocation method; rows whose values change
+        are updated, new periods are inserted and obsolete ones deleted, all
+        in one transaction. Early termination is an end date change with the
+        same total.
+        
+        Args:
+            db: Database session
+            expense: Expense record to change
+            total_amount: New total amount (None keeps the current one)
+            end_date: New end date (None keeps the current one)
+            as_of: Edit date deciding which periods are closed (default today)
+        
+        Returns:
+            Dictionary with inserted/updated/deleted/unchanged row counts
+        
+        Raises:
+            ValueError: If the change reaches into a closed or locked period
+        """
+        as_of = _as_date(as_of or date.today())
+        new_total = expense.total_amount if total_amount is None else to_dong(total_amount)
+        new_end = expense.end_date if end_date is None else _as_date(end_date)
+        counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+        
+        if new_total == expense.total_amount and new_end == expense.end_date:
+            return counts
+        if new_end < expense.start_date:
+            raise ValueError("Ngày kết thúc phải sau ngày bắt đầu")
+        
+        system_rows = [a for a in expense.allocations if a.days_in_quarter > 0]
+        period_type = system_rows[0].period_type if system_rows else PERIOD_QUARTER
+        
+        # First day of the first open period
+        cal = calendar_covering(np.array([as_of.toordinal()]), period_type)
+        rebase = max(expense.start_date, cal.dates_at(cal.index_of(as_of))[0])
+        closed_rows = [a for a in system_rows if a.end_date < rebase]
+        open_rows = [a for a in system_rows if a.end_date >= rebase]
+        closed_amount = sum(a.amount for a in closed_rows)
+        
+        from models.database import Allocation, PeriodClose
+        
+        locked = db.execute(select(func.max(PeriodClose.close_date))).scalar()
+        if locked is not None and rebase <= locked:
+            raise ValueError(
+                f"Kỳ chứa ngày hiệu lực đã khóa sổ (đến ngày {locked.strftime('%d/%m/%Y')}), "
+                "hãy chọn ngày hiệu lực sau ngày khóa sổ"
+            )
+        if new_end < rebase:
+            raise ValueError("Ngày kết thúc mới nằm trong kỳ đã khóa sổ")
+        if new_total < closed_amount:
+            raise ValueError("Tổng tiền mới nhỏ hơn số đã phân bổ trong các kỳ đã khóa sổ")
+        
+        schedule = AllocationService.calculate_allocations(
+            new_total, expense.start_date, new_end, period_type,
+            expense.allocation_method, expense.allocation_params,
+            rebase_date=rebase, rebase_accumulated=closed_amount
+        )
+        
+        existing = {
+            (a.year, a.period if a.period is not None else a.quarter): a for a in open_rows
         }
+        try:
+            for period, quarter, year, amount, days, start, end in schedule.iter_periods():
+                alloc = existing.pop((year, period), None)
+                if alloc is None:
+                    expense.allocations.append(Allocation(
+                        period_type=period_type,
+                        period=period,
+                        quarter=quarter,
+                        year=year,
+                        amount=amount,
+                        days_in_quarter=days,
+                        start_date=start,
+                        end_date=end
+                    ))
+                    counts['inserted'] += 1
+                elif (alloc.amount, alloc.days_in_quarter, alloc.start_date, alloc.end_date) != (amount, days, start, end):
+                    alloc.period = period
+                    alloc.quarter = quarter
+                    alloc.amount = amount
+                    alloc.days_in_quarter = days
+                    alloc.start_date = start
+                    alloc.end_date = end
+                    counts['updated'] += 1
+                else:
+                    counts['unchanged'] += 1
+            
+            for alloc in existing.values():
+                expense.allocations.remove(alloc)
+                counts['deleted'] += 1
+            
+            expense.total_amount = new_total
+            expense.end_date = new_end
+            expense.allocation_months = AllocationService.calculate_months_between_dates(
+                expense.start_date, new_end
+            )
+            expense.rebase_date = rebase if closed_rows else None
+            expense.rebase_accumulated = closed_amount if closed_rows else 0
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        
+        return counts
+    
+    @staticmethod
+    def get_schedule(
+        total_amount: int,
+        start_date: date,
+        end_date: date,
+        period_type: str = PERIOD_QUARTER,
+        method: Optional[str] = None,
+        params: Optional[Dict] = None
+    ) -> AllocationSchedule:
+        """
+        Get an allocation schedule through the shared LRU cache.
+        
+        Args:
+            total_amount: Total amount to allocate
+            start_date: Allocation start date
+            end_date: Allocation end date (inclusive)
+            period_type: 'month', 'quarter' or 'year'
+            method: Allocation method name (default daily pro-rata)
+            params: Method parameters
+        
+        Returns:
+            Immutable AllocationSchedule
+        """
+        key = (
+            to_dong(total_amount), _as_date(start_date), _as_date(end_date), period_type,
+            active_start_month(), method or METHOD_DAILY, params_key(params)
+        )
+        schedule = AllocationService._schedule_cache.get(key)
+        if schedule is None:
+            schedule = AllocationService.calculate_allocations(*key[:4], method, params)
+            AllocationService._schedule_cache.put(key, schedule)
+        return schedule
+    
+    @staticmethod
+    def get_schedules(
+        total_amounts: Sequence[int],
+        start_dates: Sequence[date],
+        end_dates: Sequence[date],
+        period_type: str = PERIOD_QUARTER,
+        methods: Optional[Sequence[Optional[str]]] = None,
+        params: Optional[Sequence[Optional[Dict]]] = None
+    ) -> List[AllocationSchedule]:
+        """
+        Get schedules for many expenses through the shared LRU cache.
+        
+        Cache misses are de-duplicated and computed together with
+        calculate_batch_schedules.
+        
+        Returns:
+            List of immutable schedules aligned with the inputs
+        """
+        cache = AllocationService._schedule_cache
+        start_month = active_start_month()
+        methods = methods if methods is not None else [None] * len(total_amounts)
+        params = params if params is not None else [None] * len(total_amounts)
+        keys = [
+            (to_dong(t), _as_date(s), _as_date(e), period_type, start_month, m or METHOD_DAILY, params_key(p))
+            for t, s, e, m, p in zip(total_amounts, start_dates, end_dates, methods, params)
+        ]
+        
+        found = {}
+        missing = []
+        missing_params = []
+        for key, p in zip(keys, params):
+            if key in found:
+                continue
+            schedule = cache.get(key)
+            if schedule is None:
+                found[key] = None
+                missing.append(key)
+                missing_params.append(p)
+            else:
+                found[key] = schedule
+        
+        if missing:
+            schedules = AllocationService.calculate_batch_schedules(
+                [k[0] for k in missing], [k[1] for k in missing], [k[2] for k in missing], period_type,
+                [k[5] for k in missing], missing_params
+            )
+            for key, schedule in zip(missing, schedules):
+                found[key] = schedule
+                cache.put(key, schedule)
+        
+        return [found[key] for key in keys]
+    
+    @staticmethod
+    def schedule_cache_info() -> Dict:
+        """Get hit/miss counters and size of the schedule cache."""
+        return AllocationService._schedule_cache.info()
+    
+    @staticmethod
+    def clear_schedule_cache():
+        """Drop every cached schedule."""
+        AllocationService._schedule_cache.clear()
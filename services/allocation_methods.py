@@ -0,0 +1,395 @@
+"""Allocation method registry: daily pro-rata, straight-line monthly and tranche schedules."""
+import json
+from calendar import monthrange
+from datetime import date
+from math import lcm
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from utils.fiscal_calendar import ordinals_to_datetime64
+
+METHOD_DAILY = 'daily'
+METHOD_MONTHLY = 'monthly'
+METHOD_TRANCHE = 'tranche'
+
+# Every month gets the same weight: the LCM of 28, 29, 30 and 31 days keeps
+# the per-day share of any month an integer
+MONTH_WEIGHT = 377_580
+
+
+def _mul_div_floor(a, b, c):
+    """
+    Compute floor(a * b / c) for non-negative integers without int64 overflow.
+
+    Works element-wise on NumPy arrays as well as on Python ints.
+    """
+    return (a // c) * b + (a % c) * b // c
+
+
+def params_key(params: Optional[Dict]) -> Optional[str]:
+    """Get a hashable, canonical form of method parameters (for cache keys)."""
+    return None if not params else json.dumps(params, sort_keys=True, default=str)
+
+
+class AllocationMethod:
+    """
+    Base class of allocation methods.
+
+    A method defines how much of an expense is allocated through any day.
+    Schedules are differences of that amount at period ends, so every
+    method sums exactly to the total. After a schedule edit, the amount
+    still to allocate (total - base) is spread from the rebase origin with
+    the same method.
+
+    Subclasses implement accumulated (scalar, Python ints) and
+    accumulated_batch (NumPy arrays) with identical results.
+    """
+
+    name = ''
+    label = ''
+
+    def validate_params(self, params: Optional[Dict]) -> Optional[Dict]:
+        """Check method parameters, returning the normalized form."""
+        return None
+
+    def accumulated(
+        self,
+        total: int,
+        start: int,
+        end: int,
+        as_of: int,
+        params: Optional[Dict] = None,
+        origin: Optional[int] = None,
+        base: int = 0
+    ) -> int:
+        """
+        Amount allocated through day ordinal as_of.
+
+        Args:
+            total: Total amount in whole đồng
+            start: Start day ordinal
+            end: End day ordinal (inclusive)
+            as_of: Day ordinal to evaluate
+            params: Method parameters
+            origin: Day ordinal the split restarts from (default start)
+            base: Amount allocated before origin
+
+        Returns:
+            int: Allocated amount
+        """
+        raise NotImplementedError
+
+    def accumulated_batch(
+        self,
+        totals: np.ndarray,
+        starts: np.ndarray,
+        ends: np.ndarray,
+        as_of,
+        params: Optional[Sequence[Optional[Dict]]] = None,
+        origins: Optional[np.ndarray] = None,
+        base: Optional[np.ndarray] = None,
+        index: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """
+        Vectorized accumulated over many expenses.
+
+        Args:
+            totals, starts, ends: Per-expense int64 arrays (day ordinals)
+            as_of: Day ordinals, shaped (n,) or (n, periods) per expense, or
+                (m,) evaluation points mapped to expenses by index
+            params: Per-expense method parameters
+            origins: Per-expense origin ordinals (default starts)
+            base: Per-expense amounts allocated before origin (default 0)
+            index: Expense position of each evaluation point
+
+        Returns:
+            np.ndarray: int64 amounts shaped like as_of
+        """
+        raise NotImplementedError
+
+
+class WeightedMethod(AllocationMethod):
+    """
+    Method defined by an integer cumulative day weight W.
+
+    Allocated through x = base + floor((total - base) * (W(x) - W(origin - 1))
+    / (W(end) - W(origin - 1))).
+    """
+
+    def weight(self, ordinal: int) -> int:
+        """Cumulative weight through a day ordinal (scalar)."""
+        raise NotImplementedError
+
+    def weights(self, ordinals: np.ndarray) -> np.ndarray:
+        """Cumulative weight through each day ordinal (vectorized)."""
+        raise NotImplementedError
+
+    def accumulated(self, total, start, end, as_of, params=None, origin=None, base=0):
+        origin = start if origin is None else origin
+        if end < origin:
+            return base
+        low = self.weight(origin - 1)
+        span = self.weight(end) - low
+        elapsed = self.weight(min(max(as_of, origin - 1), end)) - low
+        return base + _mul_div_floor(total - base, elapsed, span)
+
+    def accumulated_batch(self, totals, starts, ends, as_of, params=None, origins=None, base=None, index=None):
+        origins = starts if origins is None else origins
+        base = np.zeros(len(totals), dtype=np.int64) if base is None else base
+        as_of = np.asarray(as_of, dtype=np.int64)
+
+        if index is not None:
+            totals, origins, ends, base = totals[index], origins[index], ends[index], base[index]
+        elif as_of.ndim == 2:
+            totals, origins, ends, base = totals[:, None], origins[:, None], ends[:, None], base[:, None]
+
+        valid = ends >= origins
+        low = self.weights(origins - 1)
+        span = np.where(valid, self.weights(ends) - low, 1)
+        elapsed = self.weights(np.clip(as_of, origins - 1, np.maximum(ends, origins - 1))) - low
+        return base + np.where(valid, _mul_div_floor(totals - base, elapsed, span), 0)
+
+
+class DailyMethod(WeightedMethod):
+    """Daily pro-rata: every day of the term carries the same share."""
+
+    name = METHOD_DAILY
+    label = 'Theo ngày'
+
+    def weight(self, ordinal):
+        return ordinal
+
+    def weights(self, ordinals):
+        return ordinals
+
+
+class MonthlyMethod(WeightedMethod):
+    """
+    Straight-line per month: every calendar month carries the same share.
+
+    Partial first and last months get their share of days in that month.
+    """
+
+    name = METHOD_MONTHLY
+    label = 'Đều theo tháng'
+
+    def weight(self, ordinal):
+        day = date.fromordinal(ordinal)
+        months = (day.year - 1970) * 12 + day.month - 1
+        return months * MONTH_WEIGHT + day.day * (MONTH_WEIGHT // monthrange(day.year, day.month)[1])
+
+    def weights(self, ordinals):
+        days = ordinals_to_datetime64(ordinals)
+        months = days.astype('datetime64[M]')
+        month_start = months.astype('datetime64[D]')
+        days_in_month = ((months + 1).astype('datetime64[D]') - month_start).astype(np.int64)
+        day = (days - month_start).astype(np.int64) + 1
+        return months.astype(np.int64) * MONTH_WEIGHT + day * (MONTH_WEIGHT // days_in_month)
+
+
+class TrancheMethod(AllocationMethod):
+    """
+    Custom tranches: consecutive segments with their own weight.
+
+    params = {'tranches': [{'end_date': 'YYYY-MM-DD', 'weight': amount}, ...]}.
+    The first tranche starts on the expense start date and each following
+    one the day after the previous end; the last tranche runs to the
+    expense end date. The total is split between tranches by weight
+    (largest remainder) and each tranche is spread daily over its days.
+    """
+
+    name = METHOD_TRANCHE
+    label = 'Theo đợt'
+
+    def validate_params(self, params):
+        tranches = (params or {}).get('tranches') or []
+        if not tranches:
+            raise ValueError("Phương pháp theo đợt cần ít nhất một đợt")
+
+        normalized = []
+        previous_end = None
+        for tranche in tranches:
+            end_date = pd.Timestamp(tranche['end_date']).date()
+            weight = int(round(float(tranche.get('weight', tranche.get('amount', 0)))))
+            if weight < 0:
+                raise ValueError("Trọng số của đợt không được âm")
+            if previous_end is not None and end_date <= previous_end:
+                raise ValueError("Ngày kết thúc các đợt phải tăng dần")
+            previous_end = end_date
+            normalized.append({'end_date': end_date.isoformat(), 'weight': weight})
+
+        if sum(t['weight'] for t in normalized) <= 0:
+            raise ValueError("Tổng trọng số các đợt phải lớn hơn 0")
+        return {'tranches': normalized}
+
+    @staticmethod
+    def segments(
+        total: int,
+        start: int,
+        end: int,
+        params: Dict,
+        origin: Optional[int] = None,
+        base: int = 0
+    ) -> List[Tuple[int, int, int]]:
+        """
+        Get the (first day ordinal, days, amount) segments still to allocate.
+
+        Segments before origin are dropped and a tranche cut by origin keeps
+        the weight of its remaining days. The amounts sum to total - base.
+        """
+        origin = start if origin is None else origin
+        tranches = params['tranches']
+        bounds = []
+        segment_start = start
+        for i, tranche in enumerate(tranches):
+            segment_end = end if i == len(tranches) - 1 else min(date.fromisoformat(tranche['end_date']).toordinal(), end)
+            if segment_end >= segment_start:
+                bounds.append((segment_start, segment_end, tranche['weight']))
+            segment_start = segment_end + 1
+
+        remaining = [
+            (max(s, origin), e, w, e - s + 1) for s, e, w in bounds if e >= origin
+        ]
+        if not remaining:
+            return []
+
+        # Weight of the remaining days of each tranche, on a common denominator
+        lengths = [full for _, _, _, full in remaining]
+        scale = lcm(*lengths)
+        weights = [w * (e - s + 1) * (scale // full) for s, e, w, full in remaining]
+        weight_total = sum(weights)
+        if weight_total == 0:
+            weights = [e - s + 1 for s, e, _, _ in remaining]
+            weight_total = sum(weights)
+
+        # Largest-remainder split of the amount still to allocate
+        amount = total - base
+        segments = []
+        cumulative_weight = 0
+        allocated = 0
+        for (s, e, _, _), w in zip(remaining, weights):
+            cumulative_weight += w
+            cumulative = amount * cumulative_weight // weight_total
+            segments.append((s, e - s + 1, cumulative - allocated))
+            allocated = cumulative
+        return segments
+
+    def accumulated(self, total, start, end, as_of, params=None, origin=None, base=0):
+        allocated = base
+        for segment_start, days, amount in self.segments(total, start, end, params, origin, base):
+            elapsed = min(max(as_of - segment_start + 1, 0), days)
+            allocated += _mul_div_floor(amount, elapsed, days)
+        return allocated
+
+    def accumulated_batch(self, totals, starts, ends, as_of, params=None, origins=None, base=None, index=None):
+        origins = starts if origins is None else origins
+        base = np.zeros(len(totals), dtype=np.int64) if base is None else base
+        as_of = np.asarray(as_of, dtype=np.int64)
+        shape = as_of.shape
+
+        if index is None:
+            index = np.repeat(np.arange(len(totals)), as_of.size // max(len(totals), 1))
+        as_of = as_of.reshape(-1)
+
+        # Segment table of every expense (tranche lists differ in length)
+        seg_start, seg_days, seg_amount, seg_count = [], [], [], []
+        for k in range(len(totals)):
+            segments = self.segments(
+                int(totals[k]), int(starts[k]), int(ends[k]), params[k], int(origins[k]), int(base[k])
+            )
+            seg_count.append(len(segments))
+            for s, days, amount in segments:
+                seg_start.append(s)
+                seg_days.append(days)
+                seg_amount.append(amount)
+
+        seg_start = np.array(seg_start, dtype=np.int64)
+        seg_days = np.array(seg_days, dtype=np.int64)
+        seg_amount = np.array(seg_amount, dtype=np.int64)
+        seg_count = np.array(seg_count, dtype=np.int64)
+        seg_offset = np.cumsum(seg_count) - seg_count
+
+        # One row per (evaluation point, segment of its expense)
+        counts = seg_count[index]
+        point = np.repeat(np.arange(len(as_of)), counts)
+        position = np.arange(len(point)) - np.repeat(np.cumsum(counts) - counts, counts)
+        seg = seg_offset[index][point] + position
+
+        elapsed = np.clip(as_of[point] - seg_start[seg] + 1, 0, seg_days[seg])
+        result = base[index].astype(np.int64)
+        np.add.at(result, point, _mul_div_floor(seg_amount[seg], elapsed, seg_days[seg]))
+        return result.reshape(shape)
+
+
+ALLOCATION_METHODS: Dict[str, AllocationMethod] = {}
+
+
+def register_method(method: AllocationMethod) -> AllocationMethod:
+    """Add an allocation method to the registry."""
+    ALLOCATION_METHODS[method.name] = method
+    return method
+
+
+def get_method(name: Optional[str]) -> AllocationMethod:
+    """Get a registered method by name (None means daily pro-rata)."""
+    try:
+        return ALLOCATION_METHODS[name or METHOD_DAILY]
+    except KeyError:
+        raise ValueError(f"Unknown allocation method: {name}")
+
+
+register_method(DailyMethod())
+register_method(MonthlyMethod())
+register_method(TrancheMethod())
+
+# Display labels for the UI
+METHOD_LABELS = {name: method.label for name, method in ALLOCATION_METHODS.items()}
+
+
+def accumulated_grouped(
+    methods: Optional[Sequence[Optional[str]]],
+    totals: np.ndarray,
+    starts: np.ndarray,
+    ends: np.ndarray,
+    as_of,
+    params: Optional[Sequence[Optional[Dict]]] = None,
+    origins: Optional[np.ndarray] = None,
+    base: Optional[np.ndarray] = None,
+    index: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Evaluate accumulated amounts for expenses with mixed methods.
+
+    Expenses are grouped by method and each group runs as one
+    accumulated_batch call. Arguments are as for accumulated_batch plus
+    the method name of each expense (None means all daily).
+    """
+    n = len(totals)
+    origins = starts if origins is None else origins
+    base = np.zeros(n, dtype=np.int64) if base is None else base
+    as_of = np.asarray(as_of, dtype=np.int64)
+    if index is None and as_of.ndim == 0:
+        as_of = np.full(n, as_of, dtype=np.int64)
+
+    names = np.array([m or METHOD_DAILY for m in methods], dtype=object) if methods is not None else None
+    if names is None or (names == METHOD_DAILY).all():
+        return get_method(METHOD_DAILY).accumulated_batch(totals, starts, ends, as_of, None, origins, base, index)
+
+    result = np.zeros(as_of.shape, dtype=np.int64)
+    for name in pd.unique(names):
+        members = np.flatnonzero(names == name)
+        group_params = [params[i] for i in members] if params is not None else [None] * len(members)
+        if index is None:
+            points = members
+            group_index = None
+        else:
+            # Evaluation points of this group's expenses, re-indexed within the group
+            local = np.full(n, -1, dtype=np.int64)
+            local[members] = np.arange(len(members))
+            points = np.flatnonzero(local[index] >= 0)
+            group_index = local[index[points]]
+        result[points] = get_method(name).accumulated_batch(
+            totals[members], starts[members], ends[members], as_of[points],
+            group_params, origins[members], base[members], group_index
+        )
+    return result
@@ -0,0 +1,314 @@
+"""Per-period allocation totals maintained incrementally on flush."""
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import pandas as pd
+from sqlalchemy import delete, event, func, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+from models.database import SessionLocal, Expense, Allocation, AllocationTotal
+from services.allocation import AllocationService
+from services.expense_index import ExpenseIndexService
+from utils.fiscal_calendar import PERIOD_YEAR
+
+# session.info key holding expense contributions read before a flush
+_SNAPSHOT_KEY = 'allocation_totals_before'
+
+TotalKey = Tuple[int, int, str, str]
+
+
+class AllocationTotalService:
+    """
+    Service reading and maintaining the allocation_totals summary table.
+
+    Totals are kept per fiscal quarter. Yearly rows are spread over the
+    quarters they cover pro-rata by days, so a yearly schedule does not
+    land entirely in Q4; each share counts as one row of its quarter.
+    """
+
+    @staticmethod
+    def _yearly_shares(
+        connection, expense_ids: Optional[Iterable[int]] = None, start_month: Optional[int] = None
+    ) -> pd.DataFrame:
+        """
+        Split the yearly system rows of some expenses (default all) into fiscal quarters.
+
+        Quarters follow the fiscal calendar starting in start_month
+        (default the configured one).
+
+        Returns:
+            DataFrame with expense_id, year, quarter, account_number,
+            sub_code and amount, one row per quarter share
+        """
+        query = (
+            select(
+                Allocation.expense_id, Expense.account_number, Expense.sub_code,
+                Allocation.amount, Allocation.start_date, Allocation.end_date
+            )
+            .join(Expense, Allocation.expense_id == Expense.id)
+            .where(Allocation.days_in_quarter > 0, Allocation.period_type == PERIOD_YEAR)
+        )
+        if expense_ids is not None:
+            query = query.where(ExpenseIndexService.id_filter(Allocation.expense_id, expense_ids))
+        result = connection.execute(query)
+        rows = pd.DataFrame(result.all(), columns=list(result.keys()))
+        columns = ['expense_id', 'year', 'quarter', 'account_number', 'sub_code', 'amount']
+        if rows.empty:
+            return pd.DataFrame(columns=columns)
+
+        # Same daily split as a quarterly schedule over the row's dates
+        shares = AllocationService.calculate_batch_allocations(
+            rows['amount'], rows['start_date'], rows['end_date'], start_month=start_month
+        )
+        source = rows.iloc[shares['expense_index'].to_numpy()].reset_index(drop=True)
+        return pd.DataFrame({
+            'expense_id': source['expense_id'],
+            'year': shares['year'].to_numpy(),
+            'quarter': shares['quarter'].to_numpy(),
+            'account_number': source['account_number'],
+            'sub_code': source['sub_code'],
+            'amount': shares['amount'].to_numpy()
+        })[columns]
+
+    @staticmethod
+    def _contributions(connection, expense_ids: Iterable[int]) -> Dict[int, Dict[TotalKey, Tuple[int, int]]]:
+        """
+        Get (amount, row count) of the system rows of some expenses per summary key.
+
+        Returns:
+            Dict expense_id -> {(year, quarter, account_number, sub_code): (amount, count)}
+        """
+        expense_ids = list(expense_ids)
+        query = (
+            select(
+                Allocation.expense_id,
+                Allocation.year,
+                Allocation.quarter,
+                Expense.account_number,
+                Expense.sub_code,
+                func.sum(Allocation.amount),
+                func.count()
+            )
+            .join(Expense, Allocation.expense_id == Expense.id)
+            .where(
+                Allocation.days_in_quarter > 0,
+                Allocation.period_type != PERIOD_YEAR,
+                ExpenseIndexService.id_filter(Allocation.expense_id, expense_ids)
+            )
+            .group_by(Allocation.expense_id, Allocation.year, Allocation.quarter, Expense.account_number, Expense.sub_code)
+        )
+        contributions = defaultdict(dict)
+        for expense_id, year, quarter, account_number, sub_code, amount, count in connection.execute(query):
+            contributions[expense_id][(year, quarter, account_number, sub_code)] = (amount, count)
+
+        shares = AllocationTotalService._yearly_shares(connection, expense_ids)
+        if not shares.empty:
+            grouped = shares.groupby(['expense_id', 'year', 'quarter', 'account_number', 'sub_code'])['amount'].agg(['sum', 'size'])
+            for (expense_id, *key), amount, count in zip(grouped.index, grouped['sum'].tolist(), grouped['size'].tolist()):
+                old_amount, old_count = contributions[expense_id].get(tuple(key), (0, 0))
+                contributions[expense_id][tuple(key)] = (old_amount + amount, old_count + count)
+        return contributions
+
+    @staticmethod
+    def _add_rows(connection, rows: List[Dict]):
+        """Add amounts and counts to summary rows, creating missing ones and dropping emptied ones."""
+        if not rows:
+            return
+        upsert = insert(AllocationTotal).values(rows)
+        connection.execute(upsert.on_conflict_do_update(
+            index_elements=['year', 'quarter', 'account_number', 'sub_code'],
+            set_={
+                'amount': AllocationTotal.amount + upsert.excluded.amount,
+                'allocation_count': AllocationTotal.allocation_count + upsert.excluded.allocation_count,
+                'expense_count': AllocationTotal.expense_count + upsert.excluded.expense_count
+            }
+        ))
+        connection.execute(delete(AllocationTotal).where(AllocationTotal.allocation_count <= 0))
+
+    @staticmethod
+    def apply_changes(connection, before: Dict, after: Dict):
+        """
+        Add the difference between two contribution snapshots to the summary table.
+
+        Args:
+            connection: Connection of the transaction being flushed
+            before: Contributions of the changed expenses before the flush
+            after: Contributions of the same expenses after the flush
+        """
+        deltas = defaultdict(lambda: [0, 0, 0])
+        for expense_id in set(before) | set(after):
+            old, new = before.get(expense_id, {}), after.get(expense_id, {})
+            for key in set(old) | set(new):
+                old_amount, old_count = old.get(key, (0, 0))
+                new_amount, new_count = new.get(key, (0, 0))
+                delta = deltas[key]
+                delta[0] += new_amount - old_amount
+                delta[1] += new_count - old_count
+                delta[2] += (key in new) - (key in old)
+
+        rows = [
+            {
+                'year': year, 'quarter': quarter, 'account_number': account_number, 'sub_code': sub_code,
+                'amount': amount, 'allocation_count': count, 'expense_count': expenses
+            }
+            for (year, quarter, account_number, sub_code), (amount, count, expenses) in deltas.items()
+            if amount or count or expenses
+        ]
+        AllocationTotalService._add_rows(connection, rows)
+
+    @staticmethod
+    def rebuild(db, start_month: Optional[int] = None) -> int:
+        """
+        Recompute the whole summary table from the allocations table (repair).
+
+        Args:
+            db: Database session; the rebuild is committed
+            start_month: Fiscal year start month the yearly rows are split
+                under (default the configured one)
+
+        Returns:
+            Number of summary rows written
+        """
+        db.execute(delete(AllocationTotal))
+        totals = (
+            select(
+                Allocation.year,
+                Allocation.quarter,
+                Expense.account_number,
+                Expense.sub_code,
+                func.sum(Allocation.amount),
+                func.count(),
+                func.count(Allocation.expense_id.distinct())
+            )
+            .join(Expense, Allocation.expense_id == Expense.id)
+            .where(Allocation.days_in_quarter > 0, Allocation.period_type != PERIOD_YEAR)
+            .group_by(Allocation.year, Allocation.quarter, Expense.account_number, Expense.sub_code)
+        )
+        db.execute(insert(AllocationTotal).from_select(
+            ['year', 'quarter', 'account_number', 'sub_code', 'amount', 'allocation_count', 'expense_count'],
+            totals
+        ))
+
+        # An expense keeps one period type, so yearly shares add to other expenses' counts
+        shares = AllocationTotalService._yearly_shares(db.connection(), start_month=start_month)
+        if not shares.empty:
+            grouped = shares.groupby(['year', 'quarter', 'account_number', 'sub_code']).agg(
+                amount=('amount', 'sum'), allocation_count=('amount', 'size'), expense_count=('expense_id', 'nunique')
+            )
+            AllocationTotalService._add_rows(db.connection(), [
+                {'year': year, 'quarter': quarter, 'account_number': account_number, 'sub_code': sub_code,
+                 'amount': amount, 'allocation_count': count, 'expense_count': expenses}
+                for (year, quarter, account_number, sub_code), amount, count, expenses in zip(
+                    grouped.index, grouped['amount'].tolist(), grouped['allocation_count'].tolist(),
+                    grouped['expense_count'].tolist()
+                )
+            ])
+        db.commit()
+        return db.execute(select(func.count()).select_from(AllocationTotal)).scalar()
+
+    @staticmethod
+    def ensure_built(db) -> bool:
+        """
+        Rebuild the summary table if it is empty while system allocations exist.
+
+        Covers databases created before the table existed and restored backups.
+
+        Returns:
+            bool: Whether a rebuild was done
+        """
+        if db.execute(select(AllocationTotal.year).limit(1)).first() is not None:
+            return False
+        if db.execute(select(Allocation.id).where(Allocation.days_in_quarter > 0).limit(1)).first() is None:
+            return False
+        AllocationTotalService.rebuild(db)
+        return True
+
+    @staticmethod
+    def period_totals(db, year: Optional[int] = None, quarter: Optional[int] = None) -> pd.DataFrame:
+        """
+        Get summary rows, optionally for one year and quarter.
+
+        Returns:
+            DataFrame with year, quarter, account_number, sub_code, amount,
+            allocation_count and expense_count, in period then account order
+        """
+        query = select(
+            AllocationTotal.year,
+            AllocationTotal.quarter,
+            AllocationTotal.account_number,
+            AllocationTotal.sub_code,
+            AllocationTotal.amount,
+            AllocationTotal.allocation_count,
+            AllocationTotal.expense_count
+        )
+        if year is not None:
+            query = query.where(AllocationTotal.year == year)
+        if quarter is not None:
+            query = query.where(AllocationTotal.quarter == quarter)
+        query = query.order_by(
+            AllocationTotal.year, AllocationTotal.quarter, AllocationTotal.account_number, AllocationTotal.sub_code
+        )
+        result = db.execute(query)
+        return pd.DataFrame(result.all(), columns=list(result.keys()))
+
+    @staticmethod
+    def quarter_pivot(db, year: Optional[int] = None, quarter: Optional[int] = None) -> pd.DataFrame:
+        """
+        Pivot summary amounts to one row per account/sub code and one column per quarter.
+
+        Returns:
+            DataFrame indexed by (account_number, sub_code) with 'Qq/yyyy' columns
+        """
+        totals = AllocationTotalService.period_totals(db, year, quarter)
+        if totals.empty:
+            return pd.DataFrame(index=pd.MultiIndex.from_tuples([], names=['account_number', 'sub_code']))
+        pivot = totals.pivot_table(
+            index=['account_number', 'sub_code'], columns=['year', 'quarter'], values='amount', aggfunc='sum', fill_value=0
+        )
+        pivot.columns = [f"Q{q}/{y}" for y, q in pivot.columns]
+        return pivot
+
+
+def _changed_expense_ids(session) -> Set[int]:
+    """Get ids of persisted expenses whose system allocation totals a flush may change."""
+    expense_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        state = inspect(obj)
+        if isinstance(obj, Allocation):
+            expense_ids.update(v for v in state.attrs.expense_id.history.sum() if v is not None)
+            expense_ids.update(e.id for e in state.attrs.expense.history.sum() if e is not None and e.id is not None)
+        elif isinstance(obj, Expense) and obj.id is not None:
+            if (
+                obj in session.deleted
+                or state.attrs.account_number.history.has_changes()
+                or state.attrs.sub_code.history.has_changes()
+            ):
+                expense_ids.add(obj.id)
+    return expense_ids
+
+
+@event.listens_for(SessionLocal, 'before_flush')
+def _snapshot_allocation_totals(session, flush_context, instances):
+    """Read the contributions of expenses about to change."""
+    expense_ids = _changed_expense_ids(session)
+    before = AllocationTotalService._contributions(session.connection(), expense_ids) if expense_ids else {}
+    session.info[_SNAPSHOT_KEY] = (expense_ids, before)
+
+
+@event.listens_for(SessionLocal, 'after_flush')
+def _update_allocation_totals(session, flush_context):
+    """Apply the flushed changes to allocation_totals in the same transaction."""
+    expense_ids, before = session.info.pop(_SNAPSHOT_KEY, (set(), {}))
+    # New expenses and rows have ids now
+    expense_ids = expense_ids | _changed_expense_ids(session)
+    if not expense_ids:
+        return
+    connection = session.connection()
+    after = AllocationTotalService._contributions(connection, expense_ids)
+    AllocationTotalService.apply_changes(connection, before, after)
+
+
+if __name__ == "__main__":
+    db = SessionLocal()
+    try:
+        print(f"[OK] Rebuilt allocation_totals: {AllocationTotalService.rebuild(db)} rows")
+    finally:
+        db.close()
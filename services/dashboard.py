@@ -0,0 +1,132 @@
+"""Per-quarter series for the dashboard, built from the pre-aggregated summary tables."""
+from datetime import date
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, select
+from models.database import Expense, Tag, ExpenseTag
+from services.allocation_totals import AllocationTotalService
+from services.pivot import NO_TAG
+from services.report import ReportService
+from utils.fiscal_calendar import active_start_month
+from utils.helpers import format_quarter
+
+SERIES_KEYS = ['account_number', 'sub_code']
+
+
+class DashboardService:
+    """Service building the dashboard series; results are cached until the next committed write."""
+
+    @staticmethod
+    def quarter_keys(dates) -> tuple:
+        """
+        Get the fiscal (year, quarter) of many dates in one array pass.
+
+        Returns:
+            Tuple of int64 arrays (year, quarter)
+        """
+        # Months since the first fiscal year starting after 1970-01
+        days = pd.to_datetime(pd.Series(dates)).to_numpy(dtype='datetime64[D]')
+        months = days.astype('datetime64[M]').astype(np.int64) - (active_start_month() - 1)
+        return months // 12 + 1970, months % 12 // 3 + 1
+
+    @staticmethod
+    def quarter_ends(years, quarters) -> np.ndarray:
+        """Get the last day of many fiscal quarters as datetime64[D]."""
+        months = (np.asarray(years) - 1970) * 12 + active_start_month() - 1 + np.asarray(quarters) * 3
+        return months.astype('datetime64[M]').astype('datetime64[D]') - 1
+
+    @staticmethod
+    def quarterly_series(db) -> pd.DataFrame:
+        """
+        Get additions, amortization and closing balance per fiscal quarter and account/sub code.
+
+        Amortization is read from allocation_totals and additions from the
+        expense totals grouped by start date, so no allocation row is
+        loaded; closing balances are their running difference. Every
+        quarter between the first and last one with data is listed for
+        every account/sub code.
+
+        Returns:
+            DataFrame with year, quarter, period_label, end_date,
+            account_number, sub_code, additions, amortization and closing,
+            in period then account order
+        """
+        columns = ['year', 'quarter', 'period_label', 'end_date'] + SERIES_KEYS + ['additions', 'amortization', 'closing']
+        amortization = AllocationTotalService.period_totals(db)[['year', 'quarter'] + SERIES_KEYS + ['amount']]
+        result = db.execute(
+            select(Expense.start_date, Expense.account_number, Expense.sub_code, func.sum(Expense.total_amount).label('amount'))
+            .group_by(Expense.start_date, Expense.account_number, Expense.sub_code)
+        )
+        additions = pd.DataFrame(result.all(), columns=list(result.keys()))
+        if amortization.empty and additions.empty:
+            return pd.DataFrame(columns=columns)
+
+        years, quarters = DashboardService.quarter_keys(additions['start_date'])
+        additions = additions.assign(year=years, quarter=quarters).drop(columns='start_date')
+
+        # Quarters as one running number, so gaps can be filled with a range
+        frames = []
+        for name, frame in [('additions', additions), ('amortization', amortization)]:
+            frames.append(
+                frame.assign(sequence=frame['year'].astype(np.int64) * 4 + frame['quarter'] - 1)
+                .groupby(['sequence'] + SERIES_KEYS)['amount'].sum()
+                .rename(name)
+            )
+        flows = pd.concat(frames, axis=1).fillna(0).astype(np.int64).unstack(SERIES_KEYS, fill_value=0)
+        sequence = np.arange(flows.index.min(), flows.index.max() + 1)
+        flows = flows.reindex(sequence, fill_value=0)
+        additions, amortization = flows['additions'], flows['amortization']
+        groups = additions.columns
+
+        series = pd.DataFrame({
+            'year': np.repeat(sequence // 4, len(groups)),
+            'quarter': np.repeat(sequence % 4 + 1, len(groups)),
+            'account_number': np.tile(groups.get_level_values(0), len(sequence)),
+            'sub_code': np.tile(groups.get_level_values(1), len(sequence)),
+            'additions': additions.to_numpy().ravel(),
+            'amortization': amortization[groups].to_numpy().ravel(),
+            'closing': (additions - amortization[groups]).cumsum().to_numpy().ravel()
+        })
+        series['period_label'] = [format_quarter(q, y) for q, y in zip(series['quarter'], series['year'])]
+        series['end_date'] = DashboardService.quarter_ends(series['year'], series['quarter'])
+        return series.sort_values(['year', 'quarter'] + SERIES_KEYS, kind='stable').reset_index(drop=True)[columns]
+
+    @staticmethod
+    def balance_by_tag(db, as_of: date) -> pd.DataFrame:
+        """
+        Get the balance on a date per tag with one aggregate query.
+
+        Like the quarterly series, only expenses started by as_of count.
+        Expenses count under each of their tags; expenses without tags under NO_TAG.
+
+        Returns:
+            DataFrame with tag and balance, largest balance first
+        """
+        balances = (
+            ReportService.balance_query(as_of, ReportService.snapshot_date(db, as_of))
+            .where(Expense.start_date <= as_of)
+            .subquery()
+        )
+        tag = func.coalesce(Tag.name, NO_TAG)
+        result = db.execute(
+            select(tag.label('tag'), func.sum(balances.c.balance).label('balance'))
+            .select_from(balances)
+            .outerjoin(ExpenseTag, ExpenseTag.expense_id == balances.c.id)
+            .outerjoin(Tag, Tag.id == ExpenseTag.tag_id)
+            .where(balances.c.balance != 0)
+            .group_by(tag)
+            .order_by(func.sum(balances.c.balance).desc())
+        )
+        return pd.DataFrame(result.all(), columns=list(result.keys()))
+
+    @staticmethod
+    def cached_series(db) -> pd.DataFrame:
+        """Get quarterly_series from the report cache; it is rebuilt only after a committed write."""
+        return ReportService.cached(
+            'dashboard_series', (active_start_month(),), lambda: DashboardService.quarterly_series(db)
+        )
+
+    @staticmethod
+    def cached_tags(db, as_of: date) -> pd.DataFrame:
+        """Get balance_by_tag from the report cache; it is rebuilt only after a committed write."""
+        return ReportService.cached('dashboard_tags', (as_of,), lambda: DashboardService.balance_by_tag(db, as_of))
@@ -0,0 +1,101 @@
+"""Shared interval index over expense allocation periods, kept in sync on commit."""
+from datetime import date
+from threading import Lock
+from typing import Iterable, Optional
+import numpy as np
+from sqlalchemy import bindparam, event
+from models.database import SessionLocal, Expense
+from utils.interval_index import SortedIntervalIndex
+
+# session.info key holding index changes flushed but not yet committed
+_PENDING_KEY = 'expense_index_changes'
+
+
+class ExpenseIndexService:
+    """Service answering which expenses are active on a date or in a period."""
+
+    # Shared across reruns and sessions; built from the database on first use
+    _index: Optional[SortedIntervalIndex] = None
+    _lock = Lock()
+
+    @staticmethod
+    def get_index(db=None) -> SortedIntervalIndex:
+        """
+        Get the shared index, loading (id, start_date, end_date) of every expense on first use.
+
+        Args:
+            db: Database session to load with (a new session if omitted)
+
+        Returns:
+            SortedIntervalIndex keyed by expense id
+        """
+        with ExpenseIndexService._lock:
+            if ExpenseIndexService._index is None:
+                session = db or SessionLocal()
+                try:
+                    rows = session.query(Expense.id, Expense.start_date, Expense.end_date).all()
+                finally:
+                    if db is None:
+                        session.close()
+                ExpenseIndexService._index = SortedIntervalIndex.from_rows(rows)
+            return ExpenseIndexService._index
+
+    @staticmethod
+    def active_on(day: date, db=None) -> np.ndarray:
+        """Get ids of expenses whose allocation period contains a day."""
+        return ExpenseIndexService.get_index(db).active_on(day)
+
+    @staticmethod
+    def overlapping(start: date, end: date, db=None) -> np.ndarray:
+        """Get ids of expenses whose allocation period overlaps [start, end]."""
+        return ExpenseIndexService.get_index(db).overlapping(start, end)
+
+    @staticmethod
+    def with_balance_on(day: date, db=None) -> np.ndarray:
+        """Get ids of expenses not yet fully allocated by a day (end_date >= day), ordered by end date."""
+        return ExpenseIndexService.get_index(db).ending_on_or_after(day)
+
+    @staticmethod
+    def id_filter(column, ids: Iterable[int]):
+        """
+        Build an IN filter on an id column for a (possibly large) id list.
+
+        Ids are rendered inline rather than bound one by one, so the list is
+        not limited by SQLite's bound parameter count. The parameter is
+        anonymous, so several filters can be combined in one statement.
+        """
+        return column.in_(bindparam(None, [int(i) for i in ids], expanding=True, literal_execute=True))
+
+    @staticmethod
+    def invalidate():
+        """Drop the index so the next lookup reloads it (e.g. after a database restore)."""
+        with ExpenseIndexService._lock:
+            ExpenseIndexService._index = None
+
+
+@event.listens_for(SessionLocal, 'after_flush')
+def _collect_expense_changes(session, flush_context):
+    """Record flushed expense inserts, updates and deletes until the commit."""
+    pending = session.info.setdefault(_PENDING_KEY, {})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Expense) and obj.id is not None:
+            pending[obj.id] = (obj.start_date, obj.end_date)
+    for obj in session.deleted:
+        if isinstance(obj, Expense) and obj.id is not None:
+            pending[obj.id] = None
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _apply_expense_changes(session):
+    """Apply committed expense changes to the loaded index in one batch."""
+    pending = session.info.pop(_PENDING_KEY, None)
+    index = ExpenseIndexService._index
+    if not pending or index is None:
+        return
+    index.update(pending)
+
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def _discard_expense_changes(session):
+    """Forget changes of a rolled back transaction."""
+    session.info.pop(_PENDING_KEY, None)
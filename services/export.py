@@ -4,7 +4,8 @@ from openpyxl import load_workbook
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from datetime import datetime
 from typing import List
-from utils.helpers import format_currency, format_quarter
+from models.schedule import AllocationSchedule
+from utils.helpers import format_currency, format_period
 
 
 class ExportService:
@@ -13,7 +14,7 @@ class ExportService:
     @staticmethod
     def export_allocation_report(
         expense_data: dict,
-        allocations: List[dict],
+        allocations: AllocationSchedule,
         output_path: str
     ) -> bool:
         """
@@ -21,7 +22,7 @@ class ExportService:
         
         Args:
             expense_data: Dictionary with expense information
-            allocations: List of allocation dictionaries
+            allocations: Allocation schedule of the expense
             output_path: Path to save Excel file
         
         Returns:
@@ -44,37 +45,32 @@ class ExportService:
                 expense_df.to_excel(writer, sheet_name='Thông tin chi phí', index=False)
                 
                 # Sheet 2: Allocation Schedule
-                allocation_records = []
-                cumulative_allocated = 0
                 total_amount = expense_data.get('total_amount')
+                schedule_df = allocations.to_dataframe(include_dates=True)
+                cumulative_allocated = allocations.cumulative()
                 
-                for alloc in allocations:
-                    cumulative_allocated += alloc['amount']
-                    remaining_balance = total_amount - cumulative_allocated
-                    
-                    allocation_records.append({
-                        'Quý': format_quarter(alloc['quarter'], alloc['year']),
-                        'Năm': alloc['year'],
-                        'Ngày bắt đầu': alloc['start_date'].strftime('%d/%m/%Y'),
-                        'Ngày kết thúc': alloc['end_date'].strftime('%d/%m/%Y'),
-                        'Số ngày': alloc['days_in_quarter'],
-                        'Số tiền phân bổ': alloc['amount'],
-                        'Tỷ lệ (%)': round((alloc['days_in_quarter'] / alloc['total_days']) * 100, 2),
-                        'Lũy kế phân bổ': cumulative_allocated,
-                        'Còn lại': remaining_balance
-                    })
-                
-                allocation_df = pd.DataFrame(allocation_records)
+                allocation_df = pd.DataFrame({
+                    'Quý': allocations.labels(),
+                    'Năm': schedule_df['year'],
+                    'Ngày bắt đầu': schedule_df['start_date'].dt.strftime('%d/%m/%Y'),
+                    'Ngày kết thúc': schedule_df['end_date'].dt.strftime('%d/%m/%Y'),
+                    'Số ngày': schedule_df['days_in_quarter'],
+                    'Số tiền phân bổ': schedule_df['amount'],
+                    'Tỷ lệ (%)': allocations.percentages().round(2),
+                    'Lũy kế phân bổ': cumulative_allocated,
+                    'Còn lại': total_amount - cumulative_allocated
+                })
                 allocation_df.to_excel(writer, sheet_name='Kế hoạch phân bổ', index=False)
                 
                 # Add summary row
+                summary = allocations.summary()
                 summary_row = pd.DataFrame([{
                     'Quý': 'TỔNG CỘNG',
                     'Năm': '',
                     'Ngày bắt đầu': '',
                     'Ngày kết thúc': '',
-                    'Số ngày': sum(a['days_in_quarter'] for a in allocations),
-                    'Số tiền phân bổ': sum(a['amount'] for a in allocations),
+                    'Số ngày': summary['total_days'],
+                    'Số tiền phân bổ': summary['total_allocated'],
                     'Tỷ lệ (%)': 100.00,
                     'Lũy kế phân bổ': total_amount,
                     'Còn lại': 0
@@ -180,7 +176,7 @@ class ExportService:
                         'Số tài khoản': expense.get('account_number'),
                         'Tên khoản mục': expense.get('name'),
                         'Mã phụ': expense.get('sub_code'),
-                        'Quý': format_quarter(alloc['quarter'], alloc['year']),
+                        'Quý': format_period(alloc.get('period_type', 'quarter'), alloc.get('period') or alloc['quarter'], alloc['year']),
                         'Năm': alloc['year'],
                         'Ngày bắt đầu': alloc['start_date'].strftime('%d/%m/%Y'),
                         'Ngày kết thúc': alloc['end_date'].strftime('%d/%m/%Y'),
@@ -0,0 +1,125 @@
+"""Fiscal year start month stored with the data; changing it re-labels the stored allocation periods."""
+from typing import Tuple
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, update
+from config.settings import settings
+from models.database import SessionLocal, Allocation, AppSetting
+from services.allocation_totals import AllocationTotalService
+from services.report import ReportService
+from utils.fiscal_calendar import calendar_covering, to_ordinals
+
+FISCAL_START_KEY = 'fiscal_year_start_month'
+
+
+class FiscalYearService:
+    """Service persisting the fiscal year start and keeping stored period labels on that calendar."""
+
+    @staticmethod
+    def load(db) -> int:
+        """
+        Apply the stored fiscal year start month to the settings.
+
+        Keeps the configured default (FISCAL_YEAR_START_MONTH) if none was stored.
+
+        Returns:
+            int: Active fiscal year start month
+        """
+        value = db.execute(select(AppSetting.value).where(AppSetting.key == FISCAL_START_KEY)).scalar()
+        if value is not None:
+            settings.fiscal_year_start_month = int(value)
+        return settings.fiscal_year_start_month
+
+    @staticmethod
+    def period_labels(period_type: str, end_dates, start_month: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Get the (period, quarter, year) labels of periods from their end dates under a fiscal calendar.
+
+        Returns:
+            Tuple of int64 arrays: period number within the fiscal year,
+            quarter in which the period closes and fiscal year
+        """
+        ordinals = to_ordinals(end_dates)
+        cal = calendar_covering(ordinals, period_type, start_month)
+        idx = cal.period_indices(ordinals)
+        return cal.period_number[idx], cal.period_quarter[idx], cal.period_year[idx]
+
+    @staticmethod
+    def relabel(db, start_month: int) -> int:
+        """
+        Re-label the system allocation rows with the period closing on their end date.
+
+        Amounts and dates are kept; historical rows (days_in_quarter == 0)
+        keep their labels. The caller commits.
+
+        Args:
+            db: Database session
+            start_month: Fiscal year start month of the new calendar
+
+        Returns:
+            Number of rows whose labels changed
+        """
+        result = db.execute(
+            select(Allocation.id, Allocation.period_type, Allocation.end_date,
+                   Allocation.period, Allocation.quarter, Allocation.year)
+            .where(Allocation.days_in_quarter > 0)
+        )
+        rows = pd.DataFrame(result.all(), columns=list(result.keys()))
+
+        changes = []
+        for period_type, group in rows.groupby('period_type', sort=False):
+            period, quarter, year = FiscalYearService.period_labels(period_type, group['end_date'], start_month)
+            changed = (
+                (group['period'].fillna(0).to_numpy() != period)
+                | (group['quarter'].to_numpy() != quarter)
+                | (group['year'].to_numpy() != year)
+            )
+            changes.extend(
+                {'id': row_id, 'period': p, 'quarter': q, 'year': y}
+                for row_id, p, q, y in zip(
+                    group['id'].to_numpy()[changed].tolist(), period[changed].tolist(),
+                    quarter[changed].tolist(), year[changed].tolist()
+                )
+            )
+        if changes:
+            db.execute(update(Allocation), changes)
+        return len(changes)
+
+    @staticmethod
+    def set_start_month(db, start_month: int) -> int:
+        """
+        Change the fiscal year start month, store it and re-label the stored periods.
+
+        The per-period summary table is rebuilt under the new labels and
+        cached reports are dropped, so period filters, totals and reports
+        agree with the new calendar.
+
+        Args:
+            db: Database session; the change is committed
+            start_month: New fiscal year start month (1-12)
+
+        Returns:
+            Number of allocation rows whose labels changed
+        """
+        if not 1 <= start_month <= 12:
+            raise ValueError(f"Invalid fiscal year start month: {start_month}")
+        try:
+            relabelled = FiscalYearService.relabel(db, start_month)
+            db.merge(AppSetting(key=FISCAL_START_KEY, value=str(start_month)))
+            AllocationTotalService.rebuild(db, start_month)
+        except Exception:
+            db.rollback()
+            raise
+        settings.fiscal_year_start_month = start_month
+        ReportService.bump_generation()
+        return relabelled
+
+
+if __name__ == "__main__":
+    db = SessionLocal()
+    try:
+        start_month = FiscalYearService.load(db)
+        print(f"[OK] Re-labelled {FiscalYearService.set_start_month(db, start_month)} allocation rows "
+              f"for fiscal years starting in month {start_month}")
+    finally:
+        db.close()
@@ -3,6 +3,8 @@ import pandas as pd
 from datetime import datetime
 from typing import List, Tuple, Dict
 from io import BytesIO
+from utils.helpers import to_dong, PERIOD_LABELS
+from services.allocation_methods import METHOD_DAILY, METHOD_TRANCHE, METHOD_LABELS
 
 
 class ImportService:
@@ -23,6 +25,8 @@ class ImportService:
             'Tổng tiền': [36000000, 24000000],
             'Ngày bắt đầu': ['01/01/2024', '15/02/2024'],
             'Ngày kết thúc': ['31/12/2024', '14/02/2025'],
+            'Kỳ phân bổ': ['Quý', 'Tháng'],
+            'Phương pháp phân bổ': ['Theo ngày', 'Đều theo tháng'],
             'Segment (9995/9996)': ['9995', '9996'],
             'Giá trị đã phân bổ': [0, 5000000],
             'Quý-Năm Quá Khứ': ['', 'Q1/2024'],
@@ -70,6 +74,16 @@ class ImportService:
             if segment not in ['9995', '9996']:
                 errors.append(f"Dòng {row_num}: Segment phải là 9995 hoặc 9996, giá trị hiện tại: '{segment}'")
             
+            # Check period granularity (optional, default Quý)
+            period_label = row.get('Kỳ phân bổ')
+            if pd.notna(period_label) and ImportService._parse_period_type(period_label) is None:
+                errors.append(f"Dòng {row_num}: Kỳ phân bổ phải là Tháng, Quý hoặc Năm, giá trị hiện tại: '{period_label}'")
+            
+            # Check allocation method (optional, default Theo ngày; tranches are entered on the form)
+            method_label = row.get('Phương pháp phân bổ')
+            if pd.notna(method_label) and ImportService._parse_allocation_method(method_label) in (None, METHOD_TRANCHE):
+                errors.append(f"Dòng {row_num}: Phương pháp phân bổ phải là Theo ngày hoặc Đều theo tháng, giá trị hiện tại: '{method_label}'")
+            
             # Check name
             if pd.isna(row['Tên khoản mục']) or str(row['Tên khoản mục']).strip() == '':
                 errors.append(f"Dòng {row_num}: Tên khoản mục không được để trống")
@@ -127,12 +141,14 @@ class ImportService:
                 'account_number': str(row['Số tài khoản']).strip(),
                 'name': str(row['Tên khoản mục']).strip(),
                 'document_code': str(row.get('Mã chứng từ', '')).strip() if pd.notna(row.get('Mã chứng từ')) else None,
-                'total_amount': float(row['Tổng tiền']),
+                'total_amount': to_dong(row['Tổng tiền']),
                 'start_date': start_date,
                 'end_date': end_date,
                 'sub_code': str(row.get('Segment (9995/9996)', '9995')).strip(),
+                'period_type': ImportService._parse_period_type(row.get('Kỳ phân bổ')) or 'quarter',
+                'allocation_method': ImportService._parse_allocation_method(row.get('Phương pháp phân bổ')) or METHOD_DAILY,
                 'allocation_months': max(1, allocation_months),
-                'already_allocated': float(row.get('Giá trị đã phân bổ', 0)) if pd.notna(row.get('Giá trị đã phân bổ')) else 0,
+                'already_allocated': to_dong(row.get('Giá trị đã phân bổ', 0)) if pd.notna(row.get('Giá trị đã phân bổ')) else 0,
                 'past_quarter_year': str(row.get('Quý-Năm Quá Khứ', '')).strip() if pd.notna(row.get('Quý-Năm Quá Khứ')) else None,
                 'tags': tags,
                 'note': note
@@ -142,6 +158,28 @@ class ImportService:
         
         return expenses
     
+    @staticmethod
+    def _parse_period_type(value) -> str:
+        """Map a 'Kỳ phân bổ' cell (Tháng/Quý/Năm or month/quarter/year) to a period type."""
+        if value is None or pd.isna(value):
+            return None
+        text = str(value).strip().lower()
+        for period_type, label in PERIOD_LABELS.items():
+            if text in (period_type, label.lower()):
+                return period_type
+        return None
+    
+    @staticmethod
+    def _parse_allocation_method(value) -> str:
+        """Map a 'Phương pháp phân bổ' cell (label or method name) to an allocation method."""
+        if value is None or pd.isna(value):
+            return None
+        text = str(value).strip().lower()
+        for method, label in METHOD_LABELS.items():
+            if text in (method, label.lower()):
+                return method
+        return None
+    
     @staticmethod
     def export_template(output_path: str = None) -> any:
         """
@@ -169,12 +207,14 @@ class ImportService:
                         '3. Tổng tiền phải là số dương',
                         '4. Ngày theo định dạng DD/MM/YYYY (ví dụ: 01/01/2024)',
                         '5. Ngày kết thúc phải sau ngày bắt đầu',
-                        '6. Segment: 9995 (≤12 tháng) hoặc 9996 (>12 tháng)',
-                        '7. Nếu có dữ liệu phân bổ quá khứ, tính tổng thời gian từ quá khứ để chọn Segment',
-                        '8. Giá trị đã phân bổ: Nhập số tiền đã phân bổ trong quá khứ (nếu có)',
-                        '9. Quý-Năm Quá Khứ: Nhập kỳ phân bổ quá khứ (ví dụ: Q1/2024)',
-                        '10. Tags/Nhãn và Ghi chú là tùy chọn',
-                        '11. Sau khi điền xong, upload file vào ứng dụng'
+                        '6. Kỳ phân bổ: Tháng, Quý hoặc Năm (bỏ trống = Quý)',
+                        '7. Phương pháp phân bổ: Theo ngày hoặc Đều theo tháng (bỏ trống = Theo ngày; phân bổ theo đợt nhập trên màn hình Nhập Chi Phí)',
+                        '8. Segment: 9995 (≤12 tháng) hoặc 9996 (>12 tháng)',
+                        '9. Nếu có dữ liệu phân bổ quá khứ, tính tổng thời gian từ quá khứ để chọn Segment',
+                        '10. Giá trị đã phân bổ: Nhập số tiền đã phân bổ trong quá khứ (nếu có)',
+                        '11. Quý-Năm Quá Khứ: Nhập kỳ phân bổ quá khứ (ví dụ: Q1/2024)',
+                        '12. Tags/Nhãn và Ghi chú là tùy chọn',
+                        '13. Sau khi điền xong, upload file vào ứng dụng'
                     ]
                 })
                 instructions.to_excel(writer, sheet_name='Hướng dẫn', index=False)
@@ -0,0 +1,144 @@
+"""Quarter-end close: per-expense balance snapshots and the lock on closed periods."""
+from datetime import date
+from typing import List, Optional
+import pandas as pd
+from sqlalchemy import delete, event, func, insert, inspect, literal, select
+from models.database import SessionLocal, Expense, Allocation, PeriodClose, BalanceSnapshot
+from services.report import ReportService
+from utils.helpers import get_quarter_dates
+
+
+class PeriodCloseService:
+    """Service closing quarters into balance snapshots and guarding closed periods."""
+
+    @staticmethod
+    def locked_through(db) -> Optional[date]:
+        """Get the last day of the latest closed quarter (None if nothing is closed)."""
+        return db.execute(select(func.max(PeriodClose.close_date))).scalar()
+
+    @staticmethod
+    def close_quarter(db, year: int, quarter: int, today: Optional[date] = None) -> PeriodClose:
+        """
+        Close a quarter: snapshot every expense's balance on its last day and lock it.
+
+        The snapshot is computed from the previous one, so a close reads
+        only the rows ending after the previous close.
+
+        Args:
+            db: Database session; the close is committed
+            year: Fiscal year
+            quarter: Quarter (1-4)
+            today: Current date (default today); only ended quarters can be closed
+
+        Returns:
+            The PeriodClose record
+
+        Raises:
+            ValueError: If the quarter has not ended or is already locked
+        """
+        _, close_date = get_quarter_dates(quarter, year)
+        if close_date >= (today or date.today()):
+            raise ValueError("Quý chưa kết thúc, chưa thể khóa sổ")
+        locked = PeriodCloseService.locked_through(db)
+        if locked is not None and close_date <= locked:
+            raise ValueError(f"Đã khóa sổ đến ngày {locked.strftime('%d/%m/%Y')}")
+
+        balances = (
+            ReportService.balance_query(close_date, locked)
+            .where(Expense.start_date <= close_date)
+            .subquery()
+        )
+        period_close = PeriodClose(close_date=close_date, year=year, quarter=quarter)
+        try:
+            db.add(period_close)
+            db.flush()
+            db.execute(insert(BalanceSnapshot).from_select(
+                ['close_date', 'expense_id', 'allocated', 'balance'],
+                select(literal(close_date), balances.c.id, balances.c.allocated, balances.c.balance)
+            ))
+            expense_count, closing_balance = db.execute(
+                select(func.count(), func.coalesce(func.sum(BalanceSnapshot.balance), 0))
+                .where(BalanceSnapshot.close_date == close_date)
+            ).one()
+            period_close.expense_count = expense_count
+            period_close.closing_balance = closing_balance
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        return period_close
+
+    @staticmethod
+    def reopen_latest(db) -> Optional[date]:
+        """
+        Reopen the latest closed quarter, dropping its snapshot.
+
+        Args:
+            db: Database session; the change is committed
+
+        Returns:
+            Close date of the reopened quarter (None if nothing was closed)
+        """
+        locked = PeriodCloseService.locked_through(db)
+        if locked is None:
+            return None
+        db.execute(delete(BalanceSnapshot).where(BalanceSnapshot.close_date == locked))
+        db.execute(delete(PeriodClose).where(PeriodClose.close_date == locked))
+        db.commit()
+        return locked
+
+    @staticmethod
+    def closes(db) -> pd.DataFrame:
+        """Get the closed quarters, latest first."""
+        result = db.execute(
+            select(
+                PeriodClose.year, PeriodClose.quarter, PeriodClose.close_date,
+                PeriodClose.expense_count, PeriodClose.closing_balance, PeriodClose.closed_at
+            ).order_by(PeriodClose.close_date.desc())
+        )
+        return pd.DataFrame(result.all(), columns=list(result.keys()))
+
+    @staticmethod
+    def check_unlocked(dates: List[date], locked: Optional[date]):
+        """
+        Refuse changes dated inside closed periods.
+
+        Args:
+            dates: Start dates of the changed expenses/allocation rows
+            locked: Last locked day
+
+        Raises:
+            ValueError: If any date is on or before the last locked day
+        """
+        if locked is not None and dates and min(dates) <= locked:
+            raise ValueError(
+                f"Số liệu đến ngày {locked.strftime('%d/%m/%Y')} đã khóa sổ, không thể thay đổi"
+            )
+
+
+def _locked_dates(session) -> List[date]:
+    """Get start dates of the expenses and allocation rows a flush would change in closed periods."""
+    dates = []
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, (Expense, Allocation)):
+            dates.append(obj.start_date)
+    for obj in session.dirty:
+        if isinstance(obj, Allocation) and session.is_modified(obj):
+            dates.append(obj.start_date)
+            dates.extend(inspect(obj).attrs.start_date.history.deleted)
+        elif isinstance(obj, Expense):
+            attrs = inspect(obj).attrs
+            # Rows dropped from the collection are deleted as orphans later in the flush
+            dates.extend(alloc.start_date for alloc in attrs.allocations.history.deleted)
+            if attrs.start_date.history.has_changes() or attrs.already_allocated.history.has_changes():
+                dates.append(obj.start_date)
+                dates.extend(attrs.start_date.history.deleted)
+    return [d for d in dates if d is not None]
+
+
+@event.listens_for(SessionLocal, 'before_flush')
+def _guard_closed_periods(session, flush_context, instances):
+    """Stop flushes that would change balances of a closed quarter."""
+    dates = _locked_dates(session)
+    if dates:
+        PeriodCloseService.check_unlocked(dates, PeriodCloseService.locked_through(session))
@@ -0,0 +1,123 @@
+"""Pivot tables with subtotals over report frames, counting multi-valued tags under each tag."""
+from typing import List, Optional, Sequence
+import numpy as np
+import pandas as pd
+
+# Tag bucket of expenses without tags
+NO_TAG = "(Không có)"
+TOTAL_LABEL = "TỔNG CỘNG"
+SUBTOTAL_LABEL = "Cộng"
+
+
+class PivotService:
+    """Service for grouping report frames with subtotals and grand totals."""
+
+    @staticmethod
+    def explode_tags(frame: pd.DataFrame, tag_column: str = "Tags") -> pd.DataFrame:
+        """
+        Get the long form of a frame with one row per (row, tag).
+
+        Comma-separated tags are split and stripped; duplicate tags of a row
+        are dropped and rows without tags get NO_TAG. Row order is kept.
+
+        Args:
+            frame: Report frame with a comma-separated tag column
+            tag_column: Name of the tag column
+
+        Returns:
+            DataFrame with the columns of frame, tag_column holding one tag
+        """
+        rows = np.arange(len(frame))
+        tags = pd.Series(
+            frame[tag_column].fillna("").astype(str).str.split(",").to_numpy(), index=rows
+        ).explode().str.strip()
+        tags = tags[tags.notna() & (tags != "")]
+
+        pairs = pd.DataFrame({'row': tags.index.to_numpy(dtype=np.int64), 'tag': tags.to_numpy()}).drop_duplicates()
+        untagged = np.setdiff1d(rows, pairs['row'].to_numpy())
+        pairs = pd.concat(
+            [pairs, pd.DataFrame({'row': untagged, 'tag': NO_TAG})], ignore_index=True
+        ).sort_values('row', kind='stable')
+
+        long = frame.iloc[pairs['row'].to_numpy()].copy()
+        long[tag_column] = pairs['tag'].to_numpy()
+        return long.reset_index(drop=True)
+
+    @staticmethod
+    def pivot(
+        frame: pd.DataFrame,
+        group_by: Sequence[str],
+        values: Sequence[str],
+        tag_column: Optional[str] = None,
+        exploded: Optional[pd.DataFrame] = None,
+        subtotals: bool = True
+    ) -> pd.DataFrame:
+        """
+        Sum value columns by group columns, with a subtotal row after each group and a grand total.
+
+        When tag_column is grouped, rows are counted once under each of their
+        tags; levels above the tag level and the grand total are summed over
+        the original rows, so multi-tag rows are not double counted there.
+        Group values are sorted (categoricals by category order).
+
+        Args:
+            frame: Report frame
+            group_by: Group columns, outermost first
+            values: Columns to sum
+            tag_column: Comma-separated tag column of frame, if any
+            exploded: explode_tags(frame, tag_column), to reuse across pivots
+            subtotals: Add a subtotal row after each group of every outer level
+
+        Returns:
+            DataFrame with group_by and values columns; subtotal rows have
+            SUBTOTAL_LABEL in the first collapsed column and the last row is
+            the grand total (TOTAL_LABEL in the first column)
+        """
+        group_by, values = list(group_by), list(values)
+        if not group_by:
+            raise ValueError("group_by must name at least one column")
+        tag_level = group_by.index(tag_column) + 1 if tag_column in group_by else None
+        if tag_level is not None and exploded is None:
+            exploded = PivotService.explode_tags(frame, tag_column)
+        detail_source = exploded if tag_level is not None else frame
+
+        depth = len(group_by)
+        levels = range(1, depth + 1) if subtotals else [depth]
+        parts: List[pd.DataFrame] = []
+        for level in levels:
+            source = exploded if tag_level is not None and level >= tag_level else frame
+            part = (
+                source.groupby(group_by[:level], sort=False, observed=True, dropna=False)[values]
+                .sum()
+                .reset_index()
+            )
+            part['_level'] = level
+            parts.append(part)
+        total = frame[values].sum().to_frame().T
+        total['_level'] = 0
+        parts.append(total)
+        result = pd.concat(parts, ignore_index=True)[group_by + values + ['_level']]
+
+        # Sort keys: rank of the group value, collapsed levels after their group
+        level = result['_level'].to_numpy()
+        keys = []
+        for position, column in enumerate(group_by):
+            if isinstance(detail_source[column].dtype, pd.CategoricalDtype):
+                categories = detail_source[column].cat.categories
+            else:
+                uniques = pd.unique(detail_source[column].dropna())
+                categories = uniques[np.argsort(pd.Series(uniques).astype(str).to_numpy(), kind='stable')]
+            rank = pd.Categorical(result[column], categories=categories).codes.astype(np.int64)
+            keys.append(np.where(level > position, rank, len(categories)))
+        result = result.iloc[np.lexsort(keys[::-1])].reset_index(drop=True)
+
+        # Labels of subtotal and total rows
+        level = result['_level'].to_numpy()
+        for position, column in enumerate(group_by):
+            labels = result[column].to_numpy(dtype=object, copy=True)
+            labels[level == position] = SUBTOTAL_LABEL if position > 0 else TOTAL_LABEL
+            labels[level < position] = ""
+            result[column] = labels
+        for column in values:
+            result[column] = result[column].astype(frame[column].dtype)
+        return result.drop(columns='_level')
@@ -0,0 +1,277 @@
+"""Portfolio amortization projection over future periods."""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from config.settings import settings
+from services.allocation import AllocationService, _as_date, _split_origins, _to_dong_array
+from services.allocation_methods import accumulated_grouped
+from utils.fiscal_calendar import PERIOD_QUARTER, calendar_covering, to_ordinals
+from utils.helpers import add_months, format_period
+
+# Group label for expenses without tags
+NO_TAG_LABEL = "(Không có)"
+
+# Supported grouping keys for project_expenses
+GROUP_BY_FIELDS = ('account_number', 'sub_code', 'tag')
+
+
+def _project_chunk(
+    totals: np.ndarray,
+    starts: np.ndarray,
+    origins: np.ndarray,
+    ends: np.ndarray,
+    base: np.ndarray,
+    methods: Optional[List[Optional[str]]],
+    params: Optional[List[Optional[Dict]]],
+    codes: np.ndarray,
+    boundaries: np.ndarray,
+    n_groups: int
+) -> np.ndarray:
+    """
+    Sum per-period amortization of a chunk of expenses by group code.
+
+    Module-level so it can run in a worker process.
+
+    Returns:
+        np.ndarray: (n_groups, n_periods) int64 amounts
+    """
+    accumulated = accumulated_grouped(
+        methods, totals, starts, ends, np.broadcast_to(boundaries, (len(totals), len(boundaries))),
+        params, origins, base
+    )
+    amounts = np.diff(accumulated, axis=1)
+
+    result = np.zeros((n_groups, amounts.shape[1]), dtype=np.int64)
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    present, first = np.unique(sorted_codes, return_index=True)
+    result[present] = np.add.reduceat(amounts[order], first, axis=0)
+    return result
+
+
+class ProjectionService:
+    """Service for projecting future amortization of the prepaid expense portfolio."""
+
+    @staticmethod
+    def projection_periods(
+        from_date: date,
+        years: int,
+        period_type: str = PERIOD_QUARTER
+    ) -> pd.DataFrame:
+        """
+        Get the periods covered by a projection.
+
+        The horizon starts with the period containing from_date and spans
+        the given number of years.
+
+        Returns:
+            DataFrame with period, quarter, year, period_label, start_date and
+            end_date (as dates) per period
+        """
+        from_date = _as_date(from_date)
+        cal = calendar_covering(np.array([from_date.toordinal()]), period_type)
+        first_start = cal.dates_at(cal.index_of(from_date))[0]
+        last_day = add_months(first_start, years * 12).toordinal() - 1
+        cal = calendar_covering(np.array([first_start.toordinal(), last_day]), period_type)
+
+        periods = slice(cal.index_of(first_start), cal.index_of(date.fromordinal(last_day)) + 1)
+        numbers = cal.period_number[periods]
+        years_ = cal.period_year[periods]
+        return pd.DataFrame({
+            'period': numbers,
+            'quarter': cal.period_quarter[periods],
+            'year': years_,
+            'period_label': [format_period(period_type, p, y) for p, y in zip(numbers.tolist(), years_.tolist())],
+            'start_date': [date.fromordinal(o) for o in cal.period_start[periods].tolist()],
+            'end_date': [date.fromordinal(o) for o in cal.period_end[periods].tolist()]
+        })
+
+    @staticmethod
+    def project_amortization(
+        total_amounts: Sequence[int],
+        start_dates: Sequence[date],
+        end_dates: Sequence[date],
+        from_date: date,
+        years: int,
+        period_type: str = PERIOD_QUARTER,
+        groups: Optional[Sequence[str]] = None,
+        rebase_dates: Optional[Sequence[Optional[date]]] = None,
+        rebase_accumulated: Optional[Sequence[int]] = None,
+        methods: Optional[Sequence[Optional[str]]] = None,
+        params: Optional[Sequence[Optional[Dict]]] = None,
+        workers: Optional[int] = None,
+        allocations: Optional[Sequence[Optional[Sequence]]] = None
+    ) -> pd.DataFrame:
+        """
+        Project amortization per future period, optionally per group.
+
+        Period amounts are differences of the closed-form accumulated amount
+        at period boundaries, so they match the stored schedules. Expenses
+        are processed in chunks; above settings.projection_parallel_threshold
+        the chunks run in a process pool. As in accumulated_at, boundaries
+        before an expense's rebase date are read from its stored rows when
+        given; without them an edited expense projects nothing before it.
+
+        Args:
+            total_amounts: Total amount of each expense
+            start_dates: Allocation start date of each expense
+            end_dates: Allocation end date of each expense
+            from_date: Date whose period starts the projection
+            years: Horizon in years
+            period_type: 'month', 'quarter' or 'year'
+            groups: Group label of each expense (None for portfolio totals)
+            rebase_dates: Rebase date of each expense, None if never edited
+            rebase_accumulated: System allocation before each rebase date
+            methods: Allocation method of each expense (default all daily)
+            params: Method parameters of each expense
+            workers: Worker processes (default settings.projection_workers)
+            allocations: Stored allocation rows of each expense (only read
+                for edited expenses)
+
+        Returns:
+            DataFrame with one row per (group, period): group (when grouped),
+            period, quarter, year, period_label, start_date, end_date, amount
+        """
+        periods = ProjectionService.projection_periods(from_date, years, period_type)
+        boundaries = np.concatenate([
+            [periods['start_date'].iloc[0].toordinal() - 1],
+            [d.toordinal() for d in periods['end_date']]
+        ]).astype(np.int64)
+
+        totals = _to_dong_array(total_amounts)
+        starts = to_ordinals(start_dates)
+        origins, base = _split_origins(starts, rebase_dates, rebase_accumulated)
+        ends = to_ordinals(end_dates)
+        methods = list(methods) if methods is not None else None
+        params = list(params) if params is not None else [None] * len(totals)
+
+        if groups is None:
+            codes = np.zeros(len(totals), dtype=np.int64)
+            labels = [None]
+        else:
+            codes, labels = pd.factorize(pd.Series(list(groups), dtype=object), sort=True)
+            labels = list(labels)
+
+        chunk_size = settings.projection_chunk_size
+        chunks = [
+            (totals[i:i + chunk_size], starts[i:i + chunk_size], origins[i:i + chunk_size],
+             ends[i:i + chunk_size], base[i:i + chunk_size],
+             methods[i:i + chunk_size] if methods is not None else None, params[i:i + chunk_size],
+             codes[i:i + chunk_size], boundaries, len(labels))
+            for i in range(0, len(totals), chunk_size)
+        ]
+
+        workers = settings.projection_workers if workers is None else workers
+        if len(totals) >= settings.projection_parallel_threshold and len(chunks) > 1 and workers != 1:
+            with ProcessPoolExecutor(max_workers=workers or None) as pool:
+                partials = list(pool.map(_project_chunk, *zip(*chunks)))
+        else:
+            partials = [_project_chunk(*chunk) for chunk in chunks]
+
+        amounts = np.sum(partials, axis=0) if partials else np.zeros((len(labels), len(periods)), dtype=np.int64)
+
+        if allocations is not None:
+            # The closed form holds the rebase amount flat before the rebase date
+            for i in np.flatnonzero(origins > boundaries[0]).tolist():
+                if origins[i] == starts[i] or allocations[i] is None:
+                    continue
+                before = boundaries < origins[i]
+                correction = np.zeros(len(boundaries), dtype=np.int64)
+                correction[before] = [
+                    AllocationService.accumulated_from_rows(allocations[i], date.fromordinal(b)) - base[i]
+                    for b in boundaries[before].tolist()
+                ]
+                amounts[codes[i]] += np.diff(correction)
+
+        result = pd.concat([periods] * len(labels), ignore_index=True)
+        result['amount'] = amounts.reshape(-1)
+        if groups is not None:
+            result.insert(0, 'group', np.repeat(labels, len(periods)))
+        return result
+
+    @staticmethod
+    def project_expenses(
+        expenses: Sequence,
+        from_date: date,
+        years: int,
+        period_type: str = PERIOD_QUARTER,
+        group_by: Optional[str] = None
+    ) -> pd.DataFrame:
+        """
+        Project amortization of expense records.
+
+        Args:
+            expenses: Expense records
+            from_date: Date whose period starts the projection
+            years: Horizon in years
+            period_type: 'month', 'quarter' or 'year'
+            group_by: None, 'account_number', 'sub_code' or 'tag'. With 'tag'
+                an expense counts once under each of its tags.
+
+        Returns:
+            DataFrame as returned by project_amortization
+        """
+        if group_by is not None and group_by not in GROUP_BY_FIELDS:
+            raise ValueError(f"Unknown group_by: {group_by}")
+
+        rows, groups = ProjectionService._expand_groups(expenses, group_by)
+        return ProjectionService.project_amortization(
+            [expenses[i].total_amount for i in rows],
+            [expenses[i].start_date for i in rows],
+            [expenses[i].end_date for i in rows],
+            from_date,
+            years,
+            period_type,
+            groups=groups,
+            rebase_dates=[expenses[i].rebase_date for i in rows],
+            rebase_accumulated=[expenses[i].rebase_accumulated or 0 for i in rows],
+            methods=[expenses[i].allocation_method for i in rows],
+            params=[expenses[i].allocation_params for i in rows],
+            allocations=[expenses[i].allocations if expenses[i].rebase_date else None for i in rows]
+        )
+
+    @staticmethod
+    def _expand_groups(expenses: Sequence, group_by: Optional[str]) -> Tuple[List[int], Optional[List[str]]]:
+        """Get (expense positions, group labels), repeating an expense per tag."""
+        if group_by is None:
+            return list(range(len(expenses))), None
+        if group_by != 'tag':
+            return list(range(len(expenses))), [getattr(e, group_by) or "" for e in expenses]
+
+        rows, groups = [], []
+        for idx, expense in enumerate(expenses):
+            tags = [t.strip() for t in (expense.tags or "").split(',') if t.strip()]
+            for tag in dict.fromkeys(tags) or [NO_TAG_LABEL]:
+                rows.append(idx)
+                groups.append(tag)
+        return rows, groups
+
+    @staticmethod
+    def to_pivot(projection: pd.DataFrame, totals: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+        """
+        Pivot a projection to one row per group and one column per period.
+
+        Args:
+            projection: Output of project_amortization
+            totals: Ungrouped projection of the same expenses for the
+                'TỔNG CỘNG' row; needed when groups overlap (tags), where
+                the sum of the groups counts multi-tag expenses several
+                times. Defaults to the sum of the groups.
+
+        Returns:
+            DataFrame with period labels as columns (in period order), a
+            'Tổng' column and a 'TỔNG CỘNG' row
+        """
+        labels = list(dict.fromkeys(projection['period_label']))
+        if 'group' not in projection.columns:
+            pivot = pd.DataFrame([projection['amount'].to_numpy()], columns=labels, index=['TỔNG CỘNG'])
+        else:
+            pivot = projection.pivot(index='group', columns='period_label', values='amount')[labels]
+            if totals is None:
+                pivot.loc['TỔNG CỘNG'] = pivot.sum()
+            else:
+                pivot.loc['TỔNG CỘNG'] = totals.groupby('period_label', sort=False)['amount'].sum()[labels]
+        pivot['Tổng'] = pivot[labels].sum(axis=1)
+        return pivot
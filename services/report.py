@@ -0,0 +1,588 @@
+"""Aggregate report queries evaluated in the database."""
+from datetime import date, timedelta
+from itertools import chain
+from threading import Lock
+from typing import Callable, Dict, Hashable, Iterable, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, case, cast, event, func, literal, or_, select, union_all, Date, Integer
+from sqlalchemy.orm import aliased
+from config.settings import settings
+from models.database import SessionLocal, Expense, Allocation, PeriodClose, BalanceSnapshot
+from services.expense_index import ExpenseIndexService
+from services.tag_index import TagIndexService
+from utils.fiscal_calendar import PERIOD_MONTHS, active_start_month, calendar_covering
+from utils.helpers import add_months, format_period
+from utils.lru_cache import LRUCache
+
+# session.info flag set when a flush wrote expenses or allocations
+_WRITTEN_KEY = 'report_data_written'
+
+# Balances amortizing within this many months of the report date are current (short-term)
+CURRENT_MONTHS = 12
+# Upper bounds (months to maturity) of the maturity buckets; the last bucket is open-ended
+MATURITY_BOUNDS = (3, 6, 12, 24, 36, 60)
+MATURITY_LABELS = (
+    "≤ 3 tháng", "3 - 6 tháng", "6 - 12 tháng", "12 - 24 tháng", "24 - 36 tháng", "36 - 60 tháng", "> 60 tháng"
+)
+
+
+class ReportService:
+    """Service building report tables with one SQL query each."""
+
+    # Shared across reruns and sessions; keys are (name, data generation, parameters)
+    _result_cache: LRUCache[Tuple[str, int, Hashable], pd.DataFrame] = LRUCache(settings.report_cache_size)
+    # Bumped after every commit that wrote expenses or allocations
+    _generation = 0
+    _generation_lock = Lock()
+
+    @staticmethod
+    def data_generation() -> int:
+        """Get the number of committed writes to expenses/allocations seen so far."""
+        return ReportService._generation
+
+    @staticmethod
+    def bump_generation():
+        """Start a new data generation so no cached report is reused (e.g. after a restore)."""
+        with ReportService._generation_lock:
+            ReportService._generation += 1
+
+    @staticmethod
+    def cached(
+        name: str,
+        key: Hashable,
+        compute: Callable[[], pd.DataFrame],
+        generation: Optional[int] = None
+    ) -> pd.DataFrame:
+        """
+        Get a report frame from the result cache, computing it on a miss.
+
+        Entries are keyed by (name, data generation, key): a committed write
+        starts a new generation, so older results are never returned and
+        age out of the LRU.
+
+        Args:
+            name: Report name
+            key: Report parameters (report date, filters, grouping)
+            compute: Builds the frame on a cache miss
+            generation: Generation the inputs of compute were read at, when
+                it derives from another cached frame (default: current)
+
+        Returns:
+            A copy of the cached frame (callers may modify it)
+        """
+        if generation is None:
+            generation = ReportService._generation
+        cache_key = (name, generation, key)
+        frame = ReportService._result_cache.get(cache_key)
+        if frame is None:
+            frame = compute()
+            ReportService._result_cache.put(cache_key, frame)
+        return frame.copy()
+
+    @staticmethod
+    def result_cache_info() -> Dict:
+        """Get hit/miss counters and size of the report result cache."""
+        return ReportService._result_cache.info()
+
+    @staticmethod
+    def accumulated_amount(as_of: date):
+        """
+        SQL expression for the system allocation of one allocation row through as_of.
+
+        Rows ended by as_of count in full; the row containing as_of is
+        pro-rated by elapsed days (floor, as accumulated_from_rows does).
+        Rows starting after as_of must be excluded by the caller.
+        """
+        elapsed_days = cast(func.julianday(as_of) - func.julianday(Allocation.start_date) + 1, Integer)
+        return case(
+            (Allocation.end_date <= as_of, Allocation.amount),
+            else_=Allocation.amount * elapsed_days // Allocation.days_in_quarter
+        )
+
+    @staticmethod
+    def allocated_between(from_date: date, to_date: date):
+        """
+        SQL expression for the system allocation of one allocation row after from_date through to_date.
+
+        Only rows ending after from_date and starting by to_date contribute;
+        the caller must exclude the others.
+        """
+        return ReportService.accumulated_amount(to_date) - case(
+            (Allocation.start_date <= from_date, ReportService.accumulated_amount(from_date)),
+            else_=0
+        )
+
+    @staticmethod
+    def snapshot_date(db, as_of: date) -> Optional[date]:
+        """Get the latest period close on or before a date, if any."""
+        return db.execute(
+            select(func.max(PeriodClose.close_date)).where(PeriodClose.close_date <= as_of)
+        ).scalar()
+
+    @staticmethod
+    def balance_query(as_of: date, snapshot_date: Optional[date] = None):
+        """
+        Build the per-expense balance query on a date.
+
+        Without a snapshot every system row started by as_of is summed.
+        From a snapshot the stored allocation through snapshot_date is
+        taken as is and only rows ending after it are read, each adding
+        its allocation between the two dates; expenses started after the
+        close have no snapshot row and start from zero.
+
+        Args:
+            as_of: Report date
+            snapshot_date: Close date of the snapshot to start from (on or before as_of)
+
+        Returns:
+            Select of id, name, account_number, sub_code, tags, document_code,
+            note, total_value, accumulated, balance and allocated (system
+            allocation through as_of), newest expense first
+        """
+        rows = and_(
+            Allocation.expense_id == Expense.id,
+            Allocation.days_in_quarter > 0,
+            Allocation.start_date <= as_of
+        )
+        if snapshot_date is None:
+            allocated = func.coalesce(func.sum(ReportService.accumulated_amount(as_of)), 0)
+        else:
+            delta = func.sum(ReportService.allocated_between(snapshot_date, as_of))
+            allocated = func.coalesce(BalanceSnapshot.allocated, 0) + func.coalesce(delta, 0)
+        total_value = Expense.total_amount + func.coalesce(Expense.already_allocated, 0)
+        accumulated = func.coalesce(Expense.already_allocated, 0) + allocated
+
+        query = select(
+            Expense.id,
+            Expense.name,
+            Expense.account_number,
+            Expense.sub_code,
+            Expense.tags,
+            Expense.document_code,
+            Expense.note,
+            total_value.label('total_value'),
+            accumulated.label('accumulated'),
+            (total_value - accumulated).label('balance'),
+            allocated.label('allocated')
+        )
+        if snapshot_date is None:
+            query = query.outerjoin(Allocation, rows).group_by(Expense.id)
+        else:
+            query = (
+                query
+                .outerjoin(BalanceSnapshot, and_(
+                    BalanceSnapshot.close_date == snapshot_date,
+                    BalanceSnapshot.expense_id == Expense.id
+                ))
+                .outerjoin(Allocation, and_(rows, Allocation.end_date > snapshot_date))
+                .group_by(Expense.id, BalanceSnapshot.allocated)
+            )
+        return query.order_by(Expense.created_at.desc(), Expense.id.desc())
+
+    @staticmethod
+    def balance_report(
+        db,
+        as_of: date,
+        tags: Optional[Sequence[str]] = None,
+        expense_ids: Optional[Iterable[int]] = None
+    ) -> pd.DataFrame:
+        """
+        Get the balance of every expense on a date with one aggregate query.
+
+        Accumulated = historical amount (already_allocated) plus the system
+        allocation through as_of; the open period is pro-rated in SQL. After
+        a period close the query starts from the latest snapshot on or
+        before as_of, so only rows ending after that close are read.
+
+        Args:
+            db: Database session
+            as_of: Report date
+            tags: Keep expenses having any of these tags
+            expense_ids: Limit to these expenses (e.g. from the interval index)
+
+        Returns:
+            DataFrame with id, name, account_number, sub_code, tags,
+            document_code, note, total_value, accumulated and balance, newest
+            expense first
+        """
+        query = ReportService.balance_query(as_of, ReportService.snapshot_date(db, as_of))
+        if tags:
+            query = query.where(TagIndexService.tag_filter(Expense.id, tags))
+        if expense_ids is not None:
+            query = query.where(ExpenseIndexService.id_filter(Expense.id, expense_ids))
+
+        result = db.execute(query)
+        return pd.DataFrame(result.all(), columns=list(result.keys())).drop(columns='allocated')
+
+    @staticmethod
+    def allocation_detail(
+        db,
+        year: Optional[int] = None,
+        quarter: Optional[int] = None,
+        expense_ids: Optional[Iterable[int]] = None,
+        keep_historical: bool = False
+    ) -> pd.DataFrame:
+        """
+        Get allocation rows with per-expense running totals from one windowed query.
+
+        Accumulated = historical amount + system rows before the selected
+        year/quarter + SUM(amount) OVER (PARTITION BY expense_id ORDER BY
+        year, quarter, period) across the selected rows. Historical rows
+        (days_in_quarter == 0) add nothing.
+
+        Args:
+            db: Database session
+            year: Keep rows of this (fiscal) year
+            quarter: Keep rows of this quarter
+            expense_ids: Limit to these expenses
+            keep_historical: Keep historical rows of expenses outside expense_ids
+
+        Returns:
+            DataFrame with one row per allocation: id, expense_id, name,
+            account_number, sub_code, tags, period_type, period, quarter, year,
+            start_date, end_date, days_in_quarter, amount, accumulated and
+            remaining, in chronological order (newest expense first within a
+            period)
+        """
+        system_amount = case((Allocation.days_in_quarter > 0, Allocation.amount), else_=0)
+        running = func.sum(system_amount).over(
+            partition_by=Allocation.expense_id,
+            order_by=(Allocation.year, Allocation.quarter, Allocation.period, Allocation.id)
+        )
+        accumulated = func.coalesce(Expense.already_allocated, 0) + running
+
+        rows = (
+            select(
+                Allocation.id,
+                Allocation.expense_id,
+                Expense.name,
+                Expense.account_number,
+                Expense.sub_code,
+                Expense.tags,
+                Expense.created_at,
+                Allocation.period_type,
+                Allocation.period,
+                Allocation.quarter,
+                Allocation.year,
+                Allocation.start_date,
+                Allocation.end_date,
+                Allocation.days_in_quarter,
+                Allocation.amount,
+                (Expense.total_amount + func.coalesce(Expense.already_allocated, 0)).label('total_value')
+            )
+            .join(Expense, Allocation.expense_id == Expense.id)
+        )
+        if year is not None:
+            # System rows before the selected range enter as an opening balance
+            earlier = aliased(Allocation)
+            before = earlier.year < year
+            if quarter is not None:
+                before = or_(before, and_(earlier.year == year, earlier.quarter < quarter))
+            opening = (
+                select(earlier.expense_id, func.sum(earlier.amount).label('amount'))
+                .where(earlier.days_in_quarter > 0, before)
+                .group_by(earlier.expense_id)
+                .subquery()
+            )
+            rows = rows.outerjoin(opening, opening.c.expense_id == Allocation.expense_id)
+            accumulated = accumulated + func.coalesce(opening.c.amount, 0)
+            rows = rows.where(Allocation.year == year)
+            if quarter is not None:
+                rows = rows.where(Allocation.quarter == quarter)
+        if expense_ids is not None:
+            id_filter = ExpenseIndexService.id_filter(Allocation.expense_id, expense_ids)
+            rows = rows.where(or_(Allocation.days_in_quarter == 0, id_filter) if keep_historical else id_filter)
+        rows = rows.add_columns(accumulated.label('accumulated')).subquery()
+
+        query = select(
+            *[c for c in rows.c if c.name not in ('created_at', 'total_value')],
+            (rows.c.total_value - rows.c.accumulated).label('remaining')
+        )
+        if year is None and quarter is not None:
+            # Without a year the window runs over every year first
+            query = query.where(rows.c.quarter == quarter)
+        query = query.order_by(
+            rows.c.year, rows.c.quarter, rows.c.period, rows.c.created_at.desc(), rows.c.id
+        )
+
+        result = db.execute(query)
+        return pd.DataFrame(result.all(), columns=list(result.keys()))
+
+    @staticmethod
+    def roll_forward_periods(from_date: date, to_date: date, period_type: Optional[str] = None) -> pd.DataFrame:
+        """
+        Get the periods of a roll-forward, clipped to the date range.
+
+        Args:
+            from_date: First day of the range
+            to_date: Last day of the range
+            period_type: 'month', 'quarter' or 'year'; None for the whole range
+                as one period
+
+        Returns:
+            DataFrame with period_label, start_date and end_date per period
+        """
+        if to_date < from_date:
+            raise ValueError("to_date must not be before from_date")
+        if period_type is None:
+            label = f"{from_date.strftime('%d/%m/%Y')} - {to_date.strftime('%d/%m/%Y')}"
+            return pd.DataFrame({'period_label': [label], 'start_date': [from_date], 'end_date': [to_date]})
+
+        cal = calendar_covering(np.array([from_date.toordinal(), to_date.toordinal()]), period_type)
+        periods = slice(cal.index_of(from_date), cal.index_of(to_date) + 1)
+        starts = np.maximum(cal.period_start[periods], from_date.toordinal())
+        ends = np.minimum(cal.period_end[periods], to_date.toordinal())
+        return pd.DataFrame({
+            'period_label': [
+                format_period(period_type, p, y)
+                for p, y in zip(cal.period_number[periods].tolist(), cal.period_year[periods].tolist())
+            ],
+            'start_date': [date.fromordinal(o) for o in starts.tolist()],
+            'end_date': [date.fromordinal(o) for o in ends.tolist()]
+        })
+
+    @staticmethod
+    def roll_forward(db, from_date: date, to_date: date, period_type: Optional[str] = None) -> pd.DataFrame:
+        """
+        Get the prepaid roll-forward (opening, additions, amortization, closing) by account and sub code.
+
+        One aggregate query sums, per account/sub code and period bucket
+        (bucket 0 = everything before from_date), the value of expenses
+        starting in the bucket and the amortization charged in it: the
+        historical amount on the start date plus, for each system row,
+        accumulated through the bucket end minus accumulated through the day
+        before the bucket start (pro-rated as in balance_report). Opening and
+        closing balances are running sums of additions - amortization, so
+        closing equals the balance report of the expenses started by then.
+
+        Args:
+            db: Database session
+            from_date: First day of the range
+            to_date: Last day of the range
+            period_type: 'month', 'quarter' or 'year'; None for the whole range
+
+        Returns:
+            DataFrame with period_label, start_date, end_date, account_number,
+            sub_code, opening, additions, amortization and closing, in period
+            then account order; groups with nothing to report in a period are
+            left out
+        """
+        periods = ReportService.roll_forward_periods(from_date, to_date, period_type)
+        day = timedelta(days=1)
+        n_periods = len(periods)
+
+        # Bucket of a date in the range, by calendar month arithmetic on the stored ISO date
+        if period_type is None:
+            def bucket_of(column):
+                return literal(1, Integer)
+            max_span = 1
+        else:
+            months = PERIOD_MONTHS[period_type]
+            first_month = from_date.year * 12 + from_date.month - (from_date.month - active_start_month()) % months
+
+            def bucket_of(column):
+                month = cast(func.substr(column, 1, 4), Integer) * 12 + cast(func.substr(column, 6, 2), Integer)
+                return func.min(func.max((month - first_month) // months + 1, 1), n_periods)
+            # Allocation rows never exceed a year, so they touch at most this many periods
+            max_span = 12 // months + 1
+
+        buckets = union_all(*[
+            select(
+                literal(bucket, Integer).label('bucket'),
+                literal(start, Date).label('start_date'),
+                literal(end, Date).label('end_date'),
+                literal(start - day, Date).label('prior_date')
+            )
+            for bucket, (start, end) in enumerate(zip(periods['start_date'], periods['end_date']), start=1)
+        ]).cte('buckets')
+        # Every (first, last) bucket pair a row can touch with the buckets in between,
+        # so rows find their periods by an equality lookup instead of a range scan
+        first, last, inner = buckets.alias('first_bucket'), buckets.alias('last_bucket'), buckets.alias('inner_bucket')
+        spans = (
+            select(
+                first.c.bucket.label('first'),
+                last.c.bucket.label('last'),
+                inner.c.bucket,
+                inner.c.start_date,
+                inner.c.end_date,
+                inner.c.prior_date
+            )
+            .join(last, and_(last.c.bucket >= first.c.bucket, last.c.bucket < first.c.bucket + max_span))
+            .join(inner, inner.c.bucket.between(first.c.bucket, last.c.bucket))
+            .cte('spans')
+            .prefix_with('MATERIALIZED')
+        )
+
+        # Bucket 0 holds everything before from_date
+        historical = func.coalesce(Expense.already_allocated, 0)
+        additions = (
+            select(
+                Expense.account_number,
+                Expense.sub_code,
+                case((Expense.start_date < from_date, 0), else_=bucket_of(Expense.start_date)).label('bucket'),
+                (Expense.total_amount + historical).label('additions'),
+                historical.label('amortization')
+            )
+            .where(Expense.start_date <= to_date)
+        )
+        # Rows started before the range count through its eve in the opening bucket
+        opening = (
+            select(
+                Expense.account_number,
+                Expense.sub_code,
+                literal(0, Integer),
+                literal(0, Integer),
+                ReportService.accumulated_amount(from_date - day)
+            )
+            .join(Expense, Allocation.expense_id == Expense.id)
+            .where(Allocation.days_in_quarter > 0, Allocation.start_date < from_date)
+        )
+        charged_before = case(
+            (Allocation.start_date > spans.c.prior_date, 0),
+            else_=ReportService.accumulated_amount(spans.c.prior_date)
+        )
+        charged = (
+            select(
+                Expense.account_number,
+                Expense.sub_code,
+                spans.c.bucket,
+                literal(0, Integer),
+                ReportService.accumulated_amount(spans.c.end_date) - charged_before
+            )
+            .join(Expense, Allocation.expense_id == Expense.id)
+            .join(spans, and_(
+                spans.c.first == bucket_of(Allocation.start_date),
+                spans.c.last == bucket_of(Allocation.end_date)
+            ))
+            .where(
+                Allocation.days_in_quarter > 0,
+                Allocation.start_date <= to_date,
+                Allocation.end_date >= from_date
+            )
+        )
+        movements = union_all(additions, opening, charged).subquery()
+        query = (
+            select(
+                movements.c.account_number,
+                movements.c.sub_code,
+                movements.c.bucket,
+                func.sum(movements.c.additions).label('additions'),
+                func.sum(movements.c.amortization).label('amortization')
+            )
+            .group_by(movements.c.account_number, movements.c.sub_code, movements.c.bucket)
+        )
+        sums = pd.DataFrame(db.execute(query).all(), columns=['account_number', 'sub_code', 'bucket', 'additions', 'amortization'])
+
+        columns = list(periods.columns) + ['account_number', 'sub_code', 'opening', 'additions', 'amortization', 'closing']
+        if sums.empty:
+            return pd.DataFrame(columns=columns)
+
+        # (group, bucket) matrices; balances are running sums over buckets
+        n_buckets = n_periods + 1
+        grouped = sums.set_index(['account_number', 'sub_code', 'bucket'])[['additions', 'amortization']].unstack(
+            'bucket', fill_value=0
+        )
+        added = grouped['additions'].reindex(columns=range(n_buckets), fill_value=0).to_numpy(dtype=np.int64)
+        charged_amounts = grouped['amortization'].reindex(columns=range(n_buckets), fill_value=0).to_numpy(dtype=np.int64)
+        closing = np.cumsum(added - charged_amounts, axis=1)
+
+        n_groups = len(grouped)
+        result = pd.DataFrame({
+            **{column: np.repeat(periods[column].to_numpy(), n_groups) for column in periods.columns},
+            'account_number': np.tile(grouped.index.get_level_values('account_number').to_numpy(), len(periods)),
+            'sub_code': np.tile(grouped.index.get_level_values('sub_code').to_numpy(), len(periods)),
+            'opening': closing[:, :-1].T.ravel(),
+            'additions': added[:, 1:].T.ravel(),
+            'amortization': charged_amounts[:, 1:].T.ravel(),
+            'closing': closing[:, 1:].T.ravel()
+        })
+        active = result[['opening', 'additions', 'amortization', 'closing']].to_numpy().any(axis=1)
+        return result[active].reset_index(drop=True)[columns]
+
+    @staticmethod
+    def maturity_report(db, as_of: date) -> pd.DataFrame:
+        """
+        Split every balance on a date into current and non-current parts and age it by maturity.
+
+        The current part is what amortizes within CURRENT_MONTHS after as_of
+        (from the stored rows, the open periods pro-rated), whatever sub_code
+        the expense was created with; the rest is non-current. Balances and
+        the current part come from one query (balances from the latest
+        close snapshot); months to maturity and buckets are array operations.
+
+        Args:
+            db: Database session
+            as_of: Report date
+
+        Returns:
+            DataFrame with id, name, account_number, sub_code, tags,
+            document_code, end_date, balance, current, non_current,
+            months_to_maturity and maturity_bucket (ordered categorical of
+            MATURITY_LABELS) for expenses with a balance, newest expense first
+        """
+        horizon = add_months(as_of, CURRENT_MONTHS)
+        balances = ReportService.balance_query(as_of, ReportService.snapshot_date(db, as_of)).subquery()
+        upcoming = (
+            select(
+                Allocation.expense_id,
+                func.sum(ReportService.allocated_between(as_of, horizon)).label('amount')
+            )
+            .where(Allocation.days_in_quarter > 0, Allocation.end_date > as_of, Allocation.start_date <= horizon)
+            .group_by(Allocation.expense_id)
+            .subquery()
+        )
+        current = func.coalesce(upcoming.c.amount, 0)
+        query = (
+            select(
+                balances.c.id,
+                balances.c.name,
+                balances.c.account_number,
+                balances.c.sub_code,
+                balances.c.tags,
+                balances.c.document_code,
+                Expense.end_date,
+                balances.c.balance,
+                current.label('current'),
+                (balances.c.balance - current).label('non_current')
+            )
+            .join(Expense, Expense.id == balances.c.id)
+            .outerjoin(upcoming, upcoming.c.expense_id == balances.c.id)
+            .where(balances.c.balance != 0)
+            .order_by(Expense.created_at.desc(), Expense.id.desc())
+        )
+        result = db.execute(query)
+        report = pd.DataFrame(result.all(), columns=list(result.keys()))
+
+        # Whole months from as_of to the end date, a started month counting as one
+        end_dates = pd.to_datetime(report['end_date']).to_numpy(dtype='datetime64[D]')
+        end_months = end_dates.astype('datetime64[M]')
+        end_days = (end_dates - end_months.astype('datetime64[D]')).astype(np.int64) + 1
+        months = (end_months - np.datetime64(as_of, 'M')).astype(np.int64) + (end_days > as_of.day)
+        report['months_to_maturity'] = np.maximum(months, 0)
+        report['maturity_bucket'] = pd.Categorical.from_codes(
+            np.searchsorted(MATURITY_BOUNDS, report['months_to_maturity'].to_numpy()),
+            categories=list(MATURITY_LABELS),
+            ordered=True
+        )
+        return report
+
+
+@event.listens_for(SessionLocal, 'after_flush')
+def _note_report_writes(session, flush_context):
+    """Remember that the transaction wrote report data."""
+    if any(isinstance(obj, (Expense, Allocation)) for obj in chain(session.new, session.dirty, session.deleted)):
+        session.info[_WRITTEN_KEY] = True
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _bump_report_generation(session):
+    """Start a new data generation once written data is committed."""
+    if session.info.pop(_WRITTEN_KEY, False):
+        ReportService.bump_generation()
+
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def _discard_report_writes(session):
+    """Forget writes of a rolled back transaction."""
+    session.info.pop(_WRITTEN_KEY, None)
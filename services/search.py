@@ -0,0 +1,94 @@
+"""Full-text expense search over the FTS5 index kept in sync by triggers (models/database.py)."""
+import re
+from typing import Optional
+from sqlalchemy import column, func, select, table, text
+from models.database import SessionLocal, Expense, SEARCH_FIELDS, search_values
+
+expenses_fts = table('expenses_fts', column('rowid'), column('expenses_fts'))
+
+# bm25 weight of each SEARCH_FIELDS column: name and document code rank first
+SEARCH_WEIGHTS = (10.0, 2.0, 1.0, 5.0, 1.0)
+
+
+class SearchService:
+    """Service answering free-text expense searches from the FTS5 index."""
+
+    @staticmethod
+    def match_query(term: str) -> Optional[str]:
+        """
+        Build an FTS5 query matching every word of a search term as a prefix.
+
+        Words are quoted so FTS syntax in user input is taken literally;
+        đ/Đ are folded to d/D as in the index.
+
+        Returns:
+            str: e.g. '"phan"* "mem"*', or None if the term has no words
+        """
+        words = re.findall(r"\w+", term.replace('đ', 'd').replace('Đ', 'D'))
+        return " ".join(f'"{word}"*' for word in words) or None
+
+    @staticmethod
+    def ranked(term: str):
+        """
+        Get a subquery of (expense_id, rank) for expenses matching a search term.
+
+        Lower rank is better (bm25).
+
+        Returns:
+            Subquery, or None if the term has no words
+        """
+        match = SearchService.match_query(term)
+        if match is None:
+            return None
+        return (
+            select(
+                expenses_fts.c.rowid.label('expense_id'),
+                func.bm25(expenses_fts.c.expenses_fts, *SEARCH_WEIGHTS).label('rank')
+            )
+            .where(expenses_fts.c.expenses_fts.match(match))
+            .subquery('search')
+        )
+
+    @staticmethod
+    def rebuild(db) -> int:
+        """
+        Refill the search index from the expenses table (migration and repair).
+
+        Args:
+            db: Database session; the rebuild is committed
+
+        Returns:
+            Number of indexed expenses
+        """
+        db.execute(text("DELETE FROM expenses_fts"))
+        result = db.execute(text(
+            f"INSERT INTO expenses_fts (rowid, {', '.join(SEARCH_FIELDS)}) "
+            f"SELECT id, {search_values('expenses')} FROM expenses"
+        ))
+        db.commit()
+        return result.rowcount
+
+    @staticmethod
+    def ensure_built(db) -> bool:
+        """
+        Fill the search index if it is empty while expenses exist.
+
+        Covers databases created before the index existed and restored backups.
+
+        Returns:
+            bool: Whether a rebuild was done
+        """
+        if db.execute(text("SELECT rowid FROM expenses_fts LIMIT 1")).first() is not None:
+            return False
+        if db.execute(select(Expense.id).limit(1)).first() is None:
+            return False
+        SearchService.rebuild(db)
+        return True
+
+
+if __name__ == "__main__":
+    db = SessionLocal()
+    try:
+        print(f"[OK] Rebuilt search index: {SearchService.rebuild(db)} expenses")
+    finally:
+        db.close()
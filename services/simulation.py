@@ -0,0 +1,172 @@
+"""What-if simulation of bulk changes to expense end dates and amounts."""
+from datetime import date
+from typing import Dict, Optional, Sequence
+import numpy as np
+import pandas as pd
+from services.allocation import _split_origins, _to_dong_array
+from services.allocation_methods import accumulated_grouped
+from services.projection import ProjectionService
+from utils.fiscal_calendar import PERIOD_QUARTER, ordinals_to_datetime64, to_ordinals
+
+
+def _shift_months(ordinals: np.ndarray, months: int) -> np.ndarray:
+    """Add months to day ordinals, clipping to the last day of the target month."""
+    days = ordinals_to_datetime64(ordinals)
+    month_start = days.astype('datetime64[M]')
+    target = month_start + months
+    last_day = (target + 1).astype('datetime64[D]') - 1
+    shifted = np.minimum(target.astype('datetime64[D]') + (days - month_start.astype('datetime64[D]')), last_day)
+    return to_ordinals(shifted)
+
+
+class SimulationService:
+    """Service for what-if scenarios on an in-memory copy of the portfolio."""
+
+    @staticmethod
+    def select_expenses(
+        expenses: Sequence,
+        tags: Optional[Sequence[str]] = None,
+        accounts: Optional[Sequence[str]] = None
+    ) -> np.ndarray:
+        """
+        Get a mask of the expenses a scenario applies to.
+
+        Args:
+            expenses: Expense records
+            tags: Keep expenses having any of these tags (None for all)
+            accounts: Keep expenses on these account numbers (None for all)
+
+        Returns:
+            np.ndarray: Boolean mask aligned with expenses
+        """
+        mask = np.ones(len(expenses), dtype=bool)
+        if tags:
+            wanted = set(tags)
+            mask &= np.array([
+                bool(wanted.intersection(t.strip() for t in (e.tags or "").split(','))) for e in expenses
+            ], dtype=bool)
+        if accounts:
+            mask &= np.isin(np.array([e.account_number for e in expenses], dtype=object), list(accounts))
+        return mask
+
+    @staticmethod
+    def simulate(
+        total_amounts: Sequence[int],
+        start_dates: Sequence[date],
+        end_dates: Sequence[date],
+        selected: np.ndarray,
+        from_date: date,
+        years: int,
+        period_type: str = PERIOD_QUARTER,
+        end_shift_months: int = 0,
+        amount_change_pct: float = 0.0,
+        rebase_dates: Optional[Sequence[Optional[date]]] = None,
+        rebase_accumulated: Optional[Sequence[int]] = None,
+        methods: Optional[Sequence[Optional[str]]] = None,
+        params: Optional[Sequence[Optional[Dict]]] = None
+    ) -> pd.DataFrame:
+        """
+        Compare per-period amortization before and after a hypothetical change.
+
+        The change works like a schedule edit made at the start of the first
+        projected period: amounts allocated before it are kept and only the
+        remainder is re-split. Expenses that ended before that day are not
+        changed. Nothing is written to the database.
+
+        Args:
+            total_amounts, start_dates, end_dates: Portfolio columns
+            selected: Boolean mask of expenses the change applies to
+            from_date: Date whose period starts the comparison
+            years: Horizon in years
+            period_type: 'month', 'quarter' or 'year'
+            end_shift_months: Months added to the end date (negative = earlier)
+            amount_change_pct: Percent change of the total amount
+            rebase_dates: Rebase date of each expense, None if never edited
+            rebase_accumulated: System allocation before each rebase date
+            methods: Allocation method of each expense (default all daily)
+            params: Method parameters of each expense
+
+        Returns:
+            DataFrame with one row per period: period, quarter, year,
+            period_label, start_date, end_date, baseline, scenario and delta
+        """
+        n = len(total_amounts)
+        totals = _to_dong_array(total_amounts)
+        starts = to_ordinals(start_dates)
+        ends = to_ordinals(end_dates)
+        origins, base = _split_origins(starts, rebase_dates, rebase_accumulated)
+        methods = list(methods) if methods is not None else [None] * n
+        params = list(params) if params is not None else [None] * n
+
+        baseline = ProjectionService.project_amortization(
+            totals, ordinals_to_datetime64(starts), ordinals_to_datetime64(ends), from_date, years, period_type,
+            rebase_dates=ordinals_to_datetime64(origins), rebase_accumulated=base,
+            methods=methods, params=params
+        )
+        result = baseline.drop(columns='amount')
+        result['baseline'] = baseline['amount'].to_numpy()
+
+        effective = baseline['start_date'].iloc[0].toordinal()
+        rows = np.flatnonzero(np.asarray(selected, dtype=bool) & (ends >= effective))
+        if len(rows) == 0:
+            result['scenario'] = result['baseline']
+            result['delta'] = 0
+            return result
+
+        totals, starts, ends, origins, base = totals[rows], starts[rows], ends[rows], origins[rows], base[rows]
+        methods = [methods[i] for i in rows]
+        params = [params[i] for i in rows]
+
+        # Freeze what was allocated before the effective date
+        new_origins = np.maximum(origins, effective)
+        new_base = accumulated_grouped(methods, totals, starts, ends, new_origins - 1, params, origins, base)
+        new_totals = np.maximum(np.rint(totals * (1 + amount_change_pct / 100.0)).astype(np.int64), new_base)
+        new_ends = np.maximum(_shift_months(ends, end_shift_months), new_origins)
+
+        before = ProjectionService.project_amortization(
+            totals, ordinals_to_datetime64(starts), ordinals_to_datetime64(ends), from_date, years, period_type,
+            rebase_dates=ordinals_to_datetime64(origins), rebase_accumulated=base,
+            methods=methods, params=params
+        )['amount'].to_numpy()
+        after = ProjectionService.project_amortization(
+            new_totals, ordinals_to_datetime64(starts), ordinals_to_datetime64(new_ends), from_date, years, period_type,
+            rebase_dates=ordinals_to_datetime64(new_origins), rebase_accumulated=new_base,
+            methods=methods, params=params
+        )['amount'].to_numpy()
+
+        result['delta'] = after - before
+        result['scenario'] = result['baseline'] + result['delta']
+        return result[[c for c in result.columns if c != 'delta'] + ['delta']]
+
+    @staticmethod
+    def simulate_expenses(
+        expenses: Sequence,
+        from_date: date,
+        years: int,
+        period_type: str = PERIOD_QUARTER,
+        tags: Optional[Sequence[str]] = None,
+        accounts: Optional[Sequence[str]] = None,
+        end_shift_months: int = 0,
+        amount_change_pct: float = 0.0
+    ) -> pd.DataFrame:
+        """
+        Run simulate on expense records filtered by tag and account.
+
+        Returns:
+            DataFrame as returned by simulate
+        """
+        return SimulationService.simulate(
+            [e.total_amount for e in expenses],
+            [e.start_date for e in expenses],
+            [e.end_date for e in expenses],
+            SimulationService.select_expenses(expenses, tags, accounts),
+            from_date,
+            years,
+            period_type,
+            end_shift_months,
+            amount_change_pct,
+            rebase_dates=[e.rebase_date for e in expenses],
+            rebase_accumulated=[e.rebase_accumulated or 0 for e in expenses],
+            methods=[e.allocation_method for e in expenses],
+            params=[e.allocation_params for e in expenses]
+        )
@@ -0,0 +1,178 @@
+"""Normalized tag tables kept in sync with the comma-separated expense tags on flush."""
+from threading import Lock
+from typing import Iterable, List, Optional, Sequence
+from sqlalchemy import delete, event, func, inspect, select
+from sqlalchemy.dialects.sqlite import insert
+from models.database import SessionLocal, Expense, Tag, ExpenseTag
+from services.expense_index import ExpenseIndexService
+
+# session.info flag set when a flush changed tag links
+_CHANGED_KEY = 'tag_links_changed'
+
+
+class TagIndexService:
+    """Service maintaining the tags/expense_tags tables and filtering expenses by tag."""
+
+    # Distinct tag names in use, shared across reruns; reloaded after tag changes are committed
+    _names: Optional[List[str]] = None
+    _lock = Lock()
+
+    @staticmethod
+    def split_tags(value: Optional[str]) -> List[str]:
+        """
+        Split a comma-separated tag string into distinct stripped tags.
+
+        Returns:
+            Tags in their first-seen order, without empty entries
+        """
+        if not value:
+            return []
+        return list(dict.fromkeys(tag.strip() for tag in value.split(',') if tag.strip()))
+
+    @staticmethod
+    def sync(connection, expense_ids: Iterable[int]):
+        """
+        Rewrite the tag links of some expenses from their tags column.
+
+        Deleted expenses lose their links; tags no expense uses any more
+        are removed.
+
+        Args:
+            connection: Connection of the transaction being flushed
+            expense_ids: Expenses whose tags may have changed
+        """
+        expense_ids = list(expense_ids)
+        connection.execute(delete(ExpenseTag).where(ExpenseIndexService.id_filter(ExpenseTag.expense_id, expense_ids)))
+
+        rows = connection.execute(
+            select(Expense.id, Expense.tags)
+            .where(ExpenseIndexService.id_filter(Expense.id, expense_ids), Expense.tags.isnot(None))
+        ).all()
+        links = [(expense_id, tag) for expense_id, tags in rows for tag in TagIndexService.split_tags(tags)]
+        if links:
+            names = sorted({tag for _, tag in links})
+            connection.execute(insert(Tag).on_conflict_do_nothing(), [{'name': name} for name in names])
+            # The tags table holds one row per distinct tag, so it is read whole
+            tag_ids = dict(connection.execute(select(Tag.name, Tag.id)).all())
+            connection.execute(insert(ExpenseTag), [
+                {'expense_id': expense_id, 'tag_id': tag_ids[tag]} for expense_id, tag in links
+            ])
+        connection.execute(delete(Tag).where(Tag.id.not_in(select(ExpenseTag.tag_id))))
+
+    @staticmethod
+    def rebuild(db) -> int:
+        """
+        Recompute both tag tables from the tags column of every expense (migration and repair).
+
+        Args:
+            db: Database session; the rebuild is committed
+
+        Returns:
+            Number of expense/tag links written
+        """
+        connection = db.connection()
+        connection.execute(delete(ExpenseTag))
+        TagIndexService.sync(connection, [expense_id for (expense_id,) in connection.execute(select(Expense.id))])
+        count = connection.execute(select(func.count()).select_from(ExpenseTag)).scalar()
+        db.commit()
+        TagIndexService.invalidate()
+        return count
+
+    @staticmethod
+    def ensure_built(db) -> bool:
+        """
+        Rebuild the tag tables if they are empty while expenses have tags.
+
+        Covers databases created before the tables existed and restored backups.
+
+        Returns:
+            bool: Whether a rebuild was done
+        """
+        if db.execute(select(ExpenseTag.tag_id).limit(1)).first() is not None:
+            return False
+        if db.execute(select(Expense.id).where(Expense.tags.isnot(None), Expense.tags != "").limit(1)).first() is None:
+            return False
+        TagIndexService.rebuild(db)
+        return True
+
+    @staticmethod
+    def tag_names(db=None) -> List[str]:
+        """
+        Get the sorted distinct tags used by any expense, loaded once per committed tag change.
+
+        Args:
+            db: Database session to load with (a new session if omitted)
+        """
+        with TagIndexService._lock:
+            if TagIndexService._names is None:
+                session = db or SessionLocal()
+                try:
+                    names = session.execute(
+                        select(Tag.name).where(Tag.id.in_(select(ExpenseTag.tag_id))).order_by(Tag.name)
+                    ).scalars().all()
+                finally:
+                    if db is None:
+                        session.close()
+                TagIndexService._names = list(names)
+            return list(TagIndexService._names)
+
+    @staticmethod
+    def tag_filter(column, tags: Sequence[str]):
+        """
+        Build a filter keeping expense ids that have any of the given tags (exact match, indexed join).
+
+        Args:
+            column: Expense id column to filter
+            tags: Tag names
+        """
+        return column.in_(
+            select(ExpenseTag.expense_id)
+            .join(Tag, Tag.id == ExpenseTag.tag_id)
+            .where(Tag.name.in_(list(tags)))
+        )
+
+    @staticmethod
+    def invalidate():
+        """Drop the cached tag names so the next lookup reloads them (e.g. after a database restore)."""
+        with TagIndexService._lock:
+            TagIndexService._names = None
+
+
+def _changed_expense_ids(session) -> List[int]:
+    """Get ids of persisted expenses whose tag links a flush may change."""
+    expense_ids = []
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Expense) and obj.id is not None:
+            if obj in session.new or obj in session.deleted or inspect(obj).attrs.tags.history.has_changes():
+                expense_ids.append(obj.id)
+    return expense_ids
+
+
+@event.listens_for(SessionLocal, 'after_flush')
+def _sync_tag_links(session, flush_context):
+    """Apply flushed tag changes to the link tables in the same transaction."""
+    expense_ids = _changed_expense_ids(session)
+    if expense_ids:
+        TagIndexService.sync(session.connection(), expense_ids)
+        session.info[_CHANGED_KEY] = True
+
+
+@event.listens_for(SessionLocal, 'after_commit')
+def _reload_tag_names(session):
+    """Drop the cached tag names once tag changes are committed."""
+    if session.info.pop(_CHANGED_KEY, False):
+        TagIndexService.invalidate()
+
+
+@event.listens_for(SessionLocal, 'after_rollback')
+def _discard_tag_changes(session):
+    """Forget tag changes of a rolled back transaction."""
+    session.info.pop(_CHANGED_KEY, None)
+
+
+if __name__ == "__main__":
+    db = SessionLocal()
+    try:
+        print(f"[OK] Rebuilt tag index: {TagIndexService.rebuild(db)} links")
+    finally:
+        db.close()
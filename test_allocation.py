@@ -2,6 +2,7 @@
 from datetime import date
 import sys
 import os
+import numpy as np
 
 # Add parent directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -9,6 +10,28 @@ sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 from services.allocation import AllocationService
 from utils.helpers import format_currency, format_quarter
 
+
+def _memory_session():
+    """Open a session on a new in-memory database with every table created."""
+    from sqlalchemy import create_engine
+    from models.database import Base, SessionLocal
+    
+    engine = create_engine("sqlite://")
+    Base.metadata.create_all(bind=engine)
+    return SessionLocal(bind=engine)
+
+
+def _add_scheduled_expense(db, total_amount, start_date, end_date, period_type='quarter', **fields):
+    """Add an expense with the allocation rows of its schedule to a session (not committed)."""
+    from models.database import Expense
+    
+    fields = {'account_number': "242001", 'name': f"CP {total_amount}", 'sub_code': "9996", **fields}
+    expense = Expense(total_amount=total_amount, start_date=start_date, end_date=end_date, **fields)
+    schedule = AllocationService.calculate_allocations(total_amount, start_date, end_date, period_type)
+    expense.allocations.extend(AllocationService.schedule_to_allocations(schedule))
+    db.add(expense)
+    return expense
+
 def test_allocation():
     """Test the allocation algorithm with sample data."""
     
@@ -124,5 +147,942 @@ def test_allocation():
     print("=" * 80)
 
 
+
+def test_batch_allocation_matches_scalar():
+    """Batch engine must reproduce the scalar schedule row for row."""
+    cases = [
+        (36_000_000, date(2024, 1, 15), date(2025, 1, 14)),
+        (54_000_000, date(2024, 3, 1), date(2025, 8, 31)),
+        (1_000_001, date(2023, 12, 31), date(2024, 1, 1)),
+        (7_777_777, date(2024, 2, 29), date(2029, 2, 28)),
+        (500_000, date(2024, 5, 5), date(2024, 5, 5)),
+    ]
+    
+    batch = AllocationService.calculate_batch_allocations(
+        [c[0] for c in cases],
+        [c[1] for c in cases],
+        [c[2] for c in cases]
+    )
+    
+    expected = []
+    for idx, (total_amount, start_date, end_date) in enumerate(cases):
+        for alloc in AllocationService.calculate_quarterly_allocations(total_amount, start_date, end_date):
+            expected.append((
+                idx, alloc['quarter'], alloc['year'], alloc['amount'],
+                alloc['days_in_quarter'], alloc['start_date'], alloc['end_date']
+            ))
+    
+    actual = [
+        (r.expense_index, r.quarter, r.year, r.amount,
+         r.days_in_quarter, r.start_date.date(), r.end_date.date())
+        for r in batch.itertuples(index=False)
+    ]
+    
+    assert actual == expected
+
+
+
+def test_allocation_split_reconciles():
+    """Integer split sums to the total and stays within 1 đồng of each exact share."""
+    total_amount = 1_000_000_007
+    start_date = date(2023, 11, 17)
+    end_date = date(2027, 2, 3)
+    
+    allocations = AllocationService.calculate_quarterly_allocations(total_amount, start_date, end_date)
+    total_days = allocations[0]['total_days']
+    
+    assert sum(a['amount'] for a in allocations) == total_amount
+    for alloc in allocations:
+        assert isinstance(alloc['amount'], int)
+        exact_share = total_amount * alloc['days_in_quarter'] / total_days
+        assert abs(alloc['amount'] - exact_share) < 1
+
+
+
+def test_monthly_schedule_rolls_up_to_quarterly():
+    """Monthly and yearly schedules reconcile exactly with the quarterly one."""
+    total_amount = 123_456_789
+    start_date = date(2024, 2, 10)
+    end_date = date(2029, 2, 9)
+    
+    quarterly = AllocationService.calculate_allocations(total_amount, start_date, end_date, 'quarter')
+    monthly = AllocationService.calculate_allocations(total_amount, start_date, end_date, 'month')
+    yearly = AllocationService.calculate_allocations(total_amount, start_date, end_date, 'year')
+    
+    assert len(monthly) == 61
+    assert len(yearly) == 6
+    
+    monthly_by_quarter = {}
+    for alloc in monthly:
+        key = (alloc['year'], alloc['quarter'])
+        monthly_by_quarter[key] = monthly_by_quarter.get(key, 0) + alloc['amount']
+    
+    assert monthly_by_quarter == {(a['year'], a['quarter']): a['amount'] for a in quarterly}
+    assert sum(a['amount'] for a in yearly) == total_amount
+
+
+
+def test_schedule_cache_reuses_immutable_schedules():
+    """Equal (amount, start, end, period) parameters share one cached schedule."""
+    AllocationService.clear_schedule_cache()
+    
+    first = AllocationService.get_schedule(12_000_000, date(2024, 1, 1), date(2024, 12, 31))
+    again = AllocationService.get_schedule(12_000_000.0, date(2024, 1, 1), date(2024, 12, 31))
+    batch = AllocationService.get_schedules(
+        [12_000_000, 6_000_000, 6_000_000],
+        [date(2024, 1, 1)] * 3,
+        [date(2024, 12, 31), date(2024, 6, 30), date(2024, 6, 30)]
+    )
+    
+    assert again is first
+    assert batch[0] is first
+    assert batch[1] is batch[2]
+    assert [dict(a) for a in batch[1]] == AllocationService.calculate_allocations(
+        6_000_000, date(2024, 1, 1), date(2024, 6, 30)
+    ).to_dicts()
+    assert AllocationService.schedule_cache_info()['hits'] == 2
+    
+    try:
+        first[0]['amount'] = 0
+        assert False, "Cached schedules must be read-only"
+    except TypeError:
+        pass
+
+
+def test_allocation_schedule_views():
+    """Schedules expose array views, a zero-copy DataFrame and a summary."""
+    schedule = AllocationService.calculate_allocations(10_000_000, date(2024, 2, 15), date(2025, 2, 14))
+    
+    df = schedule.to_dataframe()
+    assert np.shares_memory(df['amount'].to_numpy(), schedule.rows)
+    assert df['amount'].tolist() == [a['amount'] for a in schedule]
+    assert schedule.cumulative()[-1] == 10_000_000
+    assert schedule[-1]['end_date'] == date(2025, 2, 14)
+    
+    summary = schedule.summary()
+    assert summary['total_quarters'] == 5
+    assert summary['total_allocated'] == 10_000_000
+    assert summary['total_days'] == schedule.total_days == 366
+    assert (summary['first_quarter'], summary['last_quarter']) == ('Q1/2024', 'Q1/2025')
+
+
+def test_accumulated_at_matches_schedule():
+    """Closed-form accumulated amount agrees with the stored schedule."""
+    class _Expense:
+        total_amount = 99_999_999
+        start_date = date(2024, 2, 10)
+        end_date = date(2026, 11, 20)
+        already_allocated = 1_000_000
+    
+    expense = _Expense()
+    schedule = AllocationService.calculate_allocations(
+        expense.total_amount, expense.start_date, expense.end_date, 'month'
+    )
+    
+    for alloc, cumulative in zip(schedule, schedule.cumulative()):
+        assert AllocationService.accumulated_at(expense, alloc['end_date']) == 1_000_000 + cumulative
+    assert AllocationService.accumulated_at(expense, date(2024, 1, 1)) == 1_000_000
+    assert AllocationService.accumulated_at(expense, date(2030, 1, 1)) == 100_999_999
+    
+    as_of = [date(2023, 12, 31), date(2024, 2, 10), date(2025, 6, 17), date(2026, 11, 20)]
+    batch = AllocationService.accumulated_at_batch(
+        [expense.total_amount] * 4, [expense.start_date] * 4, [expense.end_date] * 4, as_of, [1_000_000] * 4
+    )
+    assert batch.tolist() == [AllocationService.accumulated_at(expense, d) for d in as_of]
+
+
+def test_reschedule_touches_only_open_periods():
+    """Extending a long lease near its end rewrites only the open periods."""
+    db = _memory_session()
+    start_date, end_date = date(2020, 1, 1), date(2029, 12, 31)
+    schedule = AllocationService.calculate_allocations(40_000_000, start_date, end_date)
+    expense = _add_scheduled_expense(db, 40_000_000, start_date, end_date, name="Thuê văn phòng", already_allocated=0)
+    db.commit()
+    
+    counts = AllocationService.reschedule_expense(
+        db, expense, total_amount=41_000_000, end_date=date(2030, 3, 31), as_of=date(2029, 11, 15)
+    )
+    assert counts == {'inserted': 1, 'updated': 1, 'deleted': 0, 'unchanged': 0}
+    
+    allocations = sorted(expense.allocations, key=lambda a: (a.year, a.quarter))
+    assert len(allocations) == 41
+    assert sum(a.amount for a in allocations) == 41_000_000
+    assert [a.amount for a in allocations[:39]] == schedule.amounts[:39].tolist()
+    
+    # Closed form stays exact before and after the rebase point
+    running = 0
+    for alloc in allocations:
+        running += alloc.amount
+        assert AllocationService.accumulated_at(expense, alloc.end_date) == running
+    assert AllocationService.accumulated_at_expenses([expense], date(2025, 6, 30)).tolist() == [
+        AllocationService.accumulated_from_rows(allocations, date(2025, 6, 30))
+    ]
+    
+    # Early termination allocates the rest in the open period
+    counts = AllocationService.reschedule_expense(
+        db, expense, end_date=date(2029, 11, 15), as_of=date(2029, 11, 15)
+    )
+    assert counts['deleted'] == 1
+    assert AllocationService.accumulated_at(expense, date(2029, 11, 15)) == 41_000_000
+    db.close()
+
+
+def test_projection_matches_schedules():
+    """Projected period totals equal the sum of the stored schedules."""
+    from services.projection import ProjectionService
+    
+    cases = [
+        (36_000_000, date(2024, 1, 15), date(2025, 1, 14), "2421"),
+        (54_000_001, date(2023, 3, 1), date(2027, 8, 31), "2422"),
+        (7_777_777, date(2025, 2, 28), date(2026, 2, 27), "2421"),
+    ]
+    projection = ProjectionService.project_amortization(
+        [c[0] for c in cases], [c[1] for c in cases], [c[2] for c in cases],
+        from_date=date(2024, 5, 20), years=2, groups=[c[3] for c in cases]
+    )
+    
+    expected = {}
+    for total_amount, start_date, end_date, account in cases:
+        for alloc in AllocationService.calculate_allocations(total_amount, start_date, end_date):
+            if date(2024, 4, 1) <= alloc['start_date'] <= date(2026, 3, 31):
+                key = (account, alloc['year'], alloc['quarter'])
+                expected[key] = expected.get(key, 0) + alloc['amount']
+    
+    assert len(projection) == 2 * 8
+    assert {
+        (r.group, r.year, r.quarter): r.amount for r in projection.itertuples() if r.amount
+    } == expected
+    assert ProjectionService.to_pivot(projection).loc['TỔNG CỘNG', 'Tổng'] == sum(expected.values())
+    
+    # Multi-tag expenses count under each tag but once in the total row
+    from models.database import Expense
+    expenses = [
+        Expense(total_amount=total_amount, start_date=start_date, end_date=end_date, tags=tags)
+        for (total_amount, start_date, end_date, _), tags in zip(cases, ["IT, Thuê", "IT", None])
+    ]
+    by_tag = ProjectionService.project_expenses(expenses, date(2024, 5, 20), 2, group_by='tag')
+    portfolio = ProjectionService.project_expenses(expenses, date(2024, 5, 20), 2)
+    pivot = ProjectionService.to_pivot(by_tag, portfolio)
+    assert pivot.loc['TỔNG CỘNG', 'Tổng'] == sum(expected.values())
+    assert pivot.drop('TỔNG CỘNG')['Tổng'].sum() > sum(expected.values())
+    
+    # An edited expense projected from before its rebase date follows its stored rows
+    db = _memory_session()
+    edited = _add_scheduled_expense(db, 40_000_000, date(2024, 1, 1), date(2025, 12, 31))
+    db.commit()
+    AllocationService.reschedule_expense(db, edited, total_amount=41_000_000, as_of=date(2025, 5, 1))
+    projected = ProjectionService.project_expenses([edited], date(2024, 1, 1), 2)
+    assert projected['amount'].tolist() == [a.amount for a in sorted(edited.allocations, key=lambda a: a.start_date)]
+    db.close()
+
+
+def test_fiscal_year_calendar():
+    """Quarter lookups and schedules follow the configured fiscal year start."""
+    from config.settings import settings
+    from utils.helpers import get_quarter, get_quarter_dates, format_period
+    
+    original = settings.fiscal_year_start_month
+    settings.fiscal_year_start_month = 4
+    try:
+        assert get_quarter(date(2024, 5, 10)) == (1, 2024)
+        assert get_quarter(date(2025, 2, 1)) == (4, 2024)
+        assert get_quarter(date(1990, 3, 31)) == (4, 1989)
+        assert get_quarter_dates(4, 2024) == (date(2025, 1, 1), date(2025, 3, 31))
+        assert get_quarter_dates(2, 1990) == (date(1990, 7, 1), date(1990, 9, 30))
+        
+        schedule = AllocationService.calculate_allocations(12_000_000, date(2024, 3, 1), date(2025, 2, 28))
+        assert [(a['quarter'], a['year']) for a in schedule] == [(4, 2023), (1, 2024), (2, 2024), (3, 2024), (4, 2024)]
+        assert sum(a['amount'] for a in schedule) == 12_000_000
+        
+        monthly = AllocationService.calculate_allocations(1_000_000, date(2025, 1, 1), date(2025, 1, 31), 'month')
+        assert (monthly[0]['period'], monthly[0]['year']) == (10, 2024)
+        assert format_period('month', 10, 2024) == "T1/2025"
+    finally:
+        settings.fiscal_year_start_month = original
+    
+    assert get_quarter(date(2024, 5, 10)) == (2, 2024)
+
+
+def test_allocation_methods():
+    """Straight-line monthly and tranche methods, scalar and grouped batch."""
+    monthly = AllocationService.calculate_allocations(
+        12_000_000, date(2024, 1, 15), date(2025, 1, 14), 'month', method='monthly'
+    )
+    assert monthly.amounts.tolist() == [548_387] + [1_000_000] * 11 + [451_613]
+    
+    params = {'tranches': [
+        {'end_date': '2024-06-30', 'weight': 9_000_000},
+        {'end_date': '2025-01-14', 'weight': 3_000_000}
+    ]}
+    tranche = AllocationService.calculate_allocations(
+        12_000_000, date(2024, 1, 15), date(2025, 1, 14), method='tranche', params=params
+    )
+    assert tranche.cumulative()[1] == 9_000_000
+    assert tranche.total_allocated() == 12_000_000
+    
+    cases = [
+        (36_000_001, date(2024, 1, 15), date(2026, 3, 9), None, None),
+        (7_777_777, date(2024, 2, 29), date(2025, 2, 27), 'monthly', None),
+        (12_000_000, date(2024, 1, 15), date(2025, 1, 14), 'tranche', params),
+        (5_000_003, date(2023, 11, 30), date(2024, 12, 1), 'monthly', None),
+    ]
+    schedules = AllocationService.calculate_batch_schedules(
+        [c[0] for c in cases], [c[1] for c in cases], [c[2] for c in cases], 'month',
+        [c[3] for c in cases], [c[4] for c in cases]
+    )
+    for (total_amount, start_date, end_date, method, method_params), schedule in zip(cases, schedules):
+        expected = AllocationService.calculate_allocations(
+            total_amount, start_date, end_date, 'month', method, method_params
+        )
+        assert schedule.to_dicts() == expected.to_dicts()
+    
+    class _Expense:
+        total_amount = 12_000_000
+        start_date = date(2024, 1, 15)
+        end_date = date(2025, 1, 14)
+        allocation_method = 'tranche'
+        allocation_params = params
+    
+    for alloc, cumulative in zip(tranche, tranche.cumulative()):
+        assert AllocationService.accumulated_at(_Expense(), alloc['end_date']) == cumulative
+    
+    as_of = [a['end_date'] for a in monthly]
+    batch = AllocationService.accumulated_at_batch(
+        [12_000_000] * 13, [date(2024, 1, 15)] * 13, [date(2025, 1, 14)] * 13, as_of,
+        methods=['monthly'] * 13
+    )
+    assert batch.tolist() == monthly.cumulative().tolist()
+
+
+def test_simulation_reprices_open_periods():
+    """What-if deltas follow a schedule edit at the first projected period."""
+    from services.simulation import SimulationService
+    
+    totals = [40_000_000, 12_000_000]
+    starts = [date(2024, 1, 1), date(2024, 3, 1)]
+    ends = [date(2026, 12, 31), date(2025, 2, 28)]
+    simulation = SimulationService.simulate(
+        totals, starts, ends, np.array([True, False]), from_date=date(2025, 5, 20), years=3,
+        end_shift_months=-6, amount_change_pct=10
+    )
+    
+    closed = AllocationService.accumulated_at_batch([40_000_000], [starts[0]], [ends[0]], date(2025, 3, 31))[0]
+    edited = AllocationService.calculate_allocations(
+        44_000_000, starts[0], date(2026, 6, 30), rebase_date=date(2025, 4, 1), rebase_accumulated=int(closed)
+    )
+    assert simulation['scenario'].tolist()[:len(edited)] == edited.amounts.tolist()
+    assert simulation['delta'].sum() == 4_000_000
+    assert (simulation['scenario'] - simulation['baseline']).tolist() == simulation['delta'].tolist()
+
+
+def test_expense_index_follows_commits():
+    """Interval index answers overlap queries and tracks committed changes."""
+    from models.database import Expense
+    from services.expense_index import ExpenseIndexService
+    from utils.interval_index import SortedIntervalIndex
+    
+    db = _memory_session()
+    
+    def add_expense(name, start_date, end_date):
+        expense = Expense(
+            account_number="242001", name=name, total_amount=1_000_000,
+            start_date=start_date, end_date=end_date, sub_code="9995"
+        )
+        db.add(expense)
+        return expense
+    
+    old = add_expense("Đã hết", date(2020, 1, 1), date(2020, 12, 31))
+    current = add_expense("Đang chạy", date(2024, 1, 1), date(2025, 12, 31))
+    db.commit()
+    
+    ExpenseIndexService.invalidate()
+    try:
+        assert ExpenseIndexService.active_on(date(2024, 6, 1), db).tolist() == [current.id]
+        assert sorted(ExpenseIndexService.overlapping(date(2020, 6, 1), date(2024, 1, 1), db).tolist()) == sorted([old.id, current.id])
+        
+        future = add_expense("Sắp tới", date(2026, 1, 1), date(2026, 6, 30))
+        db.commit()
+        assert ExpenseIndexService.with_balance_on(date(2025, 1, 1), db).tolist() == [current.id, future.id]
+        
+        current.end_date = date(2024, 3, 31)
+        db.delete(future)
+        db.flush()
+        db.rollback()
+        assert ExpenseIndexService.with_balance_on(date(2025, 1, 1), db).tolist() == [current.id, future.id]
+        
+        db.delete(future)
+        db.commit()
+        assert ExpenseIndexService.active_on(date(2026, 3, 1), db).tolist() == []
+        assert db.query(Expense).filter(
+            ExpenseIndexService.id_filter(Expense.id, ExpenseIndexService.active_on(date(2024, 6, 1), db))
+        ).count() == 1
+        assert db.query(Expense.id).filter(
+            ExpenseIndexService.id_filter(Expense.id, [old.id]), ExpenseIndexService.id_filter(Expense.id, [old.id, current.id])
+        ).all() == [(old.id,)]
+        
+        # Several changes in one commit are applied as one batch
+        batch = [add_expense(f"Lô {i}", date(2024, 12 - i, 1), date(2027, 1, 1)) for i in range(3)]
+        current.end_date = date(2024, 3, 31)
+        db.delete(old)
+        db.commit()
+        fresh = SortedIntervalIndex.from_rows(db.query(Expense.id, Expense.start_date, Expense.end_date).all())
+        assert ExpenseIndexService.overlapping(date.min, date.max, db).tolist() == fresh.overlapping(date.min, date.max).tolist()
+        assert ExpenseIndexService.with_balance_on(date(2025, 1, 1), db).tolist() == [e.id for e in reversed(batch)]
+        
+        # The end-ordered array agrees with a scan after batched changes
+        rng = np.random.default_rng(0)
+        starts = rng.integers(738000, 739000, 500)
+        index = SortedIntervalIndex(range(500), starts.tolist(), (starts + rng.integers(0, 400, 500)).tolist(), block_size=16)
+        index.update({i: (738500, 738600) if i % 2 else None for i in range(0, 500, 7)})
+        for day in [737000, 738400, 738800, 739500]:
+            assert sorted(index.ending_on_or_after(day).tolist()) == sorted(index.overlapping(day, 10 ** 6).tolist())
+    finally:
+        ExpenseIndexService.invalidate()
+        db.close()
+
+
+def test_balance_report_matches_rows():
+    """SQL balance report pro-rates the open period like accumulated_from_rows."""
+    from models.database import Expense
+    from services.report import ReportService
+    
+    db = _memory_session()
+    
+    cases = [
+        (99_999_999, date(2024, 2, 10), date(2026, 11, 20), 1_000_000, 'month', "IT"),
+        (36_000_001, date(2023, 7, 15), date(2025, 7, 14), 0, 'quarter', None),
+    ]
+    for total_amount, start_date, end_date, already_allocated, period_type, tags in cases:
+        _add_scheduled_expense(db, total_amount, start_date, end_date, period_type, already_allocated=already_allocated, tags=tags)
+    db.commit()
+    
+    for as_of in [date(2023, 1, 1), date(2024, 8, 17), date(2025, 7, 14), date(2027, 1, 1)]:
+        report = ReportService.balance_report(db, as_of)
+        for row in report.itertuples():
+            expense = db.get(Expense, row.id)
+            expected = expense.already_allocated + AllocationService.accumulated_from_rows(expense.allocations, as_of)
+            assert row.accumulated == expected
+            assert row.balance == expense.total_amount + expense.already_allocated - expected
+    
+    assert ReportService.balance_report(db, date(2024, 8, 17), tags=["IT"])['name'].tolist() == ["CP 99999999"]
+    db.close()
+
+
+def test_allocation_detail_running_totals():
+    """Windowed detail query matches a running total over each expense's sorted rows."""
+    from models.database import Expense, Allocation
+    from services.report import ReportService
+    
+    db = _memory_session()
+    
+    cases = [
+        (99_999_999, date(2024, 2, 10), date(2026, 11, 20), 1_000_000, 'month'),
+        (36_000_001, date(2023, 7, 15), date(2025, 7, 14), 0, 'quarter'),
+    ]
+    for total_amount, start_date, end_date, already_allocated, period_type in cases:
+        expense = _add_scheduled_expense(db, total_amount, start_date, end_date, period_type, already_allocated=already_allocated)
+        if already_allocated:
+            # Historical row: shown in the schedule but never added to the running total
+            expense.allocations.append(Allocation(
+                period_type='quarter', period=4, quarter=4, year=2023, amount=already_allocated,
+                days_in_quarter=0, start_date=start_date, end_date=start_date
+            ))
+    db.commit()
+    
+    expected = {}
+    for expense in db.query(Expense).all():
+        running = expense.already_allocated
+        for alloc in sorted(expense.allocations, key=lambda a: (a.year, a.quarter, a.period or 0)):
+            if alloc.days_in_quarter > 0:
+                running += alloc.amount
+            expected[alloc.id] = (running, expense.total_amount + expense.already_allocated - running)
+    
+    for year, quarter in [(None, None), (2024, None), (2024, 3), (None, 2), (2023, 4)]:
+        detail = ReportService.allocation_detail(db, year, quarter)
+        assert len(detail) == sum(
+            1 for a in db.query(Allocation).all()
+            if (year is None or a.year == year) and (quarter is None or a.quarter == quarter)
+        )
+        for row in detail.itertuples():
+            assert (row.accumulated, row.remaining) == expected[row.id]
+    
+    first = db.query(Expense).filter(Expense.already_allocated == 0).one()
+    detail = ReportService.allocation_detail(db, 2023, 4, expense_ids=[first.id])
+    assert set(detail['expense_id']) == {first.id}
+    detail = ReportService.allocation_detail(db, 2023, 4, expense_ids=[first.id], keep_historical=True)
+    assert len(set(detail['expense_id'])) == 2
+    db.close()
+
+
+def test_allocation_totals_follow_flushes():
+    """Summary table updated on flush equals a full rebuild after inserts, edits and deletes."""
+    from services.allocation_totals import AllocationTotalService
+    
+    db = _memory_session()
+    
+    def totals():
+        return AllocationTotalService.period_totals(db).to_dict('records')
+    
+    def check():
+        maintained = totals()
+        AllocationTotalService.rebuild(db)
+        assert maintained == totals()
+        return maintained
+    
+    expenses = [
+        _add_scheduled_expense(db, total_amount, start_date, end_date, period_type, account_number=account_number)
+        for total_amount, start_date, end_date, period_type, account_number in [
+            (99_999_999, date(2024, 2, 10), date(2026, 11, 20), 'month', "242001"),
+            (36_000_001, date(2023, 7, 15), date(2025, 7, 14), 'quarter', "242001"),
+            (12_000_000, date(2024, 1, 1), date(2024, 12, 31), 'year', "242002"),
+        ]
+    ]
+    db.commit()
+    created = check()
+    q1_2024 = [r for r in created if (r['year'], r['quarter'], r['account_number']) == (2024, 1, "242001")][0]
+    assert q1_2024['expense_count'] == 2 and q1_2024['allocation_count'] == 3
+    # The yearly schedule is spread over its quarters, not booked in Q4
+    yearly = {r['quarter']: r['amount'] for r in created if (r['year'], r['account_number']) == (2024, "242002")}
+    quarterly = AllocationService.calculate_allocations(12_000_000, date(2024, 1, 1), date(2024, 12, 31))
+    assert yearly == {a['quarter']: a['amount'] for a in quarterly}
+    
+    AllocationService.reschedule_expense(db, expenses[0], total_amount=80_000_000, end_date=date(2025, 6, 30), as_of=date(2024, 8, 17))
+    check()
+    
+    expenses[1].account_number = "242002"
+    db.commit()
+    check()
+    
+    db.delete(expenses[2])
+    db.commit()
+    check()
+    
+    before_rollback = totals()
+    expenses[0].sub_code = "9995"
+    db.flush()
+    db.rollback()
+    assert totals() == before_rollback
+    db.close()
+
+
+def test_report_cache_follows_data_generation():
+    """Cached report frames are reused until a committed write to expenses/allocations."""
+    from models.database import Expense
+    from services.report import ReportService
+    
+    db = _memory_session()
+    calls = []
+    
+    def report():
+        return ReportService.cached('test_balance', (date(2024, 6, 30),), lambda: calls.append(1) or ReportService.balance_report(db, date(2024, 6, 30)))
+    
+    db.add(Expense(
+        account_number="242001", name="CP", total_amount=12_000_000,
+        start_date=date(2024, 1, 1), end_date=date(2024, 12, 31), sub_code="9995"
+    ))
+    db.commit()
+    first = report()
+    first['name'] = "modified by caller"
+    assert report()['name'].tolist() == ["CP"] and len(calls) == 1
+    
+    generation = ReportService.data_generation()
+    expense = db.query(Expense).one()
+    expense.name = "CP rolled back"
+    db.flush()
+    db.rollback()
+    db.commit()
+    assert ReportService.data_generation() == generation
+    assert report()['name'].tolist() == ["CP"] and len(calls) == 1
+    
+    expense.name = "CP mới"
+    db.commit()
+    assert ReportService.data_generation() == generation + 1
+    assert report()['name'].tolist() == ["CP mới"] and len(calls) == 2
+    db.close()
+
+
+def test_pivot_explodes_tags_with_subtotals():
+    """Tags in any order share a bucket, multi-tag rows count under each tag but once in totals."""
+    import pandas as pd
+    from services.pivot import PivotService, NO_TAG, TOTAL_LABEL, SUBTOTAL_LABEL
+    
+    frame = pd.DataFrame({
+        'Tài khoản': ["2421", "2421", "2422", "2421"],
+        'Tags': ["IT, Software", "Software,IT", None, "HR, IT, IT"],
+        'Số tiền': [10, 20, 30, 40],
+    })
+    long = PivotService.explode_tags(frame, "Tags")
+    assert sorted(long['Tags']) == sorted(["IT", "Software", "Software", "IT", NO_TAG, "HR", "IT"])
+    
+    by_tag = PivotService.pivot(frame, ["Tags"], ["Số tiền"], tag_column="Tags")
+    assert dict(zip(by_tag['Tags'], by_tag['Số tiền'])) == {
+        NO_TAG: 30, "HR": 40, "IT": 70, "Software": 30, TOTAL_LABEL: 100
+    }
+    
+    by_account_tag = PivotService.pivot(frame, ["Tài khoản", "Tags"], ["Số tiền"], tag_column="Tags")
+    rows = list(by_account_tag.itertuples(index=False, name=None))
+    assert rows == [
+        ("2421", "HR", 40), ("2421", "IT", 70), ("2421", "Software", 30), ("2421", SUBTOTAL_LABEL, 70),
+        ("2422", NO_TAG, 30), ("2422", SUBTOTAL_LABEL, 30),
+        (TOTAL_LABEL, "", 100),
+    ]
+
+
+def test_roll_forward_matches_balance_report():
+    """Roll-forward opening/closing per period equal the balance report of expenses started by then."""
+    from datetime import timedelta
+    from models.database import Expense
+    from services.report import ReportService
+    
+    db = _memory_session()
+    
+    cases = [
+        ("2421", "9996", 99_999_999, date(2023, 2, 10), date(2026, 11, 20), 1_000_000, 'month'),
+        ("2421", "9995", 36_000_001, date(2024, 7, 15), date(2025, 7, 14), 0, 'quarter'),
+        ("2422", "9996", 12_000_000, date(2024, 3, 1), date(2027, 2, 28), 500_000, 'year'),
+        ("2422", "9996", 7_000_000, date(2026, 1, 1), date(2026, 12, 31), 0, 'quarter'),
+    ]
+    for account_number, sub_code, total_amount, start_date, end_date, already_allocated, period_type in cases:
+        _add_scheduled_expense(
+            db, total_amount, start_date, end_date, period_type,
+            account_number=account_number, sub_code=sub_code, already_allocated=already_allocated
+        )
+    db.commit()
+    
+    def balances(as_of):
+        report = ReportService.balance_report(db, as_of)
+        started = {e.id for e in db.query(Expense).filter(Expense.start_date <= as_of)}
+        report = report[report['id'].isin(started)]
+        return report.groupby(['account_number', 'sub_code'])['balance'].sum().to_dict()
+    
+    from_date, to_date = date(2024, 2, 15), date(2025, 11, 20)
+    for period_type in [None, 'month', 'quarter', 'year']:
+        rollforward = ReportService.roll_forward(db, from_date, to_date, period_type)
+        assert (rollforward['opening'] + rollforward['additions'] - rollforward['amortization'] == rollforward['closing']).all()
+        
+        opening = balances(from_date - timedelta(days=1))
+        first = rollforward[rollforward['start_date'] == from_date]
+        for row in first.itertuples():
+            assert row.opening == opening.get((row.account_number, row.sub_code), 0)
+        for end_date, period in rollforward.groupby('end_date'):
+            closing = {k: v for k, v in balances(end_date).items() if v}
+            rolled = dict(zip(zip(period['account_number'], period['sub_code']), period['closing']))
+            assert {k: v for k, v in rolled.items() if v} == closing
+    
+    # Expenses added in the range and the amortization charged on them
+    whole = ReportService.roll_forward(db, from_date, to_date).set_index(['account_number', 'sub_code'])
+    assert whole.loc[("2421", "9995"), 'additions'] == 36_000_001
+    assert whole.loc[("2422", "9996"), 'additions'] == 12_500_000
+    assert whole['amortization'].sum() == whole['opening'].sum() + whole['additions'].sum() - whole['closing'].sum()
+    db.close()
+
+
+def test_tag_index_matches_exact_tags():
+    """Tag links follow inserts, edits and deletes; filters match whole tags only."""
+    from sqlalchemy import select
+    from models.database import Expense, Tag
+    from services.report import ReportService
+    from services.tag_index import TagIndexService
+    
+    db = _memory_session()
+    TagIndexService.invalidate()
+    
+    for name, tags in [("Phần mềm", "IT, Software"), ("Kiểm toán", "Audit"), ("Đào tạo", " HR ,IT,IT"), ("Khác", None)]:
+        db.add(Expense(
+            account_number="2421", name=name, total_amount=1_200, start_date=date(2024, 1, 1),
+            end_date=date(2024, 12, 31), sub_code="9995", tags=tags
+        ))
+    db.commit()
+    
+    def tagged(*tags):
+        return sorted(db.execute(select(Expense.name).where(TagIndexService.tag_filter(Expense.id, tags))).scalars())
+    
+    assert TagIndexService.tag_names(db) == ["Audit", "HR", "IT", "Software"]
+    assert tagged("IT") == ["Phần mềm", "Đào tạo"]
+    assert tagged("Audit", "HR") == ["Kiểm toán", "Đào tạo"]
+    assert sorted(ReportService.balance_report(db, date(2024, 6, 30), tags=["IT"])['name']) == ["Phần mềm", "Đào tạo"]
+    
+    audit = db.query(Expense).filter_by(name="Kiểm toán").one()
+    audit.tags = "Audit, IT"
+    db.delete(db.query(Expense).filter_by(name="Đào tạo").one())
+    db.commit()
+    assert tagged("IT") == ["Kiểm toán", "Phần mềm"]
+    assert TagIndexService.tag_names(db) == ["Audit", "IT", "Software"]
+    assert db.execute(select(Tag.name).where(Tag.name == "HR")).first() is None
+    
+    # Rebuilding from the tags column gives the same links
+    assert TagIndexService.rebuild(db) == 4
+    assert tagged("IT") == ["Kiểm toán", "Phần mềm"]
+    db.close()
+
+
+def test_search_index_ranks_folded_matches():
+    """FTS search follows inserts, edits and deletes, ignores diacritics and ranks name hits first."""
+    from sqlalchemy import select
+    from models.database import Expense
+    from services.search import SearchService
+    
+    db = _memory_session()
+    
+    for name, document_code, note in [
+        ("Phần mềm kế toán", "PC-001", None),
+        ("Thuê văn phòng Đà Nẵng", "HD-778", "Gồm phí quản lý phần mềm"),
+        ("Bảo hiểm xe", None, None),
+    ]:
+        db.add(Expense(
+            account_number="242001", name=name, total_amount=1_200, start_date=date(2024, 1, 1),
+            end_date=date(2024, 12, 31), sub_code="9995", document_code=document_code, note=note
+        ))
+    db.commit()
+    
+    def search(term):
+        ranked = SearchService.ranked(term)
+        return db.execute(
+            select(Expense.name).join(ranked, ranked.c.expense_id == Expense.id).order_by(ranked.c.rank)
+        ).scalars().all()
+    
+    assert search("phan mem") == ["Phần mềm kế toán", "Thuê văn phòng Đà Nẵng"]
+    assert search("da nang") == ["Thuê văn phòng Đà Nẵng"]
+    assert search("hd-77") == ["Thuê văn phòng Đà Nẵng"]
+    assert len(search("2420")) == 3
+    assert SearchService.match_query(' "" * ') is None
+    
+    insurance = db.query(Expense).filter_by(name="Bảo hiểm xe").one()
+    insurance.name = "Bảo hiểm ô tô"
+    db.delete(db.query(Expense).filter_by(name="Phần mềm kế toán").one())
+    db.commit()
+    assert search("xe") == []
+    assert search("o to") == ["Bảo hiểm ô tô"]
+    assert search("phan mem") == ["Thuê văn phòng Đà Nẵng"]
+    
+    assert SearchService.rebuild(db) == 2
+    assert search("bao hiem") == ["Bảo hiểm ô tô"]
+    db.close()
+
+
+def test_period_close_snapshots_and_locks():
+    """Reports from a close snapshot equal a full recomputation; closed quarters refuse edits."""
+    import pandas as pd
+    from models.database import Expense
+    from services.report import ReportService
+    from services.period_close import PeriodCloseService
+    
+    db = _memory_session()
+    expenses = [
+        _add_scheduled_expense(db, total_amount, start_date, end_date, period_type, already_allocated=already_allocated)
+        for total_amount, start_date, end_date, already_allocated, period_type in [
+            (99_999_999, date(2023, 2, 10), date(2026, 11, 20), 1_000_000, 'month'),
+            (36_000_001, date(2024, 1, 15), date(2025, 7, 14), 0, 'quarter'),
+            (12_000_000, date(2023, 6, 1), date(2027, 2, 28), 500_000, 'year'),
+        ]
+    ]
+    db.commit()
+    
+    def check(dates):
+        for as_of in dates:
+            full = db.execute(ReportService.balance_query(as_of))
+            expected = pd.DataFrame(full.all(), columns=list(full.keys())).drop(columns='allocated')
+            pd.testing.assert_frame_equal(ReportService.balance_report(db, as_of), expected)
+    
+    report_dates = [date(2024, 3, 31), date(2024, 5, 17), date(2024, 9, 30), date(2024, 12, 31), date(2025, 8, 1)]
+    first = PeriodCloseService.close_quarter(db, 2024, 1)
+    assert first.expense_count == 3
+    assert first.closing_balance == ReportService.balance_report(db, date(2024, 3, 31))['balance'].sum()
+    check(report_dates)
+    # The second snapshot is built from the first
+    PeriodCloseService.close_quarter(db, 2024, 3)
+    check(report_dates)
+    
+    # Closed quarters are locked against reschedules, new expenses and deletes
+    for expense, as_of in [(expenses[1], date(2024, 8, 17)), (expenses[2], date(2024, 11, 15))]:
+        try:
+            AllocationService.reschedule_expense(db, expense, total_amount=40_000_000, as_of=as_of)
+            assert False, "reschedule into a closed period"
+        except ValueError:
+            pass
+    for change in [
+        lambda: db.add(Expense(
+            account_number="242001", name="CP lùi ngày", total_amount=1_000_000,
+            start_date=date(2024, 5, 1), end_date=date(2024, 12, 31), sub_code="9995"
+        )),
+        lambda: db.delete(expenses[0]),
+    ]:
+        change()
+        try:
+            db.commit()
+            assert False, "change inside a closed period"
+        except ValueError:
+            db.rollback()
+    
+    AllocationService.reschedule_expense(db, expenses[1], total_amount=40_000_000, as_of=date(2024, 11, 15))
+    check(report_dates)
+    
+    assert PeriodCloseService.reopen_latest(db) == date(2024, 9, 30)
+    AllocationService.reschedule_expense(db, expenses[1], total_amount=41_000_000, as_of=date(2024, 8, 17))
+    check(report_dates)
+    try:
+        PeriodCloseService.close_quarter(db, 2024, 4, today=date(2024, 12, 31))
+        assert False, "close before the quarter ended"
+    except ValueError:
+        pass
+    db.close()
+
+
+def test_maturity_report_splits_current_portion():
+    """Current part is the next 12 months of amortization; balances age by months to maturity."""
+    from services.report import ReportService
+    from utils.helpers import add_months
+    
+    db = _memory_session()
+    expenses = [
+        _add_scheduled_expense(db, total_amount, start_date, end_date, period_type, already_allocated=0)
+        for total_amount, start_date, end_date, period_type in [
+            (36_000_001, date(2024, 1, 1), date(2026, 12, 31), 'quarter'),
+            (7_000_000, date(2024, 3, 10), date(2025, 3, 9), 'month'),
+            (99_999_999, date(2023, 2, 10), date(2030, 11, 20), 'year'),
+            (5_000_000, date(2023, 1, 1), date(2023, 12, 31), 'quarter'),
+        ]
+    ]
+    db.commit()
+    
+    as_of = date(2024, 5, 17)
+    report = ReportService.maturity_report(db, as_of).set_index('id')
+    balances = ReportService.balance_report(db, as_of).set_index('id')['balance']
+    assert sorted(report.index) == sorted(e.id for e in expenses[:3])
+    for expense in expenses[:3]:
+        row = report.loc[expense.id]
+        upcoming = (
+            AllocationService.accumulated_from_rows(expense.allocations, add_months(as_of, 12))
+            - AllocationService.accumulated_from_rows(expense.allocations, as_of)
+        )
+        assert row['balance'] == balances[expense.id]
+        assert row['current'] == upcoming
+        assert row['current'] + row['non_current'] == row['balance']
+    
+    assert report.loc[expenses[1].id, 'non_current'] == 0
+    assert dict(zip(report.index, report['months_to_maturity'])) == {
+        expenses[0].id: 32, expenses[1].id: 10, expenses[2].id: 79
+    }
+    assert dict(zip(report.index, report['maturity_bucket'].astype(str))) == {
+        expenses[0].id: "24 - 36 tháng", expenses[1].id: "6 - 12 tháng", expenses[2].id: "> 60 tháng"
+    }
+    db.close()
+
+
+def test_dashboard_series_matches_balances():
+    """Quarterly closing balances from the summary tables equal the balance report; cached until a write."""
+    import pandas as pd
+    from models.database import Expense
+    from services.report import ReportService
+    from services.dashboard import DashboardService
+    from utils.helpers import get_quarter_dates
+    
+    db = _memory_session()
+    
+    for account_number, total_amount, start_date, end_date, already_allocated, period_type, tags in [
+        ("242001", 99_999_999, date(2023, 2, 10), date(2026, 11, 20), 1_000_000, 'month', "IT, Thuê"),
+        ("242001", 36_000_001, date(2024, 7, 15), date(2025, 7, 14), 0, 'quarter', "IT"),
+        ("242002", 12_000_000, date(2024, 3, 1), date(2027, 2, 28), 500_000, 'year', None),
+    ]:
+        _add_scheduled_expense(
+            db, total_amount, start_date, end_date, period_type,
+            account_number=account_number, already_allocated=already_allocated, tags=tags
+        )
+    db.commit()
+    
+    series = DashboardService.cached_series(db)
+    assert (series['period_label'].iloc[0], series['period_label'].iloc[-1]) == ("Q1/2023", "Q1/2027")
+    assert len(series) == 17 * 2
+    for (year, quarter), period in series.groupby(['year', 'quarter']):
+        end_date = get_quarter_dates(quarter, year)[1]
+        assert (period['end_date'] == pd.Timestamp(end_date)).all()
+        report = ReportService.balance_report(db, end_date)
+        started = {e.id for e in db.query(Expense).filter(Expense.start_date <= end_date)}
+        report = report[report['id'].isin(started)]
+        assert dict(zip(period['account_number'], period['closing'])) == {
+            account: report.loc[report['account_number'] == account, 'balance'].sum() for account in ("242001", "242002")
+        }
+    assert series['additions'].sum() == 99_999_999 + 36_000_001 + 12_000_000
+    
+    tags = DashboardService.balance_by_tag(db, date(2024, 12, 31)).set_index('tag')['balance']
+    closing = series[series['period_label'] == "Q4/2024"].set_index('account_number')['closing']
+    assert tags["(Không có)"] == closing["242002"] and tags["IT"] == closing["242001"]
+    
+    # Reused until the next committed write
+    hits = ReportService.result_cache_info()['hits']
+    assert DashboardService.cached_series(db).equals(series)
+    assert ReportService.result_cache_info()['hits'] == hits + 1
+    db.add(Expense(
+        account_number="242002", name="CP mới", total_amount=4_000_000,
+        start_date=date(2025, 1, 1), end_date=date(2025, 12, 31), sub_code="9995"
+    ))
+    db.commit()
+    assert DashboardService.cached_series(db)['additions'].sum() == series['additions'].sum() + 4_000_000
+    db.close()
+
+
+def test_fiscal_year_change_relabels_stored_periods():
+    """Changing the fiscal year start is stored and moves saved rows and totals to the new calendar."""
+    from config.settings import settings
+    from models.database import SessionLocal, Allocation
+    from services.allocation_totals import AllocationTotalService
+    from services.fiscal_year import FiscalYearService
+    from services.report import ReportService
+    
+    db = _memory_session()
+    original = settings.fiscal_year_start_month
+    try:
+        _add_scheduled_expense(db, 12_000_000, date(2024, 1, 1), date(2024, 12, 31), sub_code="9995")
+        _add_scheduled_expense(db, 12_000_000, date(2024, 1, 1), date(2024, 12, 31), 'year', account_number="242002")
+        db.commit()
+        
+        assert FiscalYearService.set_start_month(db, 4) == 4
+        labels = {a.start_date: (a.quarter, a.year) for a in db.query(Allocation).filter(Allocation.period_type == 'quarter')}
+        assert labels[date(2024, 1, 1)] == (4, 2023) and labels[date(2024, 4, 1)] == (1, 2024)
+        
+        maintained = AllocationTotalService.period_totals(db).to_dict('records')
+        AllocationTotalService.rebuild(db)
+        assert maintained == AllocationTotalService.period_totals(db).to_dict('records')
+        # The yearly row's quarter shares follow the new calendar too
+        for account_number in ("242001", "242002"):
+            assert [(r['year'], r['quarter']) for r in maintained if r['account_number'] == account_number] == [
+                (2023, 4), (2024, 1), (2024, 2), (2024, 3)
+            ]
+        
+        # Period filters and stored labels agree under the new calendar
+        detail = ReportService.allocation_detail(db, 2024, 1)
+        assert detail.loc[detail['period_type'] == 'quarter', 'start_date'].tolist() == [date(2024, 4, 1)]
+        
+        settings.fiscal_year_start_month = 1
+        assert FiscalYearService.load(SessionLocal(bind=db.get_bind())) == 4
+    finally:
+        settings.fiscal_year_start_month = original
+        db.close()
+
+
 if __name__ == "__main__":
     test_allocation()
+    test_batch_allocation_matches_scalar()
+    test_allocation_split_reconciles()
+    test_monthly_schedule_rolls_up_to_quarterly()
+    test_schedule_cache_reuses_immutable_schedules()
+    test_allocation_schedule_views()
+    test_accumulated_at_matches_schedule()
+    test_reschedule_touches_only_open_periods()
+    test_projection_matches_schedules()
+    test_fiscal_year_calendar()
+    test_allocation_methods()
+    test_simulation_reprices_open_periods()
+    test_expense_index_follows_commits()
+    test_balance_report_matches_rows()
+    test_allocation_detail_running_totals()
+    test_allocation_totals_follow_flushes()
+    test_report_cache_follows_data_generation()
+    test_pivot_explodes_tags_with_subtotals()
+    test_roll_forward_matches_balance_report()
+    test_tag_index_matches_exact_tags()
+    test_search_index_ranks_folded_matches()
+    test_period_close_snapshots_and_locks()
+    test_maturity_report_splits_current_portion()
+    test_dashboard_series_matches_balances()
+    test_fiscal_year_change_relabels_stored_periods()
@@ -0,0 +1,226 @@
+"""Precomputed period calendars (month/quarter/year) for fast period lookups."""
+from datetime import date
+from functools import lru_cache
+from typing import Optional
+import numpy as np
+import pandas as pd
+from config.settings import settings
+
+# Ordinal of 1970-01-01, used to convert between day ordinals and datetime64[D]
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def to_ordinals(values) -> np.ndarray:
+    """
+    Convert a sequence of dates to an int64 array of day ordinals.
+
+    Args:
+        values: Dates, datetimes, strings or datetime64 values
+
+    Returns:
+        np.ndarray: Day ordinals (same numbering as date.toordinal())
+    """
+    if isinstance(values, np.ndarray) and values.dtype.kind == 'M':
+        days = values.astype('datetime64[D]')
+    else:
+        days = pd.to_datetime(pd.Series(values)).to_numpy().astype('datetime64[D]')
+    return days.astype(np.int64) + EPOCH_ORDINAL
+
+
+def ordinals_to_datetime64(ordinals: np.ndarray) -> np.ndarray:
+    """Convert day ordinals back to a datetime64[D] array."""
+    return (np.asarray(ordinals, dtype=np.int64) - EPOCH_ORDINAL).astype('datetime64[D]')
+
+
+# Supported allocation period granularities and their length in months
+PERIOD_MONTH = 'month'
+PERIOD_QUARTER = 'quarter'
+PERIOD_YEAR = 'year'
+PERIOD_MONTHS = {
+    PERIOD_MONTH: 1,
+    PERIOD_QUARTER: 3,
+    PERIOD_YEAR: 12,
+}
+
+
+def fiscal_year_of(date_value: date, start_month: int = 1) -> int:
+    """Get the fiscal year of a date (fiscal years are named by the year they start in)."""
+    return date_value.year if date_value.month >= start_month else date_value.year - 1
+
+
+class PeriodCalendar:
+    """
+    Flat lookup tables mapping each day of a fiscal year range to its period.
+
+    Fiscal years start on day 1 of start_month (1 = calendar years) and are
+    named by the calendar year they start in. Periods are numbered by a
+    sequence index (0 = first period of first_year). Per-day arrays give the
+    period index; per-period arrays give period number within the fiscal
+    year, fiscal year, closing fiscal quarter, start/end ordinals and days
+    in period.
+    """
+
+    def __init__(
+        self,
+        first_year: int,
+        last_year: int,
+        period_type: str = PERIOD_QUARTER,
+        start_month: int = 1
+    ):
+        if last_year < first_year:
+            raise ValueError("last_year must not be before first_year")
+        if period_type not in PERIOD_MONTHS:
+            raise ValueError(f"Unknown period type: {period_type}")
+        if not 1 <= start_month <= 12:
+            raise ValueError(f"Invalid fiscal year start month: {start_month}")
+
+        self.period_type = period_type
+        self.start_month = start_month
+        self.first_year = first_year
+        self.last_year = last_year
+        self.first_ordinal = date(first_year, start_month, 1).toordinal()
+        self.last_ordinal = date(last_year + 1, start_month, 1).toordinal() - 1
+
+        months = PERIOD_MONTHS[period_type]
+        self.periods_per_year = 12 // months
+
+        # Period boundaries via month arithmetic (months counted from 1970-01)
+        n_periods = (last_year - first_year + 1) * self.periods_per_year
+        sequence = np.arange(n_periods, dtype=np.int64)
+        month_index = (
+            (first_year - 1970) * 12 + start_month - 1
+            + np.arange(n_periods + 1, dtype=np.int64) * months
+        )
+        boundaries = month_index.astype('datetime64[M]').astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+
+        self.period_start = boundaries[:-1]
+        self.period_end = boundaries[1:] - 1
+        self.period_days = self.period_end - self.period_start + 1
+        self.period_number = sequence % self.periods_per_year + 1
+        self.period_year = sequence // self.periods_per_year + first_year
+        # Fiscal quarter in which each period closes (periods never straddle a fiscal year end)
+        self.period_quarter = (self.period_number * months - 1) // 3 + 1
+
+        # Day ordinal -> period index
+        self.day_period = np.repeat(sequence, self.period_days)
+
+        # Prebuilt Python objects for the scalar helpers
+        self._day_period_list = self.day_period.tolist()
+        self._period_keys = list(zip(self.period_number.tolist(), self.period_year.tolist()))
+        self._period_quarters = self.period_quarter.tolist()
+        self._period_dates = [
+            (date.fromordinal(s), date.fromordinal(e))
+            for s, e in zip(self.period_start.tolist(), self.period_end.tolist())
+        ]
+
+    def contains(self, ordinal: int) -> bool:
+        """Check whether a day ordinal is covered by the table."""
+        return self.first_ordinal <= ordinal <= self.last_ordinal
+
+    def period_index(self, number: int, year: int) -> Optional[int]:
+        """Get the sequence index of a period, or None if outside the table."""
+        if not (self.first_year <= year <= self.last_year and 1 <= number <= self.periods_per_year):
+            return None
+        return (year - self.first_year) * self.periods_per_year + number - 1
+
+    def index_of(self, date_value: date) -> Optional[int]:
+        """Get the sequence index of the period containing a date, or None."""
+        ordinal = date_value.toordinal()
+        if not self.contains(ordinal):
+            return None
+        return self._day_period_list[ordinal - self.first_ordinal]
+
+    def period_of(self, date_value: date) -> Optional[tuple[int, int]]:
+        """Get (period number, year) for a date, or None if outside the table."""
+        idx = self.index_of(date_value)
+        return None if idx is None else self._period_keys[idx]
+
+    def period_dates(self, number: int, year: int) -> Optional[tuple[date, date]]:
+        """Get (start_date, end_date) for a period, or None if outside the table."""
+        idx = self.period_index(number, year)
+        return None if idx is None else self._period_dates[idx]
+
+    def dates_at(self, idx: int) -> tuple[date, date]:
+        """Get (start_date, end_date) of the period with a given sequence index."""
+        return self._period_dates[idx]
+
+    def key_at(self, idx: int) -> tuple[int, int]:
+        """Get (period number, year) of the period with a given sequence index."""
+        return self._period_keys[idx]
+
+    def quarter_at(self, idx: int) -> int:
+        """Get the quarter in which the period with a given sequence index closes."""
+        return self._period_quarters[idx]
+
+    def covers(self, ordinals: np.ndarray) -> bool:
+        """Check whether every ordinal in an array is covered by the table."""
+        ordinals = np.asarray(ordinals)
+        if ordinals.size == 0:
+            return True
+        return bool(ordinals.min() >= self.first_ordinal and ordinals.max() <= self.last_ordinal)
+
+    def period_indices(self, ordinals: np.ndarray) -> np.ndarray:
+        """Vectorized day ordinal -> period index (ordinals must be covered)."""
+        return self.day_period[np.asarray(ordinals, dtype=np.int64) - self.first_ordinal]
+
+
+@lru_cache(maxsize=None)
+def _shared_calendar(period_type: str, start_month: int) -> PeriodCalendar:
+    """Build the shared table for a period type and fiscal year start (once each)."""
+    return PeriodCalendar(settings.calendar_first_year, settings.calendar_last_year, period_type, start_month)
+
+
+def active_start_month() -> int:
+    """Get the fiscal year start month currently configured."""
+    return settings.fiscal_year_start_month
+
+
+def get_period_calendar(period_type: str = PERIOD_QUARTER, start_month: Optional[int] = None) -> PeriodCalendar:
+    """
+    Get the shared calendar table for a period type, built on first use.
+
+    Args:
+        period_type: 'month', 'quarter' or 'year'
+        start_month: Fiscal year start month (default: the configured one,
+            read at call time so a settings change applies immediately)
+    """
+    return _shared_calendar(period_type, active_start_month() if start_month is None else start_month)
+
+
+def calendar_covering(
+    ordinals: np.ndarray,
+    period_type: str = PERIOD_QUARTER,
+    start_month: Optional[int] = None
+) -> PeriodCalendar:
+    """
+    Get a calendar covering every ordinal in an array.
+
+    Returns the shared table when it covers the dates, otherwise builds a
+    one-off table for the required fiscal years.
+    """
+    cal = get_period_calendar(period_type, start_month)
+    if cal.covers(ordinals):
+        return cal
+
+    ordinals = np.asarray(ordinals)
+    first_year = fiscal_year_of(date.fromordinal(int(ordinals.min())), cal.start_month)
+    last_year = fiscal_year_of(date.fromordinal(int(ordinals.max())), cal.start_month)
+    return PeriodCalendar(first_year, last_year, period_type, cal.start_month)
+
+
+def calendar_month(period: int, year: int, start_month: Optional[int] = None) -> tuple[int, int]:
+    """
+    Convert a fiscal month period to (calendar month, calendar year).
+
+    Args:
+        period: Month number within the fiscal year (1 = first fiscal month)
+        year: Fiscal year
+        start_month: Fiscal year start month (default: the configured one)
+    """
+    start_month = active_start_month() if start_month is None else start_month
+    month_index = start_month - 1 + period - 1
+    return month_index % 12 + 1, year + month_index // 12
+
+
+# Quarter table of the configured fiscal year is built at import time; others on first use
+get_period_calendar(PERIOD_QUARTER)
@@ -1,39 +1,51 @@
 """Helper utility functions."""
 from datetime import date, timedelta
 from calendar import monthrange
+from utils.fiscal_calendar import (
+    PERIOD_QUARTER, get_period_calendar, active_start_month, fiscal_year_of, calendar_month
+)
 
 
 def get_quarter(date_value: date) -> tuple[int, int]:
     """
-    Get quarter and year for a given date.
+    Get fiscal quarter and fiscal year for a given date.
     
     Args:
         date_value: Date to get quarter for
     
     Returns:
-        tuple: (quarter, year)
+        tuple: (quarter, year) under the configured fiscal year start
     """
-    quarter = (date_value.month - 1) // 3 + 1
-    return quarter, date_value.year
+    cached = get_period_calendar(PERIOD_QUARTER).period_of(date_value)
+    if cached is not None:
+        return cached
+    
+    start_month = active_start_month()
+    quarter = (date_value.month - start_month) % 12 // 3 + 1
+    return quarter, fiscal_year_of(date_value, start_month)
 
 
 def get_quarter_dates(quarter: int, year: int) -> tuple[date, date]:
     """
-    Get start and end dates for a given quarter.
+    Get start and end dates for a given fiscal quarter.
     
     Args:
         quarter: Quarter number (1-4)
-        year: Year
+        year: Fiscal year
     
     Returns:
         tuple: (start_date, end_date)
     """
-    start_month = (quarter - 1) * 3 + 1
-    end_month = start_month + 2
+    cached = get_period_calendar(PERIOD_QUARTER).period_dates(quarter, year)
+    if cached is not None:
+        return cached
+    
+    start_month, start_year = calendar_month((quarter - 1) * 3 + 1, year)
+    end_month, end_year = calendar_month(quarter * 3, year)
     
-    start_date = date(year, start_month, 1)
-    _, last_day = monthrange(year, end_month)
-    end_date = date(year, end_month, last_day)
+    start_date = date(start_year, start_month, 1)
+    _, last_day = monthrange(end_year, end_month)
+    end_date = date(end_year, end_month, last_day)
     
     return start_date, end_date
 
@@ -52,6 +64,21 @@ def get_days_in_range(start: date, end: date) -> int:
     return (end - start).days + 1
 
 
+def to_dong(amount) -> int:
+    """
+    Convert an amount to whole đồng.
+    
+    Args:
+        amount: Amount as int, float, string or Decimal
+    
+    Returns:
+        int: Amount rounded to the nearest đồng
+    """
+    if isinstance(amount, int):
+        return amount
+    return int(round(float(amount)))
+
+
 def format_currency(amount: float) -> str:
     """
     Format amount as Vietnamese currency with comma separator.
@@ -80,6 +107,35 @@ def format_quarter(quarter: int, year: int) -> str:
     return f"Q{quarter}/{year}"
 
 
+# Display labels for allocation period granularities
+PERIOD_LABELS = {
+    'month': 'Tháng',
+    'quarter': 'Quý',
+    'year': 'Năm',
+}
+
+
+def format_period(period_type: str, period: int, year: int) -> str:
+    """
+    Format a period label for any allocation granularity.
+    
+    Args:
+        period_type: 'month', 'quarter' or 'year'
+        period: Period number within the fiscal year
+        year: Fiscal year
+    
+    Returns:
+        str: Formatted period string (e.g. T3/2024, Q1/2024, 2024). Month
+        labels show the calendar month; quarters and years are fiscal.
+    """
+    if period_type == 'month':
+        month, calendar_year = calendar_month(period, year)
+        return f"T{month}/{calendar_year}"
+    if period_type == 'year':
+        return f"{year}"
+    return format_quarter(period, year)
+
+
 def add_months(start_date: date, months: int) -> date:
     """
     Add months to a date.
@@ -0,0 +1,174 @@
+"""Sorted-array interval index for date range lookups."""
+from datetime import date
+from threading import Lock
+from typing import Iterable, Mapping, Optional, Tuple, Union
+import numpy as np
+
+DateLike = Union[date, int]
+
+# Bits of the start ordinal in the (end, start) sort key; date.max's ordinal fits in 22
+_START_BITS = 22
+
+
+def _ordinal(value: DateLike) -> int:
+    """Get the day ordinal of a date (ints are taken as ordinals already)."""
+    return value if isinstance(value, (int, np.integer)) else value.toordinal()
+
+
+class SortedIntervalIndex:
+    """
+    Index of closed [start, end] day intervals keyed by integer id.
+
+    Intervals are kept in arrays sorted by start, split into fixed-size
+    blocks that record their largest end. An overlap query binary-searches
+    the last interval starting before the query end and scans only blocks
+    whose largest end reaches the query start, so intervals that ended long
+    ago are skipped a block at a time. A second array sorted by (end, start)
+    answers "ends on or after a day" with one binary search. Changes
+    rewrite the arrays; batch them with update() so a group of changes
+    costs one pass.
+    """
+
+    def __init__(
+        self,
+        ids: Iterable[int] = (),
+        starts: Iterable[DateLike] = (),
+        ends: Iterable[DateLike] = (),
+        block_size: int = 256
+    ):
+        ids = np.fromiter(ids, dtype=np.int64)
+        starts = np.array([_ordinal(v) for v in starts], dtype=np.int64)
+        ends = np.array([_ordinal(v) for v in ends], dtype=np.int64)
+        order = np.lexsort((ids, starts))
+        self._ids = ids[order]
+        self._starts = starts[order]
+        self._ends = ends[order]
+        by_end = np.argsort(self._end_keys(self._ends, self._starts), kind='stable')
+        self._end_order_keys = self._end_keys(self._ends, self._starts)[by_end]
+        self._end_order_ids = self._ids[by_end]
+        self._block_size = block_size
+        self._lock = Lock()
+        self._refresh_blocks()
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Tuple[int, date, date]], block_size: int = 256) -> "SortedIntervalIndex":
+        """Build an index from (id, start_date, end_date) rows."""
+        rows = list(rows)
+        return cls(
+            (r[0] for r in rows), (r[1] for r in rows), (r[2] for r in rows), block_size
+        )
+
+    @staticmethod
+    def _end_keys(ends: np.ndarray, starts: np.ndarray) -> np.ndarray:
+        """Pack (end, start) ordinals into one int64 sort key."""
+        return (ends << _START_BITS) | starts
+
+    def _refresh_blocks(self):
+        """Recompute the largest end of every block."""
+        if len(self._ends):
+            self._block_max_end = np.maximum.reduceat(
+                self._ends, np.arange(0, len(self._ends), self._block_size)
+            )
+        else:
+            self._block_max_end = np.empty(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, interval_id: int) -> bool:
+        return bool((self._ids == interval_id).any())
+
+    def add(self, interval_id: int, start: DateLike, end: DateLike):
+        """Insert an interval, replacing any interval with the same id."""
+        self.update({interval_id: (start, end)})
+
+    def update(self, changes: Mapping[int, Optional[Tuple[DateLike, DateLike]]]):
+        """
+        Apply many inserts, replacements and deletes in one pass over the arrays.
+
+        Args:
+            changes: Mapping id -> (start, end) to insert or replace the
+                interval, or None to delete it
+        """
+        if not changes:
+            return
+        changed = np.fromiter(changes.keys(), dtype=np.int64, count=len(changes))
+        added = [(i, _ordinal(d[0]), _ordinal(d[1])) for i, d in changes.items() if d is not None]
+        new_ids = np.array([a[0] for a in added], dtype=np.int64)
+        new_starts = np.array([a[1] for a in added], dtype=np.int64)
+        new_ends = np.array([a[2] for a in added], dtype=np.int64)
+        order = np.lexsort((new_ids, new_starts))
+        new_keys = self._end_keys(new_ends, new_starts)
+        end_order = np.argsort(new_keys, kind='stable')
+        with self._lock:
+            keep = ~np.isin(self._ids, changed)
+            starts = self._starts[keep]
+            # Inserting at presorted positions keeps the arrays sorted by start
+            positions = np.searchsorted(starts, new_starts[order], side='right')
+            self._ids = np.insert(self._ids[keep], positions, new_ids[order])
+            self._starts = np.insert(starts, positions, new_starts[order])
+            self._ends = np.insert(self._ends[keep], positions, new_ends[order])
+            self._refresh_blocks()
+
+            keep = ~np.isin(self._end_order_ids, changed)
+            keys = self._end_order_keys[keep]
+            positions = np.searchsorted(keys, new_keys[end_order], side='right')
+            self._end_order_keys = np.insert(keys, positions, new_keys[end_order])
+            self._end_order_ids = np.insert(self._end_order_ids[keep], positions, new_ids[end_order])
+
+    def remove(self, interval_id: int) -> bool:
+        """Delete an interval by id, returning whether it was present."""
+        with self._lock:
+            removed = self._remove(interval_id)
+            if removed:
+                self._refresh_blocks()
+            return removed
+
+    def _remove(self, interval_id: int) -> bool:
+        positions = np.flatnonzero(self._ids == interval_id)
+        if len(positions) == 0:
+            return False
+        self._ids = np.delete(self._ids, positions)
+        self._starts = np.delete(self._starts, positions)
+        self._ends = np.delete(self._ends, positions)
+        positions = np.flatnonzero(self._end_order_ids == interval_id)
+        self._end_order_keys = np.delete(self._end_order_keys, positions)
+        self._end_order_ids = np.delete(self._end_order_ids, positions)
+        return True
+
+    def overlapping(self, start: DateLike, end: DateLike) -> np.ndarray:
+        """
+        Get ids of intervals sharing at least one day with [start, end].
+
+        Returns:
+            np.ndarray: Ids ordered by interval start
+        """
+        start, end = _ordinal(start), _ordinal(end)
+        with self._lock:
+            ids, starts, ends = self._ids, self._starts, self._ends
+            block_max_end, size = self._block_max_end, self._block_size
+
+        # Intervals starting on or before the query end form a prefix
+        count = int(np.searchsorted(starts, end, side='right'))
+        if count == 0:
+            return np.empty(0, dtype=np.int64)
+
+        blocks = np.flatnonzero(block_max_end[:(count - 1) // size + 1] >= start)
+        positions = (blocks[:, None] * size + np.arange(size)).ravel()
+        positions = positions[positions < count]
+        return ids[positions[ends[positions] >= start]]
+
+    def ending_on_or_after(self, day: DateLike) -> np.ndarray:
+        """
+        Get ids of intervals whose end is on or after a day, with one binary search.
+
+        Returns:
+            np.ndarray: Ids ordered by interval end, then start
+        """
+        with self._lock:
+            keys, ids = self._end_order_keys, self._end_order_ids
+        return ids[int(np.searchsorted(keys, _ordinal(day) << _START_BITS, side='left')):]
+
+    def active_on(self, day: DateLike) -> np.ndarray:
+        """Get ids of intervals containing a day."""
+        return self.overlapping(day, day)